@@ -0,0 +1,313 @@
+import click
+from datetime import datetime
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from meshscripts.compression import COMPRESSIONS
+from meshscripts.io import patch_filename, patch_reader
+
+# Each case runs a generator script with fixed arguments, plus one option
+# swept over a ladder of resolutions
+SUITE = {
+    'cylinder-2d': {
+        'script': 'cylinder/cylinder.py',
+        'args': ['--grad', '1.1'],
+        'option': '--nel-circ',
+        'ladder': [40, 80, 160, 320, 640],
+    },
+    'cylinder-3d': {
+        'script': 'cylinder/cylinder.py',
+        'args': ['--grad', '1.1', '--height', '1.0', '--nel-height', '10'],
+        'option': '--nel-circ',
+        'ladder': [40, 80, 160, 320, 640],
+    },
+    'cut_square': {
+        'script': 'cut_square/cut_square.py',
+        'args': [],
+        'option': '--nel-ang',
+        'ladder': [14, 28, 56, 112, 224],
+    },
+    'flag': {
+        'script': 'flag/flag.py',
+        'args': [],
+        'option': '--nel-circ',
+        'ladder': [120, 240, 480, 960, 1920],
+    },
+    'filled_cylinder': {
+        'script': 'filled_cylinder/filled_cylinder.py',
+        'args': [],
+        'option': '--elements-rad',
+        'ladder': [10, 20, 40, 80, 160],
+    },
+    'thingy': {
+        'script': 'thingy/thingy.py',
+        'args': [],
+        'option': '--elements',
+        'ladder': [(3, 20), (6, 40), (12, 80), (24, 160), (48, 320)],
+    },
+}
+
+# Quantities compared against a baseline, where an increase is a regression
+METRICS = ['wall', 'peak_rss', 'output_size']
+
+# Cases whose generator can build its patches at the target order
+NATIVE = ['cylinder-2d', 'cylinder-3d', 'cut_square', 'flag', 'filled_cylinder']
+
+# Cases whose generator can compress its output
+COMPRESSIBLE = ['cylinder-2d', 'cylinder-3d', 'cut_square', 'flag', 'filled_cylinder']
+
+
+def ladder_args(option, value):
+    if isinstance(value, (list, tuple)):
+        return [option] + [str(v) for v in value]
+    return [option, str(value)]
+
+
+def execute(cmd):
+    """Run a command, returning its wall time and resource usage."""
+    with tempfile.TemporaryFile() as stderr:
+        start = perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=stderr)
+        # Unlike subprocess, wait4 gives the resource usage of this child only
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError('{} failed:\n{}'.format(' '.join(cmd), stderr.read().decode()))
+    return wall, usage
+
+
+def measure(case, value, repeat):
+    script = os.path.join(ROOT, case['script'])
+    args = case['args'] + ladder_args(case['option'], value)
+    tmp = tempfile.mkdtemp(prefix='meshbench-')
+    try:
+        out = os.path.join(tmp, 'out')
+        profile = os.path.join(tmp, 'profile.json')
+        cmd = [sys.executable, script] + args + ['--no-cache', '--out', out]
+
+        # Interpreter startup, imports and option parsing
+        startup = min(execute([sys.executable, script, '--help'])[0] for _ in range(repeat))
+
+        runs = [execute(cmd) for _ in range(repeat)]
+        wall, usage = min(runs, key=lambda run: run[0])
+        size = sum(os.path.getsize(os.path.join(tmp, fn)) for fn in os.listdir(tmp))
+
+        # Stage breakdown from a separate, profiled run
+        execute(cmd + ['--profile', profile])
+        with open(profile) as f:
+            stages = {name: total['wall'] for name, total in json.load(f)['stages'].items()}
+    finally:
+        shutil.rmtree(tmp)
+
+    return {
+        'args': args,
+        'value': value,
+        'wall': wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'peak_rss': usage.ru_maxrss * 1024,
+        'output_size': size,
+        'stages': dict(stages, startup=startup),
+    }
+
+
+def max_difference(a, b):
+    """Return the largest difference between the control points of two
+    patch files with patches of the same structure.
+    """
+    from splipy.io import G2
+
+    with G2(a) as f:
+        first = f.read()
+    with G2(b) as f:
+        second = f.read()
+    return max(np.abs(p.controlpoints - q.controlpoints).max() for p, q in zip(first, second))
+
+
+def versions():
+    info = {'python': platform.python_version()}
+    for module in ['numpy', 'scipy', 'splipy', 'lxml', 'click']:
+        out = subprocess.run(
+            [sys.executable, '-c', 'import {0}; print({0}.__version__)'.format(module)],
+            capture_output=True, text=True,
+        )
+        info[module] = out.stdout.strip() or None
+    return info
+
+
+def commit():
+    out = subprocess.run(['git', '-C', ROOT, 'rev-parse', 'HEAD'], capture_output=True, text=True)
+    return out.stdout.strip() or None
+
+
+@click.group()
+def main():
+    """Benchmarks of the mesh generators."""
+
+
+@main.command()
+@click.option('--case', 'cases', multiple=True, type=click.Choice(list(SUITE)),
+              help='Cases to run (default: all)')
+@click.option('--levels', type=int, default=None, help='Number of ladder steps to run')
+@click.option('--repeat', default=1, help='Runs per step, the fastest is kept')
+@click.option('--out', default='bench.json')
+def run(cases, levels, repeat, out):
+    """Run the benchmark suite and write the results to a JSON file."""
+    results = {}
+    for name in cases or SUITE:
+        case = SUITE[name]
+        results[name] = []
+        for value in case['ladder'][:levels]:
+            result = measure(case, value, repeat)
+            results[name].append(result)
+            print('{:16} {:>12} {:9.2f} s {:9.1f} MiB {:9.1f} MiB'.format(
+                name, str(value), result['wall'],
+                result['peak_rss'] / 2**20, result['output_size'] / 2**20,
+            ))
+
+    with open(out, 'w') as f:
+        json.dump({
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': commit(),
+            'host': platform.node(),
+            'versions': versions(),
+            'results': results,
+        }, f, indent=2)
+
+
+@main.command()
+@click.option('--case', 'cases', multiple=True, type=click.Choice(NATIVE),
+              help='Cases to run (default: all)')
+@click.option('--order', default=2, help='Target order')
+@click.option('--levels', type=int, default=None, help='Number of ladder steps to run')
+@click.option('--repeat', default=1, help='Runs per step, the fastest is kept')
+def native(cases, order, levels, repeat):
+    """Compare building patches at the target order (--native-order) against
+    lowering cubic patches, and check that the meshes agree.
+    """
+    print('{:16} {:>12} {:>12} {:>12} {:>8} {:>10}'.format(
+        'case', 'step', 'lowered [s]', 'native [s]', 'speedup', 'max diff'
+    ))
+    for name in cases or NATIVE:
+        case = SUITE[name]
+        for value in case['ladder'][:levels]:
+            tmp = tempfile.mkdtemp(prefix='meshbench-')
+            try:
+                walls = []
+                for flag in ['--no-native-order', '--native-order']:
+                    out = os.path.join(tmp, flag.strip('-'))
+                    cmd = [sys.executable, os.path.join(ROOT, case['script'])] + case['args'] + \
+                        ladder_args(case['option'], value) + \
+                        ['--order', str(order), flag, '--no-cache', '--out', out]
+                    walls.append(min(execute(cmd)[0] for _ in range(repeat)))
+                diff = max_difference(*(os.path.join(tmp, fn + '.g2') for fn in ['no-native-order', 'native-order']))
+            finally:
+                shutil.rmtree(tmp)
+            print('{:16} {:>12} {:12.2f} {:12.2f} {:7.1f}x {:10.2e}'.format(
+                name, str(value), walls[0], walls[1], walls[0] / walls[1], diff
+            ))
+
+
+@main.command()
+@click.option('--case', 'cases', multiple=True, type=click.Choice(COMPRESSIBLE),
+              help='Cases to run (default: all)')
+@click.option('--compression', 'compressions', multiple=True, type=click.Choice(list(COMPRESSIONS)),
+              help='Compressions to compare (default: all)')
+@click.option('--compression-level', type=int, default=None)
+@click.option('--levels', type=int, default=None, help='Number of ladder steps to run')
+@click.option('--repeat', default=1, help='Runs per step, the fastest is kept')
+def compression(cases, compressions, compression_level, levels, repeat):
+    """Compare writing compressed patch and topology files against plain
+    ones.  Shows the wall time of the run, the size of the output, the
+    compression ratio, the throughput, as uncompressed output written per
+    second, and the time to read the patch file back.
+    """
+    print('{:16} {:>12} {:>6} {:>10} {:>12} {:>7} {:>12} {:>10}'.format(
+        'case', 'step', 'comp', 'wall [s]', 'size [MiB]', 'ratio', 'rate [MiB/s]', 'read [s]'
+    ))
+    for name in cases or COMPRESSIBLE:
+        case = SUITE[name]
+        for value in case['ladder'][:levels]:
+            tmp = tempfile.mkdtemp(prefix='meshbench-')
+            try:
+                plain = None
+                for compression in [None] + list(compressions or COMPRESSIONS):
+                    out = os.path.join(tmp, compression or 'plain')
+                    cmd = [sys.executable, os.path.join(ROOT, case['script'])] + case['args'] + \
+                        ladder_args(case['option'], value) + ['--no-cache', '--out', out]
+                    if compression:
+                        cmd += ['--compression', compression]
+                        if compression_level is not None:
+                            cmd += ['--compression-level', str(compression_level)]
+                    wall = min(execute(cmd)[0] for _ in range(repeat))
+                    size = sum(os.path.getsize(os.path.join(tmp, fn)) for fn in os.listdir(tmp)
+                               if fn.startswith(os.path.basename(out) + '.'))
+                    plain = plain or size
+
+                    start = perf_counter()
+                    with patch_reader(patch_filename(out, 'g2', compression)) as f:
+                        f.read()
+                    read = perf_counter() - start
+
+                    print('{:16} {:>12} {:>6} {:10.2f} {:12.2f} {:6.2f}x {:12.1f} {:10.2f}'.format(
+                        name, str(value), compression or 'none', wall, size / 2**20, plain / size,
+                        plain / 2**20 / wall, read,
+                    ))
+            finally:
+                shutil.rmtree(tmp)
+
+
+@main.command()
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+@click.option('--threshold', default=0.10, help='Relative increase counted as a regression')
+def compare(baseline, current, threshold):
+    """Compare benchmark results against a baseline.
+
+    Exits with status 1 if any metric of any step increased by more than
+    the threshold.
+    """
+    with open(baseline) as f:
+        baseline = json.load(f)['results']
+    with open(current) as f:
+        current = json.load(f)['results']
+
+    regressions = 0
+    print('{:16} {:>12} {:>12} {:>14} {:>14} {:>8}'.format(
+        'case', 'step', 'metric', 'baseline', 'current', 'change'
+    ))
+    for name, results in current.items():
+        steps = {json.dumps(r['value']): r for r in baseline.get(name, [])}
+        for result in results:
+            ref = steps.get(json.dumps(result['value']))
+            if ref is None:
+                continue
+            for metric in METRICS:
+                change = result[metric] / ref[metric] - 1 if ref[metric] else 0.0
+                flag = ''
+                if change > threshold:
+                    flag = '  REGRESSION'
+                    regressions += 1
+                print('{:16} {:>12} {:>12} {:14.4g} {:14.4g} {:+7.1%}{}'.format(
+                    name, str(result['value']), metric, ref[metric], result[metric], change, flag
+                ))
+
+    if regressions:
+        print('{} regression(s) above {:.0%}'.format(regressions, threshold), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,112 @@
 import click
-import numpy as np
-from lxml import etree
+from collections import OrderedDict
+import os
+import sys
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from meshscripts.cache import cached
+from meshscripts.compression import compression_options
+from meshscripts.hierarchy import write_hierarchy
+from meshscripts.io import FORMATS
+from meshscripts.lazy import lazy_import
+from meshscripts.order import to_order
+from meshscripts.profile import profiled, stage
+from meshscripts.sizing import patch_sizes, sized
+from meshscripts.partition import format_statistics
+from meshscripts.topology import PatchDict
+
+
+np = lazy_import('numpy')
+cf = lazy_import('splipy.curve_factory')
+sf = lazy_import('splipy.surface_factory')
+
+
+def element_counts(width, height, radius, inner_radius, nel_ang):
+    """Return the number of elements radially in the cylinder patches, and
+    across the rest of the domain in each direction.  Works on arrays as
+    well as scalars.
+    """
+    # Compute number of elements along each part
+    rest1 = height - radius - inner_radius
+    rest2 = width - radius - inner_radius
+    nel_cyl = np.ceil(4/np.pi * (inner_radius - radius) / radius * nel_ang).astype(int)
+    nel_rest1 = np.ceil(4/np.pi * rest1 / radius * nel_ang).astype(int)
+    nel_rest2 = np.ceil(4/np.pi * rest2 / radius * nel_ang).astype(int)
+    return nel_cyl, nel_rest1, nel_rest2
+
+
+def size_cut_square(width=1.0, height=1.0, radius=0.2, inner_radius=0.4, nel_ang=14, order=4):
+    """Return the Sizes of the mesh, without building it.  All parameters
+    may be arrays.
+    """
+    nel_cyl, nel_rest1, nel_rest2 = element_counts(width, height, radius, inner_radius, nel_ang)
+    return patch_sizes(OrderedDict([
+        ('c1', (nel_ang, nel_cyl)),
+        ('c2', (nel_ang, nel_cyl)),
+        ('r1', (nel_ang, nel_rest1)),
+        ('r2', (nel_ang, nel_rest2)),
+        ('sq', (nel_rest2, nel_rest1)),
+    ]), order)
 
-import splipy.curve_factory as cf
-import splipy.surface_factory as sf
-from splipy.IO import G2
+
+def build_cut_square(width=1.0, height=1.0, radius=0.2, inner_radius=0.4, nel_ang=14, order=4):
+    """Build the mesh and return it as a PatchDict.
+
+    Takes the same parameters as the command line interface, except for
+    those concerned with output.  The patches are built at the given order.
+    """
+    counts = element_counts(width, height, radius, inner_radius, nel_ang)
+    nel_cyl, nel_rest1, nel_rest2 = (int(n) for n in counts)
+
+    with stage('circle'):
+        # Create quarter circles
+        theta = np.linspace(0, np.pi/2, 2*nel_ang+1)[::-1]
+        pts = np.array([radius * np.cos(theta), radius * np.sin(theta)]).T
+        circle = cf.cubic_curve(pts, boundary=cf.Boundary.NATURAL).set_dimension(3)
+        knots = circle.knots('u')
+        inner1, inner2 = circle.split(knots[len(knots) // 2])
+
+    with stage('cylinder'):
+        # Fill the cylinder patches
+        factor = inner_radius / radius
+        outer1, outer2 = inner1 * factor, inner2 * factor
+        cyl1 = to_order(sf.edge_curves(inner1, outer1), order).refine(0, nel_cyl-1)
+        cyl2 = to_order(sf.edge_curves(inner2, outer2), order).refine(0, nel_cyl-1)
+
+    with stage('rectangles'):
+        # Create the "curved rectangles"
+        dist = np.sqrt(2) * radius
+        edge1 = cf.line((0, height), (dist, height)).set_order(4).set_dimension(3).refine(nel_ang-1)
+        rect1 = to_order(sf.edge_curves(outer1, edge1), order).refine(0, nel_rest1-1)
+        edge2 = cf.line((width, dist), (width, 0)).set_order(4).set_dimension(3).refine(nel_ang-1)
+        rect2 = to_order(sf.edge_curves(outer2, edge2), order).refine(0, nel_rest2-1)
+
+        # Final square
+        edge1 = rect2.section(u=0)
+        edge2 = edge1 + (0, height - dist, 0)
+        rect = to_order(sf.edge_curves(edge1, edge2), order).refine(0, nel_rest1-1)
+
+    patches = PatchDict(2)
+    patches.add('c1', 'c2', 'r1', 'r2', 'sq', [cyl1, cyl2, rect1, rect2, rect])
+    patches.connect(
+        ('c1', 2, 'c2', 1),
+        ('c1', 4, 'r1', 3),
+        ('c2', 4, 'r2', 3),
+        ('r1', 2, 'sq', 1),
+        ('r2', 1, 'sq', 3),
+    )
+    patches.boundary('Circle', 'c1', 3)
+    patches.boundary('Circle', 'c2', 3)
+    patches.boundary('Left', 'c1', 1)
+    patches.boundary('Left', 'r1', 1)
+    patches.boundary('Right', 'r2', 4)
+    patches.boundary('Right', 'sq', 2)
+    patches.boundary('Top', 'r1', 4)
+    patches.boundary('Top', 'sq', 4)
+    patches.boundary('Bottom', 'c2', 2)
+    patches.boundary('Bottom', 'r2', 2)
+    return patches
 
 
 @click.command()
@@ -14,75 +116,32 @@ from splipy.IO import G2
 @click.option('--inner-radius', default=0.4)
 @click.option('--nel-ang', default=14)
 @click.option('--order', default=4)
+@click.option('--native-order/--no-native-order', default=False,
+              help='Build the patches at --order instead of lowering cubic patches')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='g2')
+@compression_options
+@click.option('--validate/--no-validate', default=True)
+@click.option('--pretty/--no-pretty', default=True, help='Indent the topology file')
+@click.option('--procs', default=1, help='Number of processes to partition the patches for')
+@click.option('--levels', type=click.IntRange(min=1), default=1,
+              help='Number of nested levels to write, each refined uniformly from the previous')
+@click.option('--prolongation/--no-prolongation', default=False,
+              help='Write the prolongations between levels')
 @click.option('--out', default='out')
-def cut_square(width, height, radius, inner_radius, nel_ang, order, out):
+@profiled
+@sized(size_cut_square)
+@cached('cut_square')
+def cut_square(width, height, radius, inner_radius, nel_ang, order, native_order, fmt, compression,
+               compression_level, validate, pretty, procs, levels, prolongation, out):
+    """Generate a square with a quarter circle cut out of the corner."""
+    patches = build_cut_square(width, height, radius, inner_radius, nel_ang,
+                               order=order if native_order else 4)
+
+    if procs > 1:
+        print(format_statistics(patches.partition(procs, order=order)))
+    write_hierarchy(patches, out, levels, prolongation, order=order, fmt=fmt, validate=validate,
+                    pretty=pretty, compression=compression, compression_level=compression_level)
 
-    # Compute number of elements along each part
-    rest1 = height - radius - inner_radius
-    rest2 = width - radius - inner_radius
-    nel_cyl = int(np.ceil(4/np.pi * (inner_radius - radius) / radius * nel_ang))
-    nel_rest1 = int(np.ceil(4/np.pi * rest1 / radius * nel_ang))
-    nel_rest2 = int(np.ceil(4/np.pi * rest2 / radius * nel_ang))
-
-    # Create quarter circles
-    theta = np.linspace(0, np.pi/2, 2*nel_ang+1)[::-1]
-    pts = np.array([radius * np.cos(theta), radius * np.sin(theta)]).T
-    circle = cf.cubic_curve(pts, boundary=cf.Boundary.NATURAL).set_dimension(3)
-    knots = circle.knots('u')
-    inner1, inner2 = circle.split(knots[len(knots) // 2])
-
-    # Fill the cylinder patches
-    factor = inner_radius / radius
-    outer1, outer2 = inner1 * factor, inner2 * factor
-    cyl1 = sf.edge_curves(inner1, outer1).set_order(4,4).refine(0, nel_cyl-1)
-    cyl2 = sf.edge_curves(inner2, outer2).set_order(4,4).refine(0, nel_cyl-1)
-
-    # Create the "curved rectangles"
-    dist = np.sqrt(2) * radius
-    edge1 = cf.line((0, height), (dist, height)).set_order(4).set_dimension(3).refine(nel_ang-1)
-    rect1 = sf.edge_curves(outer1, edge1).set_order(4,4).refine(0, nel_rest1-1)
-    edge2 = cf.line((width, dist), (width, 0)).set_order(4).set_dimension(3).refine(nel_ang-1)
-    rect2 = sf.edge_curves(outer2, edge2).set_order(4,4).refine(0, nel_rest2-1)
-
-    # Final square
-    edge1 = rect2.section(u=0)
-    edge2 = edge1 + (0, height - dist, 0)
-    rect = sf.edge_curves(edge1, edge2).set_order(4,4).refine(0, nel_rest1-1)
-
-    diff = 4 - order
-    patches = [patch.lower_order(diff, diff) for patch in [cyl1, cyl2, rect1, rect2, rect]]
-
-    with G2(out + '.g2') as f:
-        f.write(patches)
-
-    root = etree.Element('geometry')
-    etree.SubElement(root, 'patchfile').text = out + '.g2'
-    topology = etree.SubElement(root, 'topology')
-    for mid, sid, midx, sidx, rev in [(1,2,2,1,False), (1,3,4,3,False), (2,4,4,3,False),
-                                      (3,5,2,1,False), (4,5,1,3,False)]:
-        etree.SubElement(topology, 'connection').attrib.update({
-            'master': str(mid), 'slave': str(sid),
-            'midx': str(midx), 'sidx': str(sidx),
-            'reverse': 'true' if rev else 'false',
-        })
-
-    topsets = etree.SubElement(root, 'topologysets')
-    for name, entries in [('Circle', [(1, (3,)), (2, (3,))]),
-                          ('Left',   [(1, (1,)), (3, (1,))]),
-                          ('Right',  [(4, (4,)), (5, (2,))]),
-                          ('Top',    [(3, (4,)), (5, (4,))]),
-                          ('Bottom', [(2, (2,)), (4, (2,))])]:
-        topset = etree.SubElement(topsets, 'set')
-        topset.attrib.update({'name': name, 'type': 'edge'})
-        for pid, indices in entries:
-            item = etree.SubElement(topset, 'item')
-            item.attrib['patch'] = str(pid)
-            item.text = ' '.join(str(i) for i in indices)
-
-    with open(out + '.xinp', 'wb') as f:
-        f.write(etree.tostring(
-            root, pretty_print=True, encoding='utf-8', xml_declaration=True, standalone=False
-        ))
 
 if __name__ == '__main__':
     cut_square()
@@ -0,0 +1,127 @@
+import click
+from collections import OrderedDict
+import os
+import sys
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cut_square import build_cut_square, size_cut_square
+from meshscripts.cache import cached
+from meshscripts.compression import compression_options
+from meshscripts.hierarchy import write_hierarchy
+from meshscripts.io import FORMATS
+from meshscripts.profile import profiled, stage
+from meshscripts.sizing import patch_sizes, sized
+from meshscripts.partition import format_statistics
+from meshscripts.tiling import instance_name, tile
+from meshscripts.topology import PatchDict
+
+
+# The quarters of a cell, counterclockwise from the one built by
+# cut_square, as whether they are mirrored in x and in y
+QUARTERS = [(False, False), (True, False), (True, True), (False, True)]
+
+SIDES = {'Left': (0, 0), 'Right': (0, 1), 'Bottom': (1, 0), 'Top': (1, 1)}
+
+
+def quarter_name(name, quarter):
+    return '{}-q{}'.format(name, quarter)
+
+
+def size_plate(width=1.0, height=1.0, radius=0.2, inner_radius=0.4, nel_ang=14, nx=4, ny=4, order=4):
+    """Return the Sizes of the mesh, without building it.  All parameters
+    except nx and ny may be arrays.
+    """
+    quarter = size_cut_square(width, height, radius, inner_radius, nel_ang, order).patches
+    return patch_sizes(OrderedDict(
+        (instance_name(quarter_name(name, q), i, j), nels)
+        for j in range(1, ny + 1) for i in range(1, nx + 1)
+        for q in range(len(QUARTERS)) for name, nels in quarter.items()
+    ), order)
+
+
+def mirrored(patch, mx, my):
+    """Return a copy of a patch mirrored in x and/or y, reparametrized so
+    that it keeps its orientation.
+    """
+    patch = patch.clone()
+    if mx:
+        patch.controlpoints[..., 0] *= -1
+    if my:
+        patch.controlpoints[..., 1] *= -1
+    if mx != my:
+        patch.reverse('u')
+    return patch
+
+
+def build_cell(quarter, width, height):
+    """Return a full cell, of 2*width by 2*height with the hole in the
+    middle and the lower left corner at the origin, mirrored from the
+    patches of cut_square.  The cell has boundary sets for the hole
+    ('Circle') and its sides, but no connections.
+    """
+    cell = PatchDict(quarter.dim)
+    for q, (mx, my) in enumerate(QUARTERS):
+        for name, patch in quarter.items():
+            cell[quarter_name(name, q)] = mirrored(patch, mx, my) + (width, height, 0)
+
+        for set_name, kinds in quarter.boundaries.items():
+            # The quarters meet at the symmetry lines
+            if set_name in ('Left', 'Bottom'):
+                continue
+            if set_name == 'Right' and mx:
+                set_name = 'Left'
+            if set_name == 'Top' and my:
+                set_name = 'Bottom'
+            for kind, items in kinds.items():
+                for name, number in items:
+                    if mx != my and number in (1, 2):
+                        number = 3 - number
+                    cell.boundaries.setdefault(set_name, {}).setdefault(kind, []).append(
+                        (quarter_name(name, q), number)
+                    )
+    return cell
+
+
+@click.command()
+@click.option('--width', default=1.0, help='Half the width of a cell')
+@click.option('--height', default=1.0, help='Half the height of a cell')
+@click.option('--radius', default=0.2)
+@click.option('--inner-radius', default=0.4)
+@click.option('--nel-ang', default=14)
+@click.option('--nx', type=click.IntRange(min=1), default=4, help='Number of holes in x')
+@click.option('--ny', type=click.IntRange(min=1), default=4, help='Number of holes in y')
+@click.option('--order', default=4)
+@click.option('--native-order/--no-native-order', default=False,
+              help='Build the patches at --order instead of lowering cubic patches')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='g2')
+@compression_options
+@click.option('--validate/--no-validate', default=True)
+@click.option('--pretty/--no-pretty', default=True, help='Indent the topology file')
+@click.option('--procs', default=1, help='Number of processes to partition the patches for')
+@click.option('--levels', type=click.IntRange(min=1), default=1,
+              help='Number of nested levels to write, each refined uniformly from the previous')
+@click.option('--prolongation/--no-prolongation', default=False,
+              help='Write the prolongations between levels')
+@click.option('--out', default='out')
+@profiled
+@sized(size_plate)
+@cached('plate')
+def plate(width, height, radius, inner_radius, nel_ang, nx, ny, order, native_order, fmt, compression,
+          compression_level, validate, pretty, procs, levels, prolongation, out):
+    """Generate a plate with a grid of holes, tiled from the cut_square mesh."""
+    quarter = build_cut_square(width, height, radius, inner_radius, nel_ang,
+                               order=order if native_order else 4)
+    with stage('cell'):
+        cell = build_cell(quarter, width, height)
+    with stage('tile'):
+        patches = tile(cell, (nx, ny), (2 * width, 2 * height), sides=SIDES, instanced=['Circle'])
+
+    if procs > 1:
+        print(format_statistics(patches.partition(procs, order=order)))
+    write_hierarchy(patches, out, levels, prolongation, order=order, fmt=fmt, validate=validate,
+                    pretty=pretty, compression=compression, compression_level=compression_level)
+
+
+if __name__ == '__main__':
+    plate()
@@ -0,0 +1,76 @@
+import click
+import numpy as np
+from math import pi
+from time import perf_counter
+import os
+import sys
+import tracemalloc
+
+from splipy import curve_factory as cf, surface_factory as sf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cylinder import loft_revolved, graded_space
+
+
+def measure(func, *args):
+    # Tracing allocations slows down Python code considerably, so time a
+    # separate run
+    start = perf_counter()
+    result = func(*args)
+    elapsed = perf_counter() - start
+
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def loft_cloned(curve, angles):
+    return sf.loft([curve.clone().rotate(v) for v in angles])
+
+
+@click.command()
+@click.option('--nel-circ', type=int, multiple=True, default=[40, 80, 160, 320, 640])
+@click.option('--nel-side', default=30)
+@click.option('--grad', default=1.1)
+@click.option('--max-loft', default=160, help='Largest nel-circ to run the old loft for')
+def bench(nel_circ, nel_side, grad, max_loft):
+    """Compare lofting cloned curves against loft_revolved for the inner
+    O-grid of the cylinder generator.
+    """
+    # The inner half of the radial, as in build_cylinder with default options
+    radial = cf.cubic_curve(
+        np.array(graded_space(0.5, 0.01, grad, nel_side))[:, np.newaxis],
+        boundary=cf.Boundary.NATURAL,
+    )
+    radial.set_dimension(3)
+    kts = radial.knots('u')
+    radial, _ = radial.split(kts[len(kts) // 2], 'u')
+    radial.rotate(pi/4)
+
+    print('{:>8} {:>12} {:>12} {:>14} {:>14} {:>10}'.format(
+        'nel-circ', 'loft [s]', 'loft [MiB]', 'revolve [s]', 'revolve [MiB]', 'max diff'
+    ))
+    for n in nel_circ:
+        angles = np.linspace(0, 2*pi, 4*n + 1)
+        new, new_time, new_peak = measure(loft_revolved, radial, angles)
+        if n <= max_loft:
+            old, old_time, old_peak = measure(loft_cloned, radial, angles)
+            diff = max(
+                [np.abs(old.controlpoints - new.controlpoints).max()]
+                + [np.abs(old.knots(d, with_multiplicities=True)
+                          - new.knots(d, with_multiplicities=True)).max() for d in range(2)]
+            )
+            old_time, old_peak = '{:12.4f}'.format(old_time), '{:12.2f}'.format(old_peak / 2**20)
+            diff = '{:10.2e}'.format(diff)
+        else:
+            old_time = old_peak = '{:>12}'.format('-')
+            diff = '{:>10}'.format('-')
+        print('{:8d} {} {} {:14.4f} {:14.2f} {}'.format(
+            n, old_time, old_peak, new_time, new_peak / 2**20, diff
+        ))
+
+
+if __name__ == '__main__':
+    bench()
@@ -1,189 +1,191 @@
 import click
 from collections import OrderedDict
-from math import ceil, log, sqrt, pi
-import numpy as np
-from lxml import etree as xml
+from math import ceil, sqrt, pi
+import os
 import sys
 
-from splipy import curve_factory as cf, surface_factory as sf
-from splipy.io import G2
-from splipy.utils.refinement import geometric_refine
-from splipy.volume_factory import extrude
-
-
-def graded_space(start, step, factor, N):
-    def gen_graded_space(start, step, factor, N):
-        for _ in range(N):
-            yield start
-            start += step
-            step *= factor
-    return list(gen_graded_space(float(start), float(step), float(factor), N))
-
-
-def find_factor(initial, total, N, tol=1e-7):
-    # Solve initial * (1 - a^N) / (1 - a) = total
-    overshoot = lambda a: initial * (1 - (1 + a)**N) / (1 - (1 + a)) - total
-    l, u = 0.5, 0.5
-    while overshoot(l) > 0:
-        l /= 2
-    while overshoot(u) < 0:
-        u *= 2
-    while True:
-        m = (u + l) / 2
-        s = overshoot(m)
-        if abs(s) < tol:
-            break
-        if s > 0:
-            u = m
-        else:
-            l = m
-    return 1 + m
-
-
-class PatchDict(OrderedDict):
-
-    def __init__(self, dim, *args, **kwargs):
-        super(PatchDict, self).__init__(*args, **kwargs)
-        self.dim = dim
-        self.masters = {}
-        self.boundaries = {}
-        self.periodics = []
-
-    def add(self, *args):
-        names, patches = args[:-1], args[-1]
-        for name, patch in zip(names, patches):
-            self[name] = patch
-
-    def connect(self, *args):
-        for master, medge, slave, sedge, *rest in args:
-            rev = 'rev' in rest
-            per = 'per' in rest
-
-            if master == slave and per:
-                self.periodics.append((master, max(medge, sedge) // 2))
-            elif master != slave:
-                self.masters[(master, medge)] = (slave, sedge, rev, per)
-            else:
-                raise Exception('What?')
-
-    def boundary(self, name, patch, number, dim=-1, add=0):
-        kind = {
-            2: ['vertex', 'edge'],
-            3: ['vertex', 'edge', 'face'],
-        }[self.dim][dim]
-        number += add
-        self.boundaries.setdefault(name, {}).setdefault(kind, []).append((patch, number))
-
-    def write(self, fn, order=4):
-        pids, patches = {}, []
-        for i, (name, patch) in enumerate(self.items()):
-            pids[name] = i
-            diff = [o - order for o in patch.order()]
-            patches.append(patch.lower_order(*diff))
-
-        for patch in patches:
-            du = patch.derivative(patch.start('u'), patch.start('v'), d=(1,0))
-            dv = patch.derivative(patch.start('u'), patch.start('v'), d=(0,1))
-            assert np.cross(du, dv)[2] > 0.0
-
-        with G2(fn + '.g2') as f:
-            f.write(patches)
-
-        dom = xml.Element('geometry')
-        dom.attrib['dim'] = str(patches[0].pardim)
-        xml.SubElement(dom, 'patchfile').text = fn + '.g2'
-
-        topology = xml.SubElement(dom, 'topology')
-        for (master, medge), (slave, sedge, rev, periodic) in self.masters.items():
-            mid = pids[master] + 1
-            sid = pids[slave] + 1
-            if mid > sid:
-                mid, sid = sid, mid
-                medge, sedge = sedge, medge
-            xml.SubElement(topology, 'connection').attrib.update({
-                'master': str(mid),
-                'midx': str(medge),
-                'slave': str(sid),
-                'sidx': str(sedge),
-                'reverse': 'true' if rev else 'false',
-                'periodic': 'true' if periodic else 'false',
-            })
-        for patch, direction in self.periodics:
-            pid = pids[patch] + 1
-            xml.SubElement(topology, 'periodic').attrib.update({
-                'patch': str(pid),
-                'dir': str(direction),
-            })
-
-        topsets = xml.SubElement(dom, 'topologysets')
-        for name, kinds in self.boundaries.items():
-            for kind, items in kinds.items():
-                topset = xml.SubElement(topsets, 'set')
-                topset.attrib.update({'name': name, 'type': kind})
-                for patch, number in items:
-                    item = xml.SubElement(topset, 'item')
-                    item.attrib['patch'] = str(pids[patch] + 1)
-                    item.text = str(number)
-
-        xml.ElementTree(dom).write(fn + '.xinp', encoding='utf-8', xml_declaration=True, pretty_print=True, standalone=False)
-
-
-@click.command()
-@click.option('--diam', default=1.0)
-@click.option('--width', default=20.0)
-@click.option('--front', default=20.0)
-@click.option('--back', default=40.0)
-@click.option('--side', default=20.0)
-@click.option('--height', default=0.0)
-@click.option('--Re', default=100.0)
-@click.option('--grad', type=float, required=False)
-@click.option('--nel-bndl', default=10)
-@click.option('--inner-elsize', type=float, required=False)
-@click.option('--nel-side', type=int, required=False)
-@click.option('--nel-circ', default=40)
-@click.option('--nel-height', default=10)
-@click.option('--order', default=4)
-@click.option('--outer-graded/--no-outer-graded', default=True)
-@click.option('--out', default='out')
-def cylinder(diam, width, front, back, side, height, re, grad, inner_elsize,
-             nel_side, nel_bndl, nel_circ, nel_height, order, out, outer_graded):
-    assert all(f >= width for f in [front, back, side])
-
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from meshscripts.compression import compression_options
+from meshscripts.grading import graded_space, find_factor, first_size, num_elements
+from meshscripts.cache import Cache, cached
+from meshscripts.hierarchy import write_hierarchy
+from meshscripts.io import FORMATS
+from meshscripts.lazy import lazy_import
+from meshscripts.order import to_order
+from meshscripts.profile import profiled
+from meshscripts.sizing import patch_sizes, sized
+from meshscripts.partition import format_statistics
+from meshscripts.stages import Stages
+from meshscripts.storage import Spill
+from meshscripts.topology import PatchDict
+
+
+np = lazy_import('numpy')
+spla = lazy_import('scipy.sparse.linalg')
+splipy = lazy_import('splipy')
+cf = lazy_import('splipy.curve_factory')
+sf = lazy_import('splipy.surface_factory')
+vf = lazy_import('splipy.volume_factory')
+refinement = lazy_import('splipy.utils.refinement')
+
+
+# The connections of the O-grid around the cylinder, between the patches
+# of inner_patches and of outer_patches, in that order
+INNER_CONNECTIONS = [
+    ('ir', 4, 'iu', 3),
+    ('iu', 4, 'il', 3),
+    ('il', 4, 'id', 3),
+    ('id', 4, 'ir', 3),
+]
+OUTER_CONNECTIONS = [
+    ('or', 4, 'ou', 3),
+    ('ou', 4, 'ol', 3),
+    ('ol', 4, 'od', 3),
+    ('od', 4, 'or', 3),
+    ('or', 1, 'ir', 2),
+    ('ou', 1, 'iu', 2),
+    ('ol', 1, 'il', 2),
+    ('od', 1, 'id', 2),
+]
+
+def loft_revolved(curve, angles):
+    """Loft copies of a curve rotated about the z-axis by the given angles.
+
+    Equivalent to sf.loft([curve.clone().rotate(a) for a in angles]), but
+    without creating the rotated curves.  Since the rotation commutes with
+    interpolation in the u-direction, the control points in that direction
+    are those of the curve itself, and only the banded interpolation problem
+    in the v-direction remains.
+    """
+    curve = curve.clone().set_dimension(3)
+    cps = curve.controlpoints
+    cos, sin = np.cos(angles), np.sin(angles)
+
+    pts = np.empty((len(angles),) + cps.shape)
+    pts[..., 0] = np.outer(cos, cps[:,0]) - np.outer(sin, cps[:,1])
+    pts[..., 1] = np.outer(sin, cps[:,0]) + np.outer(cos, cps[:,1])
+    pts[..., 2:] = cps[:,2:]
+
+    # Parametrize by distance between the curve centers, like sf.loft does
+    x, y, z = curve.center()
+    centers = np.array([cos * x - sin * y, sin * x + cos * y, np.full_like(cos, z)]).T
+    dist = np.add.accumulate(np.r_[0.0, np.linalg.norm(np.diff(centers, axis=0), axis=1)])
+    basis = splipy.BSplineBasis(4, np.r_[[dist[0]] * 4, dist[2:-2], [dist[-1]] * 4])
+
+    N = basis.evaluate(dist, sparse=True).tocsc()
+    cps = spla.spsolve(N, pts.reshape(len(angles), -1)).reshape(-1, cps.shape[-1])
+
+    # sf.loft reparametrizes the curves to [0, 1]
+    ubasis = curve.bases[0].clone()
+    ubasis.normalize()
+    return splipy.Surface(ubasis, basis, cps, curve.rational)
+
+
+def extrude_patch(patch, height, nel_height, order):
+    """Extrude a surface in the z-direction and refine it to nel_height
+    elements of the given order in that direction.
+    """
+    patch = vf.extrude(patch, (0, 0, height))
+    patch.raise_order(0, 0, order - 2)
+    patch.refine(nel_height-1, direction='w')
+    return patch
+
+
+def radial_grading(diam, width, re, grad, nel_bndl, inner_elsize, nel_side):
+    """Return the first element size, grading factor and number of elements
+    from the cylinder to the edge of the inner domain, at distance width
+    from the center.  Works on arrays as well as scalars.
+    """
     rad_cyl = diam / 2
-    width *= rad_cyl
-    back = back * rad_cyl - width
-    front = front * rad_cyl - width
-    side = side * rad_cyl - width
-    elsize = width * 2 / nel_circ
-
-    dim = 2 if height == 0.0 else 3
-    vx_add = 8 if dim == 3 else 0
-    patches = PatchDict(dim)
-
-    if inner_elsize and nel_side:
+    if inner_elsize is not None and nel_side is not None:
         # Calculate grading factor based on first element size,
         # total length and number of elements
         dr = rad_cyl * inner_elsize
         grad = find_factor(dr, width - rad_cyl, nel_side)
 
-    elif nel_bndl and grad:
+    elif nel_bndl is not None and grad is not None:
         # Calculate first element size based on total length
         # and number of elements
 
         # We want nel_bndl elements inside the boundary layer
         # Calculate how small the inner element must be
-        size_bndl = 1 / sqrt(re) * diam
-        dr = (1 - grad) / (1 - grad ** nel_bndl) * size_bndl
+        size_bndl = 1 / np.sqrt(re) * diam
+        dr = first_size(size_bndl, grad, nel_bndl)
 
         # Potentially reduce element size so we get a whole number of elements
         # on either side of the cylinder
-        nel_side = int(ceil(log(1 - 1/dr * (1 - grad) * (width - rad_cyl)) / log(grad)))
-        dr = (1 - grad) / (1 - grad ** nel_side) * (width - rad_cyl)
+        nel_side = num_elements(dr, width - rad_cyl, grad)
+        dr = first_size(width - rad_cyl, grad, nel_side)
 
     else:
-        print('Specify (inner-elsize and nel-side) or (nel-bndl and grad)', file=sys.stderr)
-        sys.exit(1)
+        raise ValueError('Specify (inner-elsize and nel-side) or (nel-bndl and grad)')
+
+    return dr, grad, nel_side
+
 
+def outer_size(rad_cyl, width, dr, grad, nel_side):
+    """Return the size of the last radial element times the grading
+    factor, as radial_curves does, but without building the radial.  Works
+    on arrays as well as scalars.
+    """
+    near = np.abs(grad - 1) < 1e-8
+    series = np.where(near, nel_side - 1, (grad ** (nel_side - 1) - 1) / np.where(near, 2.0, grad - 1))
+    return (width - rad_cyl - dr * series) * grad
+
+
+def size_cylinder(diam=1.0, width=20.0, front=20.0, back=40.0, side=20.0, height=0.0,
+                  re=100.0, grad=None, nel_bndl=10, inner_elsize=None, nel_side=None,
+                  nel_circ=40, nel_height=10, outer_graded=True, order=4):
+    """Return the Sizes of the mesh built by build_cylinder, without
+    building it.  All parameters may be arrays.
+    """
+    rad_cyl = diam / 2
+    width = width * rad_cyl
+    back = back * rad_cyl - width
+    front = front * rad_cyl - width
+    side = side * rad_cyl - width
+    dr, grad, nel_side = radial_grading(diam, width, re, grad, nel_bndl, inner_elsize, nel_side)
+
+    # The radial is split at its middle knot
+    nel_inner = (nel_side + 1) // 2
+    nel_outer = nel_side - nel_inner
+
+    dl = outer_size(rad_cyl, width, dr, grad, nel_side)
+
+    def graded(length):
+        nel = num_elements(dl, np.where(length > 0, length, 1.0), grad)
+        return np.where(length > 0, nel, 0)
+
+    nel_front, nel_side_outer = graded(front), graded(side)
+    nel_back = np.where(outer_graded, graded(back), np.where(back > 0, np.ceil(back / dl), 0))
+    nel_back = nel_back.astype(int)
+
+    patches = OrderedDict()
+    for name in ['iu', 'il', 'id', 'ir']:
+        patches[name] = (nel_inner, nel_circ)
+    for name in ['ou', 'ol', 'od', 'or']:
+        patches[name] = (nel_outer, nel_circ)
+    patches['fr'] = (nel_front, nel_circ)
+    patches['ba'] = (nel_back, nel_circ)
+    for prefix in ['up', 'dn']:
+        patches[prefix] = (nel_circ, nel_side_outer)
+        patches[prefix + 'fr'] = (nel_front, nel_side_outer)
+        patches[prefix + 'ba'] = (nel_back, nel_side_outer)
+
+    if np.any(np.asarray(height) > 0.0):
+        if not np.all(np.asarray(height) > 0.0):
+            raise ValueError('Can not size 2D and 3D meshes together')
+        patches = OrderedDict((name, nels + (nel_height,)) for name, nels in patches.items())
+
+    return patch_sizes(patches, order, **{'first element': dr, 'grading factor': grad})
+
+
+def radial_curves(rad_cyl, width, dr, grad, nel_side, order):
+    """Return the inner and outer halves of the radial from the cylinder to
+    the edge of the inner domain, of the given order, and the size of the
+    next element outside of it.
+    """
     # Graded radial space from cylinder to edge of domain
     radial_kts = graded_space(rad_cyl, dr, grad, nel_side) + [width]
 
@@ -195,56 +197,144 @@ def cylinder(diam, width, front, back, side, height, re, grad, inner_elsize,
     radial_inner, radial_outer = radial.split(middle, 'u')
     radial_inner.rotate(pi/4)
     dl = np.linalg.norm(radial_outer(radial_outer.knots('u')[-2]) - radial_outer.section(u=-1)) * grad
+    return to_order(radial_inner, order), to_order(radial_outer, order), dl
 
-    # Revolve the inner radial and divide it
-    radials = [radial_inner.clone().rotate(v) for v in np.linspace(0, 2*pi, 4*nel_circ + 1)]
-    inner = sf.loft(radials)
+
+def inner_patches(radial_inner, nel_circ):
+    """Revolve the inner radial and divide it in four patches, of the order
+    of the radial.
+    """
+    inner = loft_revolved(radial_inner, np.linspace(0, 2*pi, 4*nel_circ + 1))
     ikts = inner.knots('v')
     inner.insert_knot((ikts[0] + ikts[1]) / 2, 'v')
     inner.insert_knot((ikts[-1] + ikts[-2]) / 2, 'v')
 
     ikts = inner.knots('v')
-    patches.add('iu', 'il', 'id', 'ir', inner.split([ikts[k*nel_circ] for k in range(5)][1:-1], 'v'))
-    patches.connect(
-        ('ir', 4, 'iu', 3),
-        ('iu', 4, 'il', 3),
-        ('il', 4, 'id', 3),
-        ('id', 4, 'ir', 3),
-    )
-    patches.boundary('cylinder', 'ir', 1)
-    patches.boundary('cylinder', 'iu', 1)
-    patches.boundary('cylinder', 'il', 1)
-    patches.boundary('cylinder', 'id', 1)
+    parts = inner.split([ikts[k*nel_circ] for k in range(5)][1:-1], 'v')
 
-    # Create an outer section
+    # The revolution is cubic, lower each part like PatchDict.write would
+    return [to_order(part, radial_inner.order(0)) for part in parts]
+
+
+def outer_patches(radial_outer, inner, width, nel_circ, order):
+    """Return the four patches between the four inner patches and the edge
+    of the inner domain.
+    """
     rc = radial_outer.section(u=0)
     alpha = (sqrt(2) * width - rc[0]) / (width - rc[0])
     right = ((radial_outer - rc) * alpha + rc).rotate(pi/4)
     left = right.clone().rotate(pi/2).reverse()
-    outer = cf.line((-width, width, 0), (width, width, 0))
-    outer.set_order(4).refine(nel_circ - 1)
-    inner = patches['iu'].section(u=-1)
-    outer = sf.edge_curves(right, outer, left, inner)
-
-    patches.add('ou', 'ol', 'od', 'or', [outer.clone().rotate(v) for v in [0, pi/2, pi, 3*pi/2]])
-    patches.connect(
-        ('or', 4, 'ou', 3),
-        ('ou', 4, 'ol', 3),
-        ('ol', 4, 'od', 3),
-        ('od', 4, 'or', 3),
-        ('or', 1, 'ir', 2),
-        ('ou', 1, 'iu', 2),
-        ('ol', 1, 'il', 2),
-        ('od', 1, 'id', 2),
-    )
+    outer = to_order(cf.line((-width, width, 0), (width, width, 0)), order)
+    outer.refine(nel_circ - 1)
+
+    # The lofted inner patches are not exact rotations of each other, so
+    # each outer patch is built on the edge of its own inner patch
+    return [
+        sf.edge_curves(*(c.clone().rotate(v) for c in (right, outer, left)), patch.section(u=-1))
+        for v, patch in zip([0, pi/2, pi, 3*pi/2], inner)
+    ]
+
+
+def front_patch(ol, dl, front, grad, order):
+    la = ol.section(u=-1).reverse()
+    lb = la.clone() - (front, 0, 0)
+    front_srf = to_order(sf.edge_curves(lb, la), order).swap()
+    nel = num_elements(dl, front, grad)
+    refinement.geometric_refine(front_srf, grad, nel - 1, reverse=True)
+    return front_srf
+
+
+def back_patch(or_, dl, back, grad, outer_graded, order):
+    la = or_.section(u=-1).reverse()
+    lb = la.clone() + (back, 0, 0)
+    back_srf = to_order(sf.edge_curves(la, lb), order).swap().reverse('v')
+    if outer_graded:
+        nel = num_elements(dl, back, grad)
+        refinement.geometric_refine(back_srf, grad, nel - 1)
+    else:
+        nel = int(ceil(back / dl))
+        back_srf.refine(nel - 1, direction='u')
+    return back_srf
+
+
+def side_patches(ou, front_srf, back_srf, dl, width, front, back, side, grad, order):
+    """Return the patches above and below the inner domain, and above and
+    below the front and back patches, if any.
+    """
+    la = ou.section(u=-1)
+    lb = la + (0, side, 0)
+    patches = OrderedDict(up=to_order(sf.edge_curves(la, lb), order).reverse('u'))
+
+    if front_srf is not None:
+        btm = front_srf.section(v=-1)
+        right = patches['up'].section(u=0)
+        top = (btm + (0, side, 0)).reverse()
+        left = (right - (front, 0, 0)).reverse()
+        patches['upfr'] = sf.edge_curves(btm, right, top, left)
+
+    if back_srf is not None:
+        btm = back_srf.section(v=-1)
+        left = patches['up'].section(u=-1).reverse()
+        top = (btm + (0, side, 0)).reverse()
+        right = (left + (back, 0, 0)).reverse()
+        patches['upba'] = sf.edge_curves(btm, right, top, left)
+
+    nel = num_elements(dl, side, grad)
+    for uk in list(patches):
+        patches['dn' + uk[2:]] = patches[uk] - (0, side + 2 * width, 0)
+    for pname, patch in patches.items():
+        refinement.geometric_refine(patch, grad, nel - 1, direction='v', reverse=pname.startswith('dn'))
+    return patches
+
+
+def build_cylinder(diam=1.0, width=20.0, front=20.0, back=40.0, side=20.0, height=0.0,
+                   re=100.0, grad=None, nel_bndl=10, inner_elsize=None, nel_side=None,
+                   nel_circ=40, nel_height=10, outer_graded=True, order=4, jobs=1, stages=None,
+                   spill=None):
+    """Build the cylinder mesh and return it as a PatchDict.
+
+    Takes the same parameters as the command line interface, except for
+    those concerned with output.  The patches are built at the given order.
+    If jobs > 1, 3D patches are extruded in that many processes.  The
+    patches are built in stages, memoized by `stages` (a
+    meshscripts.stages.Stages) if given.  If `spill` is given, finished
+    patches are moved to memory-mapped files in a temporary directory in
+    that directory.
+    """
+    assert all(f >= width for f in [front, back, side])
+
+    rad_cyl = diam / 2
+    width *= rad_cyl
+    back = back * rad_cyl - width
+    front = front * rad_cyl - width
+    side = side * rad_cyl - width
+
+    dim = 2 if height == 0.0 else 3
+    vx_add = 8 if dim == 3 else 0
+    patches = PatchDict(dim, spill=None if spill is None else Spill(spill))
+    stages = stages or Stages()
+    surfaces = OrderedDict()
+
+    dr, grad, nel_side = radial_grading(diam, width, re, grad, nel_bndl, inner_elsize, nel_side)
+    radial = stages.run('radial', radial_curves, rad_cyl, width, dr, grad, nel_side, order)
+    dl = radial[2]
+
+    inner = stages.run('inner', inner_patches, radial[0], nel_circ)
+    for k, pname in enumerate(['iu', 'il', 'id', 'ir']):
+        surfaces[pname] = inner[k]
+    patches.connect(*INNER_CONNECTIONS)
+    patches.boundary('cylinder', 'ir', 1)
+    patches.boundary('cylinder', 'iu', 1)
+    patches.boundary('cylinder', 'il', 1)
+    patches.boundary('cylinder', 'id', 1)
+
+    outer = stages.run('outer', outer_patches, radial[1], inner, width, nel_circ, order)
+    for k, pname in enumerate(['ou', 'ol', 'od', 'or']):
+        surfaces[pname] = outer[k]
+    patches.connect(*OUTER_CONNECTIONS)
 
     if front > 0:
-        la = patches['ol'].section(u=-1).reverse()
-        lb = la.clone() - (front, 0, 0)
-        front_srf = sf.edge_curves(lb, la).set_order(4,4).swap()
-        nel = int(ceil(log(1 - 1/dl * (1 - grad) * front) / log(grad)))
-        geometric_refine(front_srf, grad, nel - 1, reverse=True)
-        patches['fr'] = front_srf
+        surfaces['fr'] = stages.run('front', front_patch, surfaces['ol'], dl, front, grad, order)
         patches.connect(('fr', 2, 'ol', 2, 'rev'))
         patches.boundary('inflow', 'fr', 1)
     else:
@@ -253,35 +343,23 @@ def cylinder(diam, width, front, back, side, height, re, grad, inner_elsize,
         patches.boundary('inflow', 'od', 2, dim=-2, add=vx_add)
 
     if back > 0:
-        la = patches['or'].section(u=-1).reverse()
-        lb = la.clone() + (back, 0, 0)
-        back_srf = sf.edge_curves(la, lb).set_order(4,4).swap().reverse('v')
-        if outer_graded:
-            nel = int(ceil(log(1 - 1/dl * (1 - grad) * back) / log(grad)))
-            geometric_refine(back_srf, grad, nel - 1)
-        else:
-            nel = int(ceil(back / dl))
-            back_srf.refine(nel - 1, direction='u')
-        patches['ba'] = back_srf
+        surfaces['ba'] = stages.run('back', back_patch, surfaces['or'], dl, back, grad, outer_graded,
+                                    order)
         patches.connect(('ba', 1, 'or', 2))
         patches.boundary('outflow', 'ba', 2)
     else:
         patches.boundary('outflow', 'or', 2)
 
     if side > 0:
-        la = patches['ou'].section(u=-1)
-        lb = la + (0, side, 0)
-        patches['up'] = sf.edge_curves(la, lb).set_order(4,4).reverse('u')
+        sides = stages.run(
+            'side', side_patches, surfaces['ou'], surfaces.get('fr'), surfaces.get('ba'),
+            dl, width, front, back, side, grad, order,
+        )
         patches.connect(('up', 3, 'ou', 2, 'rev'), ('dn', 4, 'od', 2))
         patches.boundary('top', 'up', 4)
         patches.boundary('bottom', 'dn', 3)
 
-        if 'fr' in patches:
-            btm = front_srf.section(v=-1)
-            right = patches['up'].section(u=0)
-            top = (btm + (0, side, 0)).reverse()
-            left = (right - (front, 0, 0)).reverse()
-            patches['upfr'] = sf.edge_curves(btm, right, top, left)
+        if 'fr' in surfaces:
             patches.connect(
                 ('upfr', 3, 'fr', 4), ('upfr', 2, 'up', 1),
                 ('dnfr', 4, 'fr', 3), ('dnfr', 2, 'dn', 1),
@@ -294,30 +372,22 @@ def cylinder(diam, width, front, back, side, height, re, grad, inner_elsize,
             patches.boundary('inflow', 'up', 1)
             patches.boundary('inflow', 'dn', 1)
 
-        if 'ba' in patches:
-            btm = back_srf.section(v=-1)
-            left = patches['up'].section(u=-1).reverse()
-            top = (btm + (0, side, 0)).reverse()
-            right = (left + (back, 0, 0)).reverse()
-            patches['upba'] = sf.edge_curves(btm, right, top, left)
+        if 'ba' in surfaces:
             patches.connect(
                 ('upba', 3, 'ba', 4), ('upba', 1, 'up', 2),
                 ('dnba', 4, 'ba', 3), ('dnba', 1, 'dn', 2),
             )
             patches.boundary('wall', 'upba', 4)
-            patches.boundary('outflow', 'upfr', 2)
+            patches.boundary('outflow', 'upba', 2)
             patches.boundary('wall', 'dnba', 3)
             patches.boundary('outflow', 'dnba', 2)
         else:
             patches.boundary('outflow', 'up', 2)
             patches.boundary('outflow', 'dn', 2)
 
-        nel = int(ceil(log(1 - 1/dl * (1 - grad) * side) / log(grad)))
-        for uk in {'up', 'upfr', 'upba'} & patches.keys():
-            dk = 'dn' + uk[2:]
-            patches[dk] = patches[uk] - (0, side + 2 * width, 0)
-            geometric_refine(patches[uk], grad, nel - 1, direction='v')
-            geometric_refine(patches[dk], grad, nel - 1, direction='v', reverse=True)
+        for pname in ['up', 'upfr', 'upba', 'dn', 'dnfr', 'dnba']:
+            if pname[2:] in {'', *surfaces}:
+                surfaces[pname] = sides[pname]
 
     else:
         patches.boundary('wall', 'ou', 2)
@@ -325,33 +395,92 @@ def cylinder(diam, width, front, back, side, height, re, grad, inner_elsize,
         patches.boundary('wall', 'or', 4, dim=-2, add=vx_add)
         patches.boundary('wall', 'or', 2, dim=-2, add=vx_add)
 
-        if 'fr' in patches:
+        if 'fr' in surfaces:
             patches.boundary('wall', 'fr', 4)
             patches.boundary('wall', 'fr', 3)
             patches.boundary('wall', 'ol', 2, dim=-2, add=vx_add)
             patches.boundary('wall', 'ol', 4, dim=-2, add=vx_add)
 
-        if 'ba' in patches:
+        if 'ba' in surfaces:
             patches.boundary('wall', 'ba', 4)
             patches.boundary('wall', 'ba', 3)
 
-
     if height > 0.0:
+        # When spilling, extrude no more patches at a time than run in
+        # parallel, so that each batch is moved to disk before the next
+        names = list(surfaces)
+        step = jobs if spill is not None else len(names)
+        for start in range(0, len(names), step):
+            batch = names[start:start + step]
+            volumes = stages.map('extrude', extrude_patch, [surfaces[pname] for pname in batch],
+                                 height, nel_height, order, jobs=jobs)
+            for pname, volume in zip(batch, volumes):
+                patches[pname] = volume.value
+
         names = ['iu', 'il', 'id', 'ir', 'ou', 'ol', 'od', 'or',
                  'fr', 'ba', 'up', 'upba', 'upfr', 'dn', 'dnba', 'dnfr']
         for pname in names:
-            if pname not in patches:
-                continue
-            patch = patches[pname]
-            patch = extrude(patch, (0, 0, height))
-            patch.raise_order(0, 0, 2)
-            patch.refine(nel_height-1, direction='w')
-            patches[pname] = patch
-            patches.boundary('zup', pname, 6)
-            patches.boundary('zdown', pname, 5)
-            patches.connect((pname, 5, pname, 6, 'per'))
-
-    patches.write(out, order=order)
+            if pname in surfaces:
+                patches.boundary('zup', pname, 6)
+                patches.boundary('zdown', pname, 5)
+                patches.connect((pname, 5, pname, 6, 'per'))
+
+    else:
+        for pname, result in surfaces.items():
+            patches[pname] = result.value
+
+    return patches
+
+
+@click.command()
+@click.option('--diam', default=1.0)
+@click.option('--width', default=20.0)
+@click.option('--front', default=20.0)
+@click.option('--back', default=40.0)
+@click.option('--side', default=20.0)
+@click.option('--height', default=0.0)
+@click.option('--Re', default=100.0)
+@click.option('--grad', type=float, required=False)
+@click.option('--nel-bndl', default=10)
+@click.option('--inner-elsize', type=float, required=False)
+@click.option('--nel-side', type=int, required=False)
+@click.option('--nel-circ', default=40)
+@click.option('--nel-height', default=10)
+@click.option('--order', default=4)
+@click.option('--native-order/--no-native-order', default=False,
+              help='Build the patches at --order instead of lowering cubic patches')
+@click.option('--outer-graded/--no-outer-graded', default=True)
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='g2')
+@compression_options
+@click.option('--validate/--no-validate', default=True)
+@click.option('--pretty/--no-pretty', default=True, help='Indent the topology file')
+@click.option('--procs', default=1, help='Number of processes to partition the patches for')
+@click.option('--levels', type=click.IntRange(min=1), default=1,
+              help='Number of nested levels to write, each refined uniformly from the previous')
+@click.option('--prolongation/--no-prolongation', default=False,
+              help='Write the prolongations between levels')
+@click.option('--jobs', default=1,
+              help='Number of processes to extrude 3D patches in, then of threads to validate in')
+@click.option('--spill', type=click.Path(file_okay=False, exists=True), default=None,
+              help='Keep finished patches in memory-mapped files in this directory')
+@click.option('--out', default='out')
+@profiled
+@sized(size_cylinder)
+@cached('cylinder', ignore=['jobs', 'spill'])
+def cylinder(order, native_order, fmt, compression, compression_level, validate, pretty, procs, levels,
+             prolongation, jobs, cache, out, **kwargs):
+    """Generate a channel around a cylinder, in 2D or, with --height, 3D."""
+    stages = Stages(Cache() if cache else None)
+    try:
+        patches = build_cylinder(order=order if native_order else 4, jobs=jobs, stages=stages, **kwargs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if procs > 1:
+        print(format_statistics(patches.partition(procs, order=order)))
+    write_hierarchy(patches, out, levels, prolongation,
+                    order=order, fmt=fmt, validate=validate, jobs=jobs, pretty=pretty,
+                    compression=compression, compression_level=compression_level)
 
 
 if __name__ == '__main__':
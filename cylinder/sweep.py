@@ -0,0 +1,141 @@
+import click
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import json
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cylinder import cylinder, build_cylinder
+from meshscripts.cache import Cache
+from meshscripts.compression import COMPRESSIONS
+from meshscripts.hierarchy import level_name, write_hierarchy
+from meshscripts.io import patch_filename
+from meshscripts.stages import Stages
+
+
+# Options of the cylinder command that are not passed on to build_cylinder
+OUTPUT_OPTIONS = {
+    'order', 'native_order', 'fmt', 'compression', 'compression_level', 'validate', 'pretty', 'procs',
+    'levels', 'prolongation', 'cache', 'profile', 'profile_format', 'dry_run', 'out',
+}
+
+
+def read_table(fn):
+    """Read a parameter table from a CSV or JSON file.
+
+    A CSV file has one row per run, with option names in the header.  A
+    JSON file is either a list of such rows, or a grid mapping option names
+    to lists of values, in which case every combination is run.
+    """
+    if fn.endswith('.csv'):
+        with open(fn, newline='') as f:
+            return [{k: v for k, v in row.items() if v != ''} for row in csv.DictReader(f)]
+
+    with open(fn) as f:
+        table = json.load(f)
+    if isinstance(table, list):
+        return table
+    names = list(table)
+    values = [v if isinstance(v, list) else [v] for v in table.values()]
+    return [dict(zip(names, combination)) for combination in product(*values)]
+
+
+def normalize(row):
+    """Convert a table row to a complete set of cylinder command parameters.
+
+    Option names may be given as on the command line (with or without
+    leading dashes) or as Python identifiers.  Values are converted with the
+    option's own type, and missing options take their default values.
+    """
+    params = {}
+    for param in cylinder.params:
+        params[param.name] = param
+        for opt in param.opts:
+            params[opt.lstrip('-').replace('-', '_').lower()] = param
+
+    values = dict(cylinder.make_context('cylinder', []).params)
+    for key, value in row.items():
+        name = key.lstrip('-').replace('-', '_').lower()
+        if name not in params:
+            raise click.BadParameter('unknown option {!r}'.format(key))
+        param = params[name]
+        values[param.name] = None if value is None else param.type.convert(value, param, None)
+    return values
+
+
+def run(args):
+    index, values, out, threads = args
+    order, fmt, validate = values['order'], values['fmt'], values['validate']
+    kwargs = {k: v for k, v in values.items() if k not in OUTPUT_OPTIONS}
+
+    start = perf_counter()
+    patches = build_cylinder(
+        order=order if values['native_order'] else 4,
+        stages=Stages(Cache() if values['cache'] else None), **kwargs
+    )
+    if values['procs'] > 1:
+        patches.partition(values['procs'], order=order)
+    levels = values['levels']
+    compression = values['compression']
+    write_hierarchy(patches, out, levels, values['prolongation'],
+                    order=order, fmt=fmt, validate=validate, jobs=threads, pretty=values['pretty'],
+                    compression=compression, compression_level=values['compression_level'])
+
+    # The finest level, in a hierarchy
+    finest = out if levels == 1 else level_name(out, levels - 1)
+
+    return {
+        'index': index,
+        'params': values,
+        'patchfile': patch_filename(finest, fmt, compression),
+        'xinp': finest + '.xinp' + (COMPRESSIONS[compression] if compression else ''),
+        'levels': levels,
+        'patches': len(patches),
+        'time': perf_counter() - start,
+    }
+
+
+@click.command()
+@click.argument('table', type=click.Path(exists=True, dir_okay=False))
+@click.option('--jobs', type=click.IntRange(min=1), default=os.cpu_count(),
+              help='Number of rows to run at a time, in processes sharing the cores to validate in')
+@click.option('--out', default='sweep')
+def sweep(table, jobs, out):
+    rows = [normalize(row) for row in read_table(table)]
+    os.makedirs(out, exist_ok=True)
+
+    # Each process validates its patches in threads, which must not add
+    # up to more than the cores
+    threads = max(1, os.cpu_count() // jobs)
+    width = len(str(len(rows) - 1))
+    tasks = [
+        (i, values, os.path.join(out, '{}-{:0{}}'.format(values['out'], i, width)), threads)
+        for i, values in enumerate(rows)
+    ]
+
+    manifest, failed = [], 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run, task) for task in tasks]
+        for (i, values, _, _), future in zip(tasks, futures):
+            try:
+                entry = future.result()
+            except Exception as e:
+                # One failed row must not lose the results of the others
+                error = str(e) or type(e).__name__
+                print('Row {}: {}'.format(i, error), file=sys.stderr)
+                entry = {'index': i, 'params': values, 'error': error}
+                failed += 1
+            manifest.append(entry)
+
+    with open(os.path.join(out, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    sweep()
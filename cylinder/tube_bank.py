@@ -0,0 +1,302 @@
+import click
+from collections import OrderedDict
+from math import ceil
+import os
+import sys
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cylinder import (
+    INNER_CONNECTIONS, OUTER_CONNECTIONS, extrude_patch, inner_patches, outer_patches, outer_size,
+    radial_curves, radial_grading, size_cylinder,
+)
+from meshscripts.cache import Cache, cached
+from meshscripts.compression import compression_options
+from meshscripts.grading import num_elements
+from meshscripts.hierarchy import write_hierarchy
+from meshscripts.io import FORMATS
+from meshscripts.lazy import lazy_import
+from meshscripts.order import to_order
+from meshscripts.profile import profiled, stage
+from meshscripts.sizing import patch_sizes, sized
+from meshscripts.partition import format_statistics
+from meshscripts.stages import Stages
+from meshscripts.tiling import instance_name, translated, write_instances
+from meshscripts.topology import PatchDict
+
+
+cf = lazy_import('splipy.curve_factory')
+sf = lazy_import('splipy.surface_factory')
+refinement = lazy_import('splipy.utils.refinement')
+
+
+TUBE = ['iu', 'il', 'id', 'ir', 'ou', 'ol', 'od', 'or']
+
+# The sides of a tube block, as the outer patch there, its edge on the side
+# and whether the edge runs backwards, in -x or -y
+TUBE_SIDES = {
+    'left': ('ol', 2, True),
+    'right': ('or', 2, False),
+    'bottom': ('od', 2, False),
+    'top': ('ou', 2, True),
+}
+
+# The edges of a filler block on its sides, all running in +x or +y
+FILLER_SIDES = {'left': 1, 'right': 2, 'bottom': 3, 'top': 4}
+
+# The boundary sets at the sides of the domain
+SIDES = {'left': 'inflow', 'right': 'outflow', 'bottom': 'bottom', 'top': 'top'}
+
+
+def block_intervals(count, pitch, width, before, after, dl, grad, nel_circ, graded_after=True):
+    """Return the intervals of the grid of blocks in one direction, as
+    (start, length, elements, grading, tube).  The tube blocks, of length
+    2 * width, are centered at 0, pitch, and so on, with gaps between them
+    and margins of the given lengths before the first and after the last.
+    The grading is the end with the smallest elements, 0 or 1, or None for
+    uniform elements, and tube is the number of the tube, from 1, or None.
+    Empty gaps and margins are left out.
+    """
+    gap = pitch - 2 * width
+    intervals = []
+    if before > 0:
+        intervals.append((-width - before, before, num_elements(dl, before, grad), 1, None))
+    for k in range(count):
+        if k > 0 and gap > 1e-10 * pitch:
+            intervals.append((k * pitch - pitch + width, gap, int(ceil(gap / dl)), None, None))
+        intervals.append((k * pitch - width, 2 * width, nel_circ, None, k + 1))
+    if after > 0:
+        start = (count - 1) * pitch + width
+        if graded_after:
+            intervals.append((start, after, num_elements(dl, after, grad), 0, None))
+        else:
+            intervals.append((start, after, int(ceil(after / dl)), None, None))
+    return intervals
+
+
+def _grid(diam, width, front, back, side, nx, ny, pitch_x, pitch_y, dl, grad, nel_circ,
+          outer_graded):
+    # The columns and rows of the grid of blocks, in absolute lengths
+    rad_cyl = diam / 2
+    width *= rad_cyl
+    if min(pitch_x, pitch_y) * rad_cyl < 2 * width:
+        raise ValueError('The pitch must be at least twice the width')
+    columns = block_intervals(nx, pitch_x * rad_cyl, width, front * rad_cyl - width,
+                              back * rad_cyl - width, dl, grad, nel_circ, outer_graded)
+    rows = block_intervals(ny, pitch_y * rad_cyl, width, side * rad_cyl - width,
+                           side * rad_cyl - width, dl, grad, nel_circ)
+    return columns, rows
+
+
+def size_tube_bank(diam=1.0, width=2.0, front=10.0, back=20.0, side=5.0, height=0.0, re=100.0,
+                   grad=None, nel_bndl=10, inner_elsize=None, nel_side=None, nel_circ=20,
+                   nel_height=10, nx=3, ny=3, pitch_x=5.0, pitch_y=5.0, outer_graded=True,
+                   order=4):
+    """Return the Sizes of the mesh built by build_tube_bank, without
+    building it.  Unlike for size_cylinder, the parameters must be scalars.
+    """
+    tube = size_cylinder(diam, width, width, width, width, height, re, grad, nel_bndl,
+                         inner_elsize, nel_side, nel_circ, nel_height, outer_graded, order)
+    rad_cyl = diam / 2
+    dr, grad, nel_side = radial_grading(diam, width * rad_cyl, re, grad, nel_bndl, inner_elsize,
+                                        nel_side)
+    dl = float(outer_size(rad_cyl, width * rad_cyl, dr, grad, nel_side))
+    columns, rows = _grid(diam, width, front, back, side, nx, ny, pitch_x, pitch_y, dl, grad,
+                          nel_circ, outer_graded)
+
+    extra = (nel_height,) if height > 0.0 else ()
+    patches = OrderedDict()
+    for r, (_, _, nely, _, j) in enumerate(rows, 1):
+        for c, (_, _, nelx, _, i) in enumerate(columns, 1):
+            if i and j:
+                for name in TUBE:
+                    patches[instance_name(name, i, j)] = tube.patches[name]
+            else:
+                patches[instance_name('fill', c, r)] = (nelx, nely) + extra
+    return patch_sizes(patches, order, **tube.info)
+
+
+def filler(length_x, nel_x, grading_x, length_y, nel_y, grading_y, grad, order):
+    """Return a rectangle of the given lengths, with its lower left corner
+    at the origin, refined to the given numbers of elements, graded towards
+    the given ends (see block_intervals).
+    """
+    btm = cf.line((0, 0, 0), (length_x, 0, 0))
+    top = cf.line((0, length_y, 0), (length_x, length_y, 0))
+    patch = to_order(sf.edge_curves(btm, top), order)
+    for direction, nel, grading in [('u', nel_x, grading_x), ('v', nel_y, grading_y)]:
+        if nel < 2:
+            continue
+        if grading is None:
+            patch.refine(nel - 1, direction=direction)
+        else:
+            refinement.geometric_refine(patch, grad, nel - 1, direction=direction,
+                                        reverse=grading == 1)
+    return patch
+
+
+def _side(name, tube, where):
+    # The patch, edge and direction of a block on one of its sides
+    if tube:
+        pname, number, backwards = TUBE_SIDES[where]
+        return instance_name(pname, *tube), number, backwards
+    return name, FILLER_SIDES[where], False
+
+
+def build_tube_bank(diam=1.0, width=2.0, front=10.0, back=20.0, side=5.0, height=0.0, re=100.0,
+                    grad=None, nel_bndl=10, inner_elsize=None, nel_side=None, nel_circ=20,
+                    nel_height=10, nx=3, ny=3, pitch_x=5.0, pitch_y=5.0, outer_graded=True,
+                    order=4, stages=None):
+    """Build the tube bank mesh and return it as a PatchDict.
+
+    Takes the same parameters as the command line interface, except for
+    those concerned with output.  The tubes are nx by ny cylinders, the
+    first centered at the origin, with the O-grid of the cylinder mesh
+    around each, of 2 * width.  The pitch and the distances from the
+    outermost tubes to the sides of the domain are in radii, like width.
+    The patches are instances of the O-grid, built once, and of the
+    blocks filling the gaps between the O-grids (see
+    meshscripts.tiling.translated), named with instance_name() after the
+    tube, or the column and row of the block in the grid of blocks, from
+    1.  The O-grid is built in stages, memoized by `stages` if given.
+    """
+    assert all(f >= width for f in [front, back, side])
+
+    rad_cyl = diam / 2
+    dim = 2 if height == 0.0 else 3
+    patches = PatchDict(dim)
+    stages = stages or Stages()
+
+    dr, grad, nel_side = radial_grading(diam, width * rad_cyl, re, grad, nel_bndl, inner_elsize,
+                                        nel_side)
+    radial = stages.run('radial', radial_curves, rad_cyl, width * rad_cyl, dr, grad, nel_side,
+                        order)
+    inner = stages.run('inner', inner_patches, radial[0], nel_circ)
+    outer = stages.run('outer', outer_patches, radial[1], inner, width * rad_cyl, nel_circ,
+                       order)
+    tube = OrderedDict(
+        (name, (inner if k < 4 else outer)[k % 4].value) for k, name in enumerate(TUBE)
+    )
+    dl = radial[2].value
+    columns, rows = _grid(diam, width, front, back, side, nx, ny, pitch_x, pitch_y, dl, grad,
+                          nel_circ, outer_graded)
+    pitch = (pitch_x * rad_cyl, pitch_y * rad_cyl)
+
+    def extruded(patch):
+        return extrude_patch(patch, height, nel_height, order) if dim == 3 else patch
+
+    with stage('blocks'):
+        tube = OrderedDict((name, extruded(patch)) for name, patch in tube.items())
+        fillers = {}
+        blocks = OrderedDict()
+        for r, (y, length_y, nel_y, grading_y, j) in enumerate(rows, 1):
+            for c, (x, length_x, nel_x, grading_x, i) in enumerate(columns, 1):
+                name = instance_name('fill', c, r)
+                if i and j:
+                    blocks[c, r] = (name, (i, j))
+                    offset = ((i - 1) * pitch[0], (j - 1) * pitch[1])
+                    for pname, template in tube.items():
+                        patches[instance_name(pname, i, j)] = translated(template, offset)
+                    continue
+
+                key = (length_x, nel_x, grading_x, length_y, nel_y, grading_y)
+                if key not in fillers:
+                    fillers[key] = extruded(filler(*key, grad=grad, order=order))
+                blocks[c, r] = (name, None)
+                patches[name] = translated(fillers[key], (x, y))
+
+    for (c, r), (name, tube_ij) in blocks.items():
+        if tube_ij:
+            for connections in (INNER_CONNECTIONS, OUTER_CONNECTIONS):
+                patches.connect(*(
+                    (instance_name(m, *tube_ij), medge, instance_name(s, *tube_ij), sedge)
+                    for m, medge, s, sedge in connections
+                ))
+            for pname in TUBE[:4]:
+                pname = instance_name(pname, *tube_ij)
+                patches.boundary('cylinder', pname, 1)
+                patches.boundary(instance_name('cylinder', *tube_ij), pname, 1)
+
+        # Connect to the blocks to the right and above, or add the sides of
+        # the domain
+        for where, other, facing in [('right', (c + 1, r), 'left'), ('top', (c, r + 1), 'bottom')]:
+            if other in blocks:
+                master, medge, mback = _side(name, tube_ij, where)
+                oname, otube = blocks[other]
+                slave, sedge, sback = _side(oname, otube, facing)
+                patches.connect((master, medge, slave, sedge) + (('rev',) if mback != sback else ()))
+        for where in SIDES:
+            last = {'left': c == 1, 'right': c == len(columns),
+                    'bottom': r == 1, 'top': r == len(rows)}[where]
+            if last:
+                patches.boundary(SIDES[where], *_side(name, tube_ij, where)[:2])
+
+    if dim == 3:
+        for pname in patches:
+            patches.boundary('zup', pname, 6)
+            patches.boundary('zdown', pname, 5)
+            patches.connect((pname, 5, pname, 6, 'per'))
+
+    return patches
+
+
+@click.command()
+@click.option('--diam', default=1.0)
+@click.option('--width', default=2.0, help='Half the side of the O-grid around a tube, in radii')
+@click.option('--front', default=10.0)
+@click.option('--back', default=20.0)
+@click.option('--side', default=5.0)
+@click.option('--height', default=0.0)
+@click.option('--Re', default=100.0)
+@click.option('--grad', type=float, required=False)
+@click.option('--nel-bndl', default=10)
+@click.option('--inner-elsize', type=float, required=False)
+@click.option('--nel-side', type=int, required=False)
+@click.option('--nel-circ', default=20)
+@click.option('--nel-height', default=10)
+@click.option('--nx', type=click.IntRange(min=1), default=3, help='Number of tubes in x')
+@click.option('--ny', type=click.IntRange(min=1), default=3, help='Number of tubes in y')
+@click.option('--pitch-x', default=5.0, help='Distance between tube centers in x, in radii')
+@click.option('--pitch-y', default=5.0, help='Distance between tube centers in y, in radii')
+@click.option('--order', default=4)
+@click.option('--native-order/--no-native-order', default=False,
+              help='Build the patches at --order instead of lowering cubic patches')
+@click.option('--outer-graded/--no-outer-graded', default=True)
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='g2')
+@compression_options
+@click.option('--validate/--no-validate', default=True)
+@click.option('--pretty/--no-pretty', default=True, help='Indent the topology file')
+@click.option('--procs', default=1, help='Number of processes to partition the patches for')
+@click.option('--levels', type=click.IntRange(min=1), default=1,
+              help='Number of nested levels to write, each refined uniformly from the previous')
+@click.option('--prolongation/--no-prolongation', default=False,
+              help='Write the prolongations between levels')
+@click.option('--instanced/--no-instanced', default=False,
+              help='Also write the distinct patches and the offsets of their instances')
+@click.option('--out', default='out')
+@profiled
+@sized(size_tube_bank)
+@cached('tube_bank')
+def tube_bank(order, native_order, fmt, compression, compression_level, validate, pretty, procs,
+              levels, prolongation, instanced, cache, out, **kwargs):
+    """Generate a channel around a bank of cylinders, in 2D or, with --height, 3D."""
+    if instanced and levels > 1:
+        raise click.UsageError('--instanced can not be combined with --levels')
+    stages = Stages(Cache() if cache else None)
+    try:
+        patches = build_tube_bank(order=order if native_order else 4, stages=stages, **kwargs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if procs > 1:
+        print(format_statistics(patches.partition(procs, order=order)))
+    write_hierarchy(patches, out, levels, prolongation, order=order, fmt=fmt, validate=validate,
+                    pretty=pretty, compression=compression, compression_level=compression_level)
+    if instanced:
+        with stage('instances'):
+            write_instances(out, patches, order=order, fmt=fmt, compression=compression,
+                            compression_level=compression_level)
+
+
+if __name__ == '__main__':
+    tube_bank()
@@ -1,9 +1,35 @@
 import click
-import numpy as np
-from lxml import etree
+from collections import OrderedDict
+import os
+import sys
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from meshscripts.cache import cached
+from meshscripts.compression import compression_options
+from meshscripts.hierarchy import write_hierarchy
+from meshscripts.io import FORMATS
+from meshscripts.lazy import lazy_import
+from meshscripts.order import to_order
+from meshscripts.profile import profiled, stage
+from meshscripts.sizing import patch_sizes, sized
+from meshscripts.partition import format_statistics
+from meshscripts.topology import PatchDict
+
+
+np = lazy_import('numpy')
+cf = lazy_import('splipy.curve_factory')
+sf = lazy_import('splipy.surface_factory')
+vf = lazy_import('splipy.volume_factory')
 
-from splipy import curve_factory as cf, surface_factory as sf, volume_factory as vf
-from splipy.IO import G2
+
+def size_cylinder(elements_rad=10, elements_len=15, order=4):
+    """Return the Sizes of the mesh, without building it.  All parameters
+    may be arrays.
+    """
+    # Refining the extruded patches by elements_len knots gives one more element
+    nels = (elements_rad, elements_rad, elements_len + 1)
+    return patch_sizes(OrderedDict((name, nels) for name in ['sq', 's1', 's2', 's3', 's4']), order)
 
 
 @click.command()
@@ -11,60 +37,74 @@ from splipy.IO import G2
 @click.option('--length', default=2.0)
 @click.option('--elements-rad', default=10)
 @click.option('--elements-len', default=15)
+@click.option('--order', default=4)
+@click.option('--native-order/--no-native-order', default=False,
+              help='Build the patches at --order instead of lowering cubic patches')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='g2')
+@compression_options
+@click.option('--validate/--no-validate', default=True)
+@click.option('--pretty/--no-pretty', default=True, help='Indent the topology file')
+@click.option('--procs', default=1, help='Number of processes to partition the patches for')
+@click.option('--levels', type=click.IntRange(min=1), default=1,
+              help='Number of nested levels to write, each refined uniformly from the previous')
+@click.option('--prolongation/--no-prolongation', default=False,
+              help='Write the prolongations between levels')
 @click.option('--out', default='out')
-def cylinder(radius, length, elements_rad, elements_len, out):
-    square = sf.square(size=2*radius/3, lower_left=(-radius/3, -radius/3))
-    square.set_dimension(3)
-    square.raise_order(2, 2)
-    square.refine(elements_rad-1, elements_rad-1)
-
-    pts = np.zeros((elements_rad+1, 3))
-    angles = np.linspace(-np.pi/4, np.pi/4, elements_rad+1)
-    pts[:,0] = radius * np.cos(angles)
-    pts[:,1] = radius * np.sin(angles)
-    curve = cf.cubic_curve(pts, t=square.knots('v'))
-
-    sector = sf.edge_curves(square.section(u=-1), curve)
-    sector.raise_order(0, 2)
-    sector.refine(0, elements_rad-1)
-    sector.swap()
+@profiled
+@sized(size_cylinder)
+@cached('filled_cylinder')
+def cylinder(radius, length, elements_rad, elements_len, order, native_order, fmt, compression,
+             compression_level, validate, pretty, procs, levels, prolongation, out):
+    """Generate a solid cylinder, as a square core with four sectors."""
+    p = order if native_order else 4
 
-    sectors = [sector.clone().rotate(angle) for angle in [0, np.pi/2, np.pi, np.pi*3/2]]
-    patches = [vf.extrude(patch, (0, 0, length)) for patch in [square] + sectors]
-    for patch in patches:
-        patch.raise_order(0, 0, 2)
-        patch.refine(0, 0, elements_len)
+    with stage('square'):
+        square = sf.square(size=2*radius/3, lower_left=(-radius/3, -radius/3))
+        square.set_dimension(3)
+        square.raise_order(p - 2, p - 2)
+        square.refine(elements_rad-1, elements_rad-1)
 
-    with G2(out + '.g2') as f:
-        f.write(patches)
+    with stage('sector'):
+        pts = np.zeros((elements_rad+1, 3))
+        angles = np.linspace(-np.pi/4, np.pi/4, elements_rad+1)
+        pts[:,0] = radius * np.cos(angles)
+        pts[:,1] = radius * np.sin(angles)
+        curve = cf.cubic_curve(pts, t=square.knots('v'))
 
-    root = etree.Element('geometry')
-    etree.SubElement(root, 'patchfile').text = out + '.g2'
-    topology = etree.SubElement(root, 'topology')
-    for mid, sid, midx, sidx, rev in [(1, 2, 2, 1, False), (1, 3, 4, 1, True),
-                                      (1, 4, 1, 1, True),  (1, 5, 3, 1, False),
-                                      (2, 3, 4, 3, False), (2, 5, 3, 4, False),
-                                      (3, 4, 4, 3, False), (4, 5, 4, 3, False)]:
-        etree.SubElement(topology, 'connection').attrib.update({
-            'master': str(mid), 'slave': str(sid),
-            'midx': str(midx), 'sidx': str(sidx),
-            'reverse': 'true' if rev else 'false',
-        })
+        sector = to_order(sf.edge_curves(square.section(u=-1), curve), p)
+        sector.refine(0, elements_rad-1)
+        sector.swap()
 
-    topsets = etree.SubElement(root, 'topologysets')
+    with stage('extrude'):
+        sectors = [sector.clone().rotate(angle) for angle in [0, np.pi/2, np.pi, np.pi*3/2]]
+        patches = PatchDict(3)
+        patches.add('sq', 's1', 's2', 's3', 's4',
+                    [vf.extrude(patch, (0, 0, length)) for patch in [square] + sectors])
+        for patch in patches.values():
+            patch.raise_order(0, 0, p - 2)
+            patch.refine(0, 0, elements_len)
 
-    for name, start, idx in [('wall', 2, 2), ('inflow', 1, 5), ('outflow', 1, 6)]:
-        topset = etree.SubElement(topsets, 'set')
-        topset.attrib.update({'name': name, 'type': 'face'})
-        for i in range(start, 6):
-            item = etree.SubElement(topset, 'item')
-            item.attrib['patch'] = str(i)
-            item.text = str(idx)
+    patches.connect(
+        ('sq', 2, 's1', 1),
+        ('sq', 4, 's2', 1, 'rev'),
+        ('sq', 1, 's3', 1, 'rev'),
+        ('sq', 3, 's4', 1),
+        ('s1', 4, 's2', 3),
+        ('s1', 3, 's4', 4),
+        ('s2', 4, 's3', 3),
+        ('s3', 4, 's4', 3),
+    )
+    for pname in ['s1', 's2', 's3', 's4']:
+        patches.boundary('wall', pname, 2)
+    for pname in patches:
+        patches.boundary('inflow', pname, 5)
+    for pname in patches:
+        patches.boundary('outflow', pname, 6)
 
-    with open(out + '.xinp', 'wb') as f:
-        f.write(etree.tostring(
-            root, pretty_print=True, encoding='utf-8', xml_declaration=True, standalone=False
-        ))
+    if procs > 1:
+        print(format_statistics(patches.partition(procs, order=order)))
+    write_hierarchy(patches, out, levels, prolongation, order=order, fmt=fmt, validate=validate,
+                    pretty=pretty, compression=compression, compression_level=compression_level)
 
 
 if __name__ == '__main__':
@@ -1,41 +1,129 @@
 import click
-import numpy as np
-from math import ceil, log, sqrt, pi
+from collections import OrderedDict
+import os
 import sys
-from lxml import etree
-
-from splipy import curve_factory as cf, surface_factory as sf
-from splipy.utils.refinement import geometric_refine
-from splipy.IO import G2
-
-
-def graded_space(start, step, factor, N):
-    def gen_graded_space(start, step, factor, N):
-        for _ in range(N):
-            yield start
-            start += step
-            step *= factor
-    return list(gen_graded_space(float(start), float(step), float(factor), N))
-
-
-def find_factor(initial, total, N, tol=1e-7):
-    # Solve initial * (1 - a^N) / (1 - a) = total
-    overshoot = lambda a: initial * (1 - (1 + a)**N) / (1 - (1 + a)) - total
-    l, u = 0.5, 0.5
-    while overshoot(l) > 0:
-        l /= 2
-    while overshoot(u) < 0:
-        u *= 2
-    while True:
-        m = (u + l) / 2
-        s = overshoot(m)
-        if abs(s) < tol:
-            break
-        if s > 0:
-            u = m
-        else:
-            l = m
-    return 1 + m
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from meshscripts.cache import cached
+from meshscripts.compression import compression_options
+from meshscripts.hierarchy import write_hierarchy
+from meshscripts.io import FORMATS
+from meshscripts.lazy import lazy_import
+from meshscripts.order import to_order
+from meshscripts.profile import profiled, stage
+from meshscripts.sizing import patch_sizes, sized
+from meshscripts.partition import format_statistics
+from meshscripts.states import write_states
+from meshscripts.topology import PatchDict
+
+
+np = lazy_import('numpy')
+cf = lazy_import('splipy.curve_factory')
+sf = lazy_import('splipy.surface_factory')
+refinement = lazy_import('splipy.utils.refinement')
+
+# The patches around the flag, which move with it
+FLAG_PATCHES = ['flup', 'fldn', 'flba']
+
+
+def circle_division(diam, flag_width, nel_circ):
+    """Return the number of elements along the cylinder on each side, and in
+    front.  Works on arrays as well as scalars.
+    """
+    angle = 2 * np.arcsin(flag_width / (diam / 2) / 2)
+    nels_side = np.round(nel_circ // 2 * 3 * np.pi / 4 / (np.pi - angle)).astype(int)
+    nels_front = (nel_circ // 2 - nels_side) * 2
+    return nels_side, nels_front
+
+
+def size_flag(diam=1.0, flag_width=0.1, nel_rad=40, nel_circ=120, nel_flag=40, order=4):
+    """Return the Sizes of the mesh, without building it.  All parameters
+    may be arrays.
+    """
+    nels_side, nels_front = circle_division(diam, flag_width, nel_circ)
+
+    # With odd nel_circ, the lower part of the circle has one more element
+    # than the line it is joined with, and their knots are merged
+    nels_down = nel_circ - nels_side - nels_front
+    nels_down = nels_side + nels_down - np.gcd(nels_side, nels_down)
+
+    return patch_sizes(OrderedDict([
+        ('up', (nels_side, nel_rad)),
+        ('fr', (nels_front, nel_rad)),
+        ('dn', (nels_down, nel_rad)),
+        ('flup', (nel_flag, nel_rad)),
+        ('fldn', (nel_flag, nel_rad)),
+        # The back of the flag is refined with 40 new knots
+        ('flba', (41, nel_rad)),
+    ]), order, c0=[('fldn', 0)])
+
+
+class Displacements(click.ParamType):
+    """Displacements of the flag centerline, read from a .npy file or a
+    text file.  Each state has the displacement at n points evenly spaced
+    from the root of the flag, which is clamped, to the tip, excluding the
+    root.  A text file has one state per row, with transverse displacements
+    only.  A .npy file has shape (states, n) for transverse displacements,
+    or (states, n, 2) for both components.  Converted to lists, so that the
+    displacements, rather than the file name, are part of the cache key.
+    """
+
+    name = 'displacements'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, list):
+            return value
+        try:
+            disp = np.load(value) if value.endswith('.npy') else np.loadtxt(value, ndmin=2)
+        except (OSError, ValueError) as e:
+            self.fail('can not read {}: {}'.format(value, e), param, ctx)
+        if disp.ndim == 2:
+            disp = np.stack([np.zeros_like(disp), disp], axis=-1)
+        if disp.ndim != 3 or disp.shape[1] == 0 or disp.shape[2] != 2:
+            self.fail('{} has shape {}'.format(value, disp.shape), param, ctx)
+        return disp.tolist()
+
+
+def flag_deltas(patches, reference, displacements, root, tip):
+    """Return the changes to the control points of the patches around the
+    flag for each state of the centerline displacements (see Displacements),
+    keyed on patch name.  The flag extends from x = root to x = tip.
+
+    The displacement of the flag at a point is interpolated linearly
+    between the samples, and the patches behind the flag take that of the
+    tip.  Across the patches, it decays linearly in the parameter, from the
+    flag to the walls and the outflow, which stay fixed, as does the line
+    from the root of the flag to the wall.  Control points are placed by
+    their Greville points in the patches of `reference`, as built, so
+    patches that are split or lowered since get the same changes at shared
+    control points.
+    """
+    disp = np.asarray(displacements, dtype=float)
+    nstates, nsamples = disp.shape[:2]
+    samples = np.concatenate([np.zeros((nstates, 1, 2)), disp], axis=1)
+
+    deltas = OrderedDict()
+    for name, patch in patches.items():
+        base = reference.get(name.split('.')[0])
+        if base is None:
+            continue
+        gu, gv = (np.array(basis.greville()) for basis in patch.bases)
+        (_, vstart), (_, vend) = base.start(), base.end()
+
+        # Position along the flag, and its displacement
+        x = base(gu, vend)[:, 0, 0]
+        pos = np.clip((x - root) / (tip - root), 0, 1) * nsamples
+        i = np.minimum(pos.astype(int), nsamples - 1)
+        t = (pos - i)[:, np.newaxis]
+        flag = samples[:, i] * (1 - t) + samples[:, i + 1] * t
+
+        decay = (gv - vstart) / (vend - vstart)
+        delta = flag[:, :, np.newaxis, :] * decay[:, np.newaxis]
+        if patch.rational:
+            delta *= patch.controlpoints[np.newaxis, ..., -1:]
+        deltas[name] = delta
+    return deltas
 
 
 @click.command()
@@ -50,103 +138,129 @@ def find_factor(initial, total, N, tol=1e-7):
 @click.option('--nel-circ', type=int, default=120)
 @click.option('--nel-flag', type=int, default=40)
 @click.option('--order', default=4)
+@click.option('--native-order/--no-native-order', default=False,
+              help='Build the patches at --order instead of lowering cubic patches')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='g2')
+@compression_options
+@click.option('--validate/--no-validate', default=True)
+@click.option('--pretty/--no-pretty', default=True, help='Indent the topology file')
+@click.option('--procs', default=1, help='Number of processes to partition the patches for')
+@click.option('--levels', type=click.IntRange(min=1), default=1,
+              help='Number of nested levels to write, each refined uniformly from the previous')
+@click.option('--prolongation/--no-prolongation', default=False,
+              help='Write the prolongations between levels')
+@click.option('--states', type=Displacements(), default=None,
+              help='File of flag centerline displacements, written as deformation states')
 @click.option('--out', default='out')
+@profiled
+@sized(size_flag)
+@cached('flag')
 def flag(diam, flag_width, flag_length, width, back,
-         flag_grad, grad, nel_rad, nel_circ, nel_flag, order, out):
+         flag_grad, grad, nel_rad, nel_circ, nel_flag, order, native_order, fmt, compression,
+         compression_level, validate, pretty, procs, levels, prolongation, states, out):
+    """Generate a channel around a cylinder with a flag behind it."""
     assert(back > width)
+    if states is not None and levels > 1:
+        raise click.UsageError('--states can not be combined with --levels')
+    p = order if native_order else 4
 
     rad_cyl = diam / 2
     width *= rad_cyl
     back = back * rad_cyl - width
 
-    # Create a circle
-    angle = 2 * np.arcsin(flag_width / rad_cyl / 2)
-    pts = rad_cyl * np.array([
-        (np.cos(a), np.sin(a)) for a in np.linspace(angle, 2*np.pi - angle, nel_circ + 1)
-    ])
-    circle = cf.cubic_curve(pts, boundary=cf.Boundary.NATURAL)
-    circle.set_dimension(3)
+    with stage('circle'):
+        # Create a circle
+        angle = 2 * np.arcsin(flag_width / rad_cyl / 2)
+        pts = rad_cyl * np.array([
+            (np.cos(a), np.sin(a)) for a in np.linspace(angle, 2*np.pi - angle, nel_circ + 1)
+        ])
+        circle = cf.cubic_curve(pts, boundary=cf.Boundary.NATURAL)
+        circle.set_dimension(3)
+
+        # Subdivide it
+        nels_side, nels_front = (int(n) for n in circle_division(diam, flag_width, nel_circ))
+        S = (- nel_flag * width + nels_side * (width + back)) / (nel_flag + nels_side)
+
+        kts = circle.knots('u')
+        kts = kts[nels_side], kts[nels_side + nels_front]
+        circ_up, circ_front, circ_down = circle.split(kts)
+
+    with stage('surround'):
+        # Extend to boundary
+        front = cf.line((-width, width), (-width, -width)).set_order(4).refine(nels_front - 1)
+        front = to_order(sf.edge_curves(front, circ_front), p)
+        refinement.geometric_refine(front, grad, nel_rad - 1, direction='v', reverse=True)
+
+        up = cf.line((S, width), (-width, width)).set_order(4).refine(nels_side - 1)
+        up = to_order(sf.edge_curves(up, circ_up), p)
+        refinement.geometric_refine(up, grad, nel_rad - 1, direction='v', reverse=True)
+
+        down = cf.line((-width, -width), (S, -width)).set_order(4).refine(nels_side - 1)
+        down = to_order(sf.edge_curves(down, circ_down), p)
+        refinement.geometric_refine(down, grad, nel_rad - 1, direction='v', reverse=True)
+
+    with stage('flag'):
+        # Create the flag
+        upt = circle(circle.start('u'))
+        fl_up = cf.line((flag_length + rad_cyl, upt[1], 0), upt).raise_order(2)
+        refinement.geometric_refine(fl_up, flag_grad, nel_flag - 1, direction='u', reverse=True)
+        ln_up = cf.cubic_curve(np.array([
+            ((1-i)*(width+back) + i*S, width) for i in np.linspace(0, 1, nel_flag + 1)
+        ]), boundary=cf.Boundary.NATURAL, t=fl_up.knots('u'))
+        fl_up = to_order(sf.edge_curves(ln_up, fl_up), p)
+        refinement.geometric_refine(fl_up, grad, nel_rad - 1, direction='v', reverse=True)
+
+        dpt = circle(circle.end('u'))
+        fl_down = cf.line(dpt, (flag_length + rad_cyl, dpt[1], 0))
+        refinement.geometric_refine(fl_down, flag_grad, nel_flag - 1, direction='u')
+        ln_down = cf.cubic_curve(np.array([
+            ((1-i)*S + i*(width+back), -width) for i in np.linspace(0, 1, nel_flag + 1)
+        ]), boundary=cf.Boundary.NATURAL, t=fl_down.knots('u'))
+        fl_down = to_order(sf.edge_curves(ln_down, fl_down), p)
+        refinement.geometric_refine(fl_down, grad, nel_rad - 1, direction='v', reverse=True)
+
+        fl_back = cf.line((flag_length + rad_cyl, dpt[1], 0), (flag_length + rad_cyl, upt[1], 0))
+        ln_back = cf.line((width + back, -width, 0), (width + back, width, 0))
+        fl_back = to_order(sf.edge_curves(ln_back, fl_back), p).refine(40, direction='u')
+        refinement.geometric_refine(fl_back, grad, nel_rad - 1, direction='v', reverse=True)
+
+    patches = PatchDict(2)
+    patches.add('up', 'fr', 'dn', 'flup', 'fldn', 'flba', [up, front, down, fl_up, fl_down, fl_back])
+    patches.connect(
+        ('up', 2, 'fr', 1),
+        ('up', 1, 'flup', 2),
+        ('fr', 2, 'dn', 1),
+        ('dn', 2, 'fldn', 1),
+        ('flup', 1, 'flba', 2),
+        ('fldn', 2, 'flba', 1),
+    )
+    patches.boundary('inflow', 'fr', 3)
+    patches.boundary('inflow', 'fr', 1, dim=-2)
+    patches.boundary('inflow', 'fr', 2, dim=-2)
+    patches.boundary('outflow', 'flba', 3)
+    for pname in ['up', 'flup']:
+        patches.boundary('top', pname, 3)
+    for pname in ['dn', 'fldn']:
+        patches.boundary('bottom', pname, 3)
+    for pname in ['up', 'fr', 'dn']:
+        patches.boundary('cylinder', pname, 4)
+    for pname in ['flup', 'fldn', 'flba']:
+        patches.boundary('flag', pname, 4)
+
+    # As built, before partitioning splits them
+    reference = {name: patches[name] for name in FLAG_PATCHES}
+
+    if procs > 1:
+        print(format_statistics(patches.partition(procs, order=order)))
+    write_hierarchy(patches, out, levels, prolongation, order=order, fmt=fmt, validate=validate,
+                    pretty=pretty, compression=compression, compression_level=compression_level)
+
+    if states is not None:
+        with stage('states'):
+            patches = patches.lowered(order)
+            deltas = flag_deltas(patches, reference, states, upt[0], flag_length + rad_cyl)
+            write_states(out, patches, deltas, components=[0, 1])
 
-    # Subdivide it
-    nels_side = int(round(nel_circ // 2 * 3 * np.pi / 4 / (np.pi - angle)))
-    nels_front = (nel_circ // 2 - nels_side) * 2
-    S = (- nel_flag * width + nels_side * (width + back)) / (nel_flag + nels_side)
-
-    kts = circle.knots('u')
-    kts = kts[nels_side], kts[nels_side + nels_front]
-    circ_up, circ_front, circ_down = circle.split(kts)
-
-    # Extend to boundary
-    front = cf.line((-width, width), (-width, -width)).set_order(4).refine(nels_front - 1)
-    front = sf.edge_curves(front, circ_front).raise_order(0, 2)
-    geometric_refine(front, grad, nel_rad - 1, direction='v', reverse=True)
-
-    up = cf.line((S, width), (-width, width)).set_order(4).refine(nels_side - 1)
-    up = sf.edge_curves(up, circ_up).raise_order(0, 2)
-    geometric_refine(up, grad, nel_rad - 1, direction='v', reverse=True)
-
-    down = cf.line((-width, -width), (S, -width)).set_order(4).refine(nels_side - 1)
-    down = sf.edge_curves(down, circ_down).raise_order(0, 2)
-    geometric_refine(down, grad, nel_rad - 1, direction='v', reverse=True)
-
-    # Create the flag
-    upt = circle(circle.start('u'))
-    fl_up = cf.line((flag_length + rad_cyl, upt[1], 0), upt).raise_order(2)
-    geometric_refine(fl_up, flag_grad, nel_flag - 1, direction='u', reverse=True)
-    ln_up = cf.cubic_curve(np.array([
-        ((1-i)*(width+back) + i*S, width) for i in np.linspace(0, 1, nel_flag + 1)
-    ]), boundary=cf.Boundary.NATURAL, t=fl_up.knots('u'))
-    fl_up = sf.edge_curves(ln_up, fl_up).raise_order(0, 2)
-    geometric_refine(fl_up, grad, nel_rad - 1, direction='v', reverse=True)
-
-    dpt = circle(circle.end('u'))
-    fl_down = cf.line(dpt, (flag_length + rad_cyl, dpt[1], 0))
-    geometric_refine(fl_down, flag_grad, nel_flag - 1, direction='u')
-    ln_down = cf.cubic_curve(np.array([
-        ((1-i)*S + i*(width+back), -width) for i in np.linspace(0, 1, nel_flag + 1)
-    ]), boundary=cf.Boundary.NATURAL, t=fl_down.knots('u'))
-    fl_down = sf.edge_curves(ln_down, fl_down).raise_order(0, 2)
-    geometric_refine(fl_down, grad, nel_rad - 1, direction='v', reverse=True)
-
-    fl_back = cf.line((flag_length + rad_cyl, dpt[1], 0), (flag_length + rad_cyl, upt[1], 0))
-    ln_back = cf.line((width + back, -width, 0), (width + back, width, 0))
-    fl_back = sf.edge_curves(ln_back, fl_back).raise_order(2, 2).refine(40, direction='u')
-    geometric_refine(fl_back, grad, nel_rad - 1, direction='v', reverse=True)
-
-    with G2(out + '.g2') as f:
-        f.write([up, front, down, fl_up, fl_down, fl_back])
-
-    root = etree.Element('geometry')
-    etree.SubElement(root, 'patchfile').text = out + '.g2'
-    topology = etree.SubElement(root, 'topology')
-    for mid, sid, midx, sidx, rev in [(1,2,2,1,False), (1,4,1,2,False), (2,3,2,1,False),
-                                      (3,5,2,1,False), (4,6,1,2,False), (5,6,2,1,False)]:
-        etree.SubElement(topology, 'connection').attrib.update({
-            'master': str(mid), 'slave': str(sid),
-            'midx': str(midx), 'sidx': str(sidx),
-            'reverse': 'true' if rev else 'false',
-        })
-
-    topsets = etree.SubElement(root, 'topologysets')
-    for name, index, entries in [('inflow', 3, [2]), ('outflow', 3, [6]),
-                                 ('top', 3, [1,4]), ('bottom', 3, [3,5]),
-                                 ('cylinder', 4, [1,2,3]), ('flag', 4, [4,5,6])]:
-        topset = etree.SubElement(topsets, 'set')
-        topset.attrib.update({'name': name, 'type': 'edge'})
-        for pid in entries:
-            item = etree.SubElement(topset, 'item')
-            item.attrib['patch'] = str(pid)
-            item.text = str(index)
-    topset = etree.SubElement(topsets, 'set')
-    topset.attrib.update({'name': 'inflow', 'type': 'vertex'})
-    item = etree.SubElement(topset, 'item')
-    item.attrib['patch'] = '2'
-    item.text = '1 2'
-
-    with open(out + '.xinp', 'wb') as f:
-        f.write(etree.tostring(
-            root, pretty_print=True, encoding='utf-8', xml_declaration=True, standalone=False
-        ))
 
 if __name__ == '__main__':
     flag()
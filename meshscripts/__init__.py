@@ -0,0 +1 @@
+"""Shared functionality for the mesh generation scripts."""
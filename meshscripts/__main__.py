@@ -0,0 +1,4 @@
+from meshscripts.cli import main
+
+
+main(prog_name='meshscripts')
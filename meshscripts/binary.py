@@ -0,0 +1,183 @@
+"""Binary patch files.
+
+A binary patch file holds the same information as a G2 file, but stores
+the control points of all patches as one contiguous block of little-endian
+float64 values, which can be memory-mapped instead of parsed.
+
+The layout is
+
+    offset 0     header: magic, offset and length of the index
+    offset 64    control point block
+    ...          index, as UTF-8 encoded JSON
+
+The index lists, for each patch, its name, if given, the parametric and physical dimension,
+whether it is rational, the order, knots and periodicity of each basis, the
+number of control points in each direction and the byte offset of its
+control points.  Within a patch, the control points are stored in the same
+order as in G2 files, with the first parametric direction running fastest,
+and each point is followed by its weight if the patch is rational.
+
+Run this module as a script to convert between G2 and binary files.
+"""
+
+import json
+import os
+import struct
+
+import click
+
+from meshscripts.files import open_output
+from meshscripts.lazy import lazy_import
+
+
+np = lazy_import('numpy')
+splipy = lazy_import('splipy')
+g2 = lazy_import('splipy.io.g2')
+
+EXTENSION = '.g2b'
+MAGIC = b'MSPATCH1'
+HEADER = struct.Struct('<8sQQ')
+DATA_START = 64
+DTYPE = '<f8'
+
+CONSTRUCTORS = {1: 'Curve', 2: 'Surface', 3: 'Volume'}
+
+
+def _storage_axes(pardim):
+    # Reverse the parametric axes, so that the first direction runs fastest
+    return tuple(range(pardim))[::-1] + (pardim,)
+
+
+class BinaryWriter(object):
+    """Write patches to a binary patch file.
+
+    Used in the same way as splipy's G2 writer.  Patches are written as
+    they are given, and the index is written when the file is closed.  If
+    the file is closed on an exception, it is removed instead.
+    """
+
+    def __init__(self, filename):
+        if not filename.endswith(EXTENSION):
+            filename += EXTENSION
+        self.filename = filename
+        self.index = []
+
+    def __enter__(self):
+        self.fstream = open_output(self.filename, 'wb')
+        self.fstream.write(bytes(DATA_START))
+        return self
+
+    def write(self, obj, name=None):
+        if isinstance(obj, (list, tuple)):
+            for o in obj:
+                self.write(o)
+            return
+
+        cps = obj.controlpoints.transpose(_storage_axes(obj.pardim))
+        cps = np.ascontiguousarray(cps, dtype=DTYPE)
+        self.index.append({
+            'name': name,
+            'pardim': obj.pardim,
+            'dimension': obj.dimension,
+            'rational': bool(obj.rational),
+            'bases': [
+                {'order': b.order, 'knots': [float(k) for k in b.knots], 'periodic': b.periodic}
+                for b in obj.bases
+            ],
+            'shape': list(obj.shape),
+            'offset': self.fstream.tell(),
+        })
+        self.fstream.write(cps.tobytes())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Without an index, the data could be taken for a whole file
+            self.fstream.close()
+            os.unlink(self.filename)
+            return
+        index = json.dumps({'patches': self.index}).encode('utf-8')
+        offset = self.fstream.tell()
+        self.fstream.write(index)
+        self.fstream.seek(0)
+        self.fstream.write(HEADER.pack(MAGIC, offset, len(index)))
+        self.fstream.close()
+
+
+class BinaryReader(object):
+    """Read patches from a binary patch file.
+
+    The control points are memory-mapped, and only copied into memory when
+    spline objects are created with read() or patch().
+    """
+
+    def __init__(self, filename):
+        if not filename.endswith(EXTENSION):
+            filename += EXTENSION
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            magic, offset, length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise IOError('{} is not a binary patch file'.format(filename))
+            f.seek(offset)
+            self.index = json.loads(f.read(length).decode('utf-8'))['patches']
+
+        nvalues = (offset - DATA_START) // np.dtype(DTYPE).itemsize
+        if nvalues > 0:
+            self.block = np.memmap(filename, dtype=DTYPE, mode='r', offset=DATA_START, shape=(nvalues,))
+        else:
+            self.block = np.empty((0,), dtype=DTYPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.block = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def controlpoints(self, i):
+        """Return a read-only view of the control points of patch i, with the
+        same shape as the controlpoints attribute of spline objects.
+        """
+        entry = self.index[i]
+        ncomps = entry['dimension'] + entry['rational']
+        start = (entry['offset'] - DATA_START) // np.dtype(DTYPE).itemsize
+        size = int(np.prod(entry['shape'])) * ncomps
+        cps = self.block[start:start+size].reshape(entry['shape'][::-1] + [ncomps])
+        return cps.transpose(_storage_axes(entry['pardim']))
+
+    def patch(self, i):
+        entry = self.index[i]
+        bases = [splipy.BSplineBasis(b['order'], b['knots'], b['periodic']) for b in entry['bases']]
+        constructor = getattr(splipy, CONSTRUCTORS[entry['pardim']])
+        return constructor(*bases, controlpoints=np.array(self.controlpoints(i)),
+                           rational=entry['rational'], raw=True)
+
+    def read(self):
+        return [self.patch(i) for i in range(len(self))]
+
+
+@click.command()
+@click.argument('source', type=click.Path(exists=True, dir_okay=False))
+@click.argument('target', type=click.Path(dir_okay=False))
+def convert(source, target):
+    """Convert between G2 and binary patch files.
+
+    The direction is given by the extension of SOURCE.
+    """
+    if source.endswith(EXTENSION):
+        with BinaryReader(source) as f:
+            patches = f.read()
+        with g2.G2(target) as f:
+            f.write(patches)
+    else:
+        with g2.G2(source) as f:
+            patches = f.read()
+        with BinaryWriter(target) as f:
+            f.write(patches)
+
+
+if __name__ == '__main__':
+    convert()
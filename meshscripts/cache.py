@@ -0,0 +1,323 @@
+"""Cache of generated meshes.
+
+Meshes are stored in a cache directory, keyed on a hash of the generator
+name, its option values (except the output name), the source code of the
+generator, of the modules it imports from its own directory and of this
+package, and the versions of numpy, scipy and splipy.  On a hit, the
+output files are hard-linked (or copied, if linking fails) from the cache
+instead of being generated again, as they were linked into it.  The output files are <out> with an
+output extension, or the levels <out>-<level> of a hierarchy (see
+meshscripts.hierarchy) with one, for the levels of the run only, along with
+deformation states (see meshscripts.states), instances (see
+meshscripts.tiling) and the indices of G2 files (see meshscripts.io).
+Since they may be linked from the cache, output files are never written in
+place (see meshscripts.files).
+
+The cache also holds the intermediate results of generators built from
+stages (see meshscripts.stages), pickled in entries of their own.
+
+The cache directory is given by the MESHSCRIPTS_CACHE environment variable
+and defaults to ~/.cache/meshscripts.  Its size is limited by
+MESHSCRIPTS_CACHE_SIZE (in bytes, default 1 GiB), by evicting the least
+recently used entries.
+"""
+
+import functools
+import hashlib
+import html
+import importlib.metadata
+import inspect
+import json
+import os
+import pickle
+import re
+import shutil
+import sys
+import tempfile
+
+import click
+
+from meshscripts.compression import COMPRESSIONS, CompressedWriter, compression_of, open_input
+from meshscripts.files import open_output
+from meshscripts.hierarchy import level_name
+from meshscripts.io import FORMATS, INDEX_EXTENSION
+from meshscripts.states import EXTENSION as STATES_EXTENSION
+from meshscripts.tiling import INSTANCES_EXTENSION, TEMPLATES_EXTENSIONS
+
+
+PATCH_EXTENSIONS = TEMPLATES_EXTENSIONS + sorted(set(FORMATS.values()))
+# G2 files, compressed or not, are written with an index
+G2_EXTENSIONS = [
+    ext + compressed for ext in PATCH_EXTENSIONS if ext.endswith(FORMATS['g2'])
+    for compressed in [''] + sorted(COMPRESSIONS.values())
+]
+OUTPUT_EXTENSIONS = (
+    ['.xinp', '.npz', STATES_EXTENSION, INSTANCES_EXTENSION]
+    + ['.xinp' + compressed for compressed in sorted(COMPRESSIONS.values())]
+    + sorted(set(PATCH_EXTENSIONS + G2_EXTENSIONS))
+    + [ext + INDEX_EXTENSION for ext in G2_EXTENSIONS]
+)
+DEFAULT_SIZE = 2**30
+OBJECT = 'object.pickle'
+
+# Libraries that change the generated meshes, and the pickled results of
+# stages, across versions
+LIBRARIES = ['numpy', 'scipy', 'splipy']
+
+
+def _script_sources(func):
+    # The source files of the module of func and, transitively, of the
+    # modules it imports from its own directory
+    directory = os.path.dirname(os.path.abspath(inspect.getsourcefile(func)))
+    files, pending = set(), [inspect.getmodule(func)]
+    while pending:
+        module = pending.pop()
+        fn = os.path.abspath(inspect.getsourcefile(module))
+        if fn in files:
+            continue
+        files.add(fn)
+        for value in vars(module).values():
+            imported = value if inspect.ismodule(value) else inspect.getmodule(value)
+            source = getattr(imported, '__file__', None)
+            if source and os.path.dirname(os.path.abspath(source)) == directory:
+                pending.append(imported)
+    return sorted(files)
+
+
+def _source_hash(func):
+    package = os.path.dirname(os.path.abspath(__file__))
+    files = _script_sources(func) + sorted(
+        os.path.join(package, fn) for fn in os.listdir(package) if fn.endswith('.py')
+    )
+    h = hashlib.sha256()
+    for fn in files:
+        with open(fn, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def library_versions():
+    """Return the installed version of each of LIBRARIES, or None."""
+    versions = {}
+    for name in LIBRARIES:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def cache_key(name, func, options):
+    """Return the cache key for running the generator `func`, called
+    `name`, with the given options.
+    """
+    data = json.dumps({
+        'generator': name,
+        'options': options,
+        'source': _source_hash(func),
+        'libraries': library_versions(),
+    }, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _stat(fn):
+    try:
+        st = os.stat(fn)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _outputs(out, levels=1):
+    # The suffixes of the existing output files of a run writing `levels`
+    # levels to `out`.  Other files named <out>-<number> belong to other
+    # runs.
+    directory, base = os.path.split(out)
+    names = [base] if levels == 1 else [level_name(base, k) for k in range(levels)]
+    pattern = re.compile(r'({})({})$'.format(
+        '|'.join(re.escape(name) for name in names),
+        '|'.join(re.escape(ext) for ext in OUTPUT_EXTENSIONS),
+    ))
+    return sorted(fn[len(base):] for fn in os.listdir(directory or '.') if pattern.match(fn))
+
+
+def output_states(out, levels=1):
+    """Return the state of each existing output file of a run writing
+    `levels` levels to `out`, keyed on the suffix of its name.
+    """
+    return {suffix: _stat(out + suffix) for suffix in _outputs(out, levels)}
+
+
+def changed_outputs(out, before, levels=1):
+    """Return the suffixes of the output files of a run writing `levels`
+    levels to `out` created or changed since output_states() returned
+    `before`.
+    """
+    states = output_states(out, levels)
+    return [suffix for suffix, state in states.items() if state != before.get(suffix)]
+
+
+def _link(source, target):
+    # Output files are never written in place, so they can share the data
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class Cache(object):
+
+    def __init__(self, path=None, max_size=None):
+        if path is None:
+            path = os.environ.get('MESHSCRIPTS_CACHE', os.path.expanduser('~/.cache/meshscripts'))
+        if max_size is None:
+            max_size = int(os.environ.get('MESHSCRIPTS_CACHE_SIZE', DEFAULT_SIZE))
+        self.path = path
+        self.max_size = max_size
+
+    def fetch(self, key, out):
+        """Create the output files for `out` from the cache entry `key`.
+        Returns False if there is no such entry.
+        """
+        entry = os.path.join(self.path, key)
+        try:
+            files = os.listdir(entry)
+        except FileNotFoundError:
+            return False
+
+        for fn in files:
+            suffix = fn[len('mesh'):]
+            compressed = COMPRESSIONS.get(compression_of(suffix), '')
+            if suffix[:len(suffix) - len(compressed)].endswith('.xinp'):
+                self._fetch_xinp(os.path.join(entry, fn), out + suffix[:-len('.xinp' + compressed)])
+                continue
+            target = out + suffix
+            if os.path.exists(target):
+                os.unlink(target)
+            _link(os.path.join(entry, fn), target)
+
+        # Mark as recently used
+        os.utime(entry)
+        return True
+
+    def _fetch_xinp(self, source, out):
+        # The patch file name depends on the output name (of the level, in a
+        # hierarchy), everything else is copied verbatim, but compressed
+        # files are compressed again
+        compression = compression_of(source)
+        with open_input(source) as f:
+            text = f.read().decode('utf-8')
+        def replace(match):
+            name = html.unescape(match.group(1))
+            compressed = COMPRESSIONS.get(compression_of(name), '')
+            ext = os.path.splitext(name[:len(name) - len(compressed)])[1] + compressed
+            return '<patchfile>{}</patchfile>'.format(html.escape(out + ext, quote=False))
+        text = re.sub('<patchfile>(.*?)</patchfile>', replace, text, count=1)
+        if compression:
+            f = CompressedWriter(out + '.xinp' + COMPRESSIONS[compression], compression)
+        else:
+            f = open_output(out + '.xinp', 'wb')
+        with f:
+            f.write(text.encode('utf-8'))
+
+    def store(self, key, out, outputs):
+        """Store the output files for `out` with the given suffixes as the
+        cache entry `key`, by hard-linking them if possible.  Outputs larger
+        than the cache are not stored, as they would be evicted at once.
+        """
+        if sum(os.path.getsize(out + suffix) for suffix in outputs) > self.max_size:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+        for suffix in outputs:
+            _link(out + suffix, os.path.join(tmp, 'mesh' + suffix))
+        self._commit(tmp, key)
+
+    def __contains__(self, key):
+        return os.path.isfile(os.path.join(self.path, key, OBJECT))
+
+    def get(self, key):
+        """Return the object stored as the cache entry `key`.  Raises
+        KeyError if there is no such entry.
+        """
+        entry = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(entry, OBJECT), 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            raise KeyError(key)
+
+        # Mark as recently used
+        os.utime(entry)
+        return value
+
+    def put(self, key, value):
+        """Store an object as the cache entry `key`."""
+        os.makedirs(self.path, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+        with open(os.path.join(tmp, OBJECT), 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._commit(tmp, key)
+
+    def _commit(self, tmp, key):
+        try:
+            os.rename(tmp, os.path.join(self.path, key))
+        except OSError:
+            # Stored concurrently by someone else
+            shutil.rmtree(tmp)
+        self.evict()
+
+    def entries(self):
+        """Return (mtime, size, path) for each cache entry, oldest first."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def cached(name, ignore=()):
+    """Decorator for generator commands, which must take an `out` option.
+    Adds a --cache/--no-cache option.  Options listed in `ignore` do not
+    affect the output, and are left out of the cache key.  Commands taking
+    a `cache` argument get the value of the option, to memoize their
+    stages as well.
+    """
+    def decorator(func):
+        forward = 'cache' in inspect.signature(func).parameters
+
+        @functools.wraps(func)
+        def wrapper(cache, out, **kwargs):
+            extra = {'cache': cache} if forward else {}
+            if not cache:
+                return func(out=out, **extra, **kwargs)
+
+            store = Cache()
+            key = cache_key(name, func, {k: v for k, v in kwargs.items() if k not in ignore})
+            if store.fetch(key, out):
+                print('Cache hit: {}'.format(key[:12]), file=sys.stderr)
+                return
+
+            print('Cache miss: {}'.format(key[:12]), file=sys.stderr)
+            levels = kwargs.get('levels', 1)
+            before = output_states(out, levels)
+            result = func(out=out, **extra, **kwargs)
+            store.store(key, out, changed_outputs(out, before, levels))
+            return result
+
+        return click.option('--cache/--no-cache', default=True,
+                            help='Reuse identical meshes from the cache')(wrapper)
+    return decorator
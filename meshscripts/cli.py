@@ -0,0 +1,69 @@
+"""The meshscripts command, with the generators as subcommands.
+
+Run it as 'python -m meshscripts'.  A generator script is only imported
+when its subcommand is used, and imports numpy, scipy and splipy only when
+generating (see meshscripts.lazy), so printing help and rejecting bad
+options stay quick.
+"""
+
+from collections import OrderedDict
+import importlib.util
+import os
+import sys
+
+import click
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Generator names, mapped to their scripts and commands
+GENERATORS = OrderedDict([
+    ('cylinder', ('cylinder/cylinder.py', 'cylinder')),
+    ('tube_bank', ('cylinder/tube_bank.py', 'tube_bank')),
+    ('cut_square', ('cut_square/cut_square.py', 'cut_square')),
+    ('plate', ('cut_square/plate.py', 'plate')),
+    ('flag', ('flag/flag.py', 'flag')),
+    ('filled_cylinder', ('filled_cylinder/filled_cylinder.py', 'cylinder')),
+    ('thingy', ('thingy/thingy.py', 'thingy')),
+])
+
+
+def load(name):
+    """Return the command of a generator, given by its name or subcommand
+    name, importing its script as a module of the same name the first
+    time.
+    """
+    name = name.replace('-', '_')
+    script, command = GENERATORS[name]
+    module = sys.modules.get(name)
+    if module is None:
+        path = os.path.join(ROOT, script)
+        # Scripts import their siblings, as when run directly
+        if os.path.dirname(path) not in sys.path:
+            sys.path.append(os.path.dirname(path))
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        # Registered before running, as pickling by the stages needs it
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+    return getattr(module, command)
+
+
+class _Generators(click.Group):
+
+    def list_commands(self, ctx):
+        return [name.replace('_', '-') for name in GENERATORS]
+
+    def get_command(self, ctx, name):
+        if name.replace('-', '_') not in GENERATORS:
+            return None
+        return load(name)
+
+
+@click.command(cls=_Generators)
+def main():
+    """Generate IFEM meshes."""
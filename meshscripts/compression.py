@@ -0,0 +1,184 @@
+"""Compressed output files.
+
+Patch files and topology files can be written compressed with gzip or,
+with the zstandard package installed, zstd, as '<file>.gz' or
+'<file>.zst'.  A CompressedWriter compresses on a background thread, so
+that compressing the data written so far overlaps producing the rest.
+Its file is a sequence of gzip members or zstd frames, which the usual
+tools decompress as one stream.  G2 patch files start a new member for
+each patch, so that their index (see meshscripts.io) can point at single
+patches, which are then read without decompressing the rest of the file.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import gzip
+import importlib
+
+import click
+
+from meshscripts.files import open_output
+from meshscripts.lazy import lazy_import
+
+
+zstandard = lazy_import('zstandard', optional=True)
+
+
+# Compressions, with their file extensions
+COMPRESSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+
+# Size of the members of files not split otherwise
+CHUNK = 2**20
+
+# Number of members waiting to be compressed before writing blocks
+MAX_PENDING = 4
+
+
+def _check(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression: {}'.format(compression))
+    if compression == 'zstd':
+        try:
+            importlib.import_module('zstandard')
+        except ImportError:
+            raise ValueError('zstd compression needs the zstandard package') from None
+
+
+def compression_options(func):
+    """Decorator for generator commands with a `fmt` option.  Adds
+    --compression and --compression-level options, passed on as
+    `compression` and `compression_level`.
+    """
+    def check(ctx, param, value):
+        try:
+            if value:
+                _check(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+        return value
+
+    @functools.wraps(func)
+    def wrapper(**kwargs):
+        if kwargs['compression'] and kwargs['fmt'] != 'g2':
+            raise click.UsageError('Only G2 patch files can be compressed')
+        return func(**kwargs)
+
+    wrapper = click.option('--compression-level', type=int, default=None,
+                           help='Compression level, by default 6 for gzip and 3 for zstd')(wrapper)
+    return click.option('--compression', type=click.Choice(list(COMPRESSIONS)), default=None,
+                        callback=check, help='Compress the patch and topology files')(wrapper)
+
+
+def compression_of(fn):
+    """Return the compression of a file, given by its extension, or None."""
+    for compression, ext in COMPRESSIONS.items():
+        if fn.endswith(ext):
+            return compression
+    return None
+
+
+def compressor(compression, level=None):
+    """Return a function compressing bytes to one gzip member or zstd frame,
+    at the given level, or the default level of the compression.
+    """
+    _check(compression)
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    if compression == 'gzip':
+        # Without a timestamp, equal data compresses to equal files
+        return functools.partial(gzip.compress, compresslevel=level, mtime=0)
+    return zstandard.ZstdCompressor(level=level).compress
+
+
+def decompress(data, compression):
+    """Return the decompressed data of gzip members or zstd frames."""
+    _check(compression)
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def open_input(fn):
+    """Open a file for reading in binary mode, decompressing it if its
+    extension is that of a compression.
+    """
+    compression = compression_of(fn)
+    if compression is None:
+        return open(fn, 'rb')
+    _check(compression)
+    if compression == 'gzip':
+        return gzip.open(fn, 'rb')
+    return zstandard.ZstdDecompressor().stream_reader(open(fn, 'rb'), read_across_frames=True,
+                                                      closefd=True)
+
+
+class CompressedWriter(object):
+    """A file opened for writing, which compresses the data written to it on
+    a background thread.
+
+    The data is compressed in members, ended by end_member() or, unless
+    chunk is None, whenever chunk bytes have been written since the last
+    one.  Text is encoded as ASCII.
+    """
+
+    def __init__(self, filename, compression, level=None, chunk=CHUNK):
+        self.filename = filename
+        self.compress = compressor(compression, level)
+        self.chunk = chunk
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        self.fstream = open_output(self.filename, 'wb')
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+        return self
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.chunk is not None and self.buffered >= self.chunk:
+            self.end_member()
+        return len(data)
+
+    def end_member(self):
+        """Compress the data written since the last member as a member of its
+        own.  Returns a future of its offset and length in the file, or None
+        if no data was written.
+        """
+        if not self.buffered:
+            return None
+        data = b''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+
+        # Bound the memory held by data waiting to be compressed
+        while len(self.pending) >= MAX_PENDING:
+            self.pending.popleft().result()
+        future = self.pool.submit(self._member, data)
+        self.pending.append(future)
+        return future
+
+    def _member(self, data):
+        # Only one thread writes, so members are written in order
+        data = self.compress(data)
+        offset = self.fstream.tell()
+        self.fstream.write(data)
+        return offset, len(data)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.end_member()
+            self.pool.shutdown()
+            for future in self.pending:
+                future.result()
+        finally:
+            self.fstream.close()
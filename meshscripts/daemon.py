@@ -0,0 +1,228 @@
+"""A server keeping the generators loaded.
+
+Starting Python and importing numpy, scipy and splipy takes longer than
+generating a small mesh.  The server imports the generators once, and runs
+requests in a pool of worker processes forked from it, so that a request
+only pays for the generation itself.
+
+Requests and responses are single lines of JSON over a Unix socket.  A
+request names a generator ('generator'), and gives its options as command
+line arguments ('args'), as a mapping of option names to values
+('options'), or both, and the directory that paths are relative to
+('cwd').  The response holds the exit status ('status'), what the
+generator printed ('stdout' and 'stderr') and the absolute paths of the
+output files it created or updated ('outputs').
+
+The generators, and their dependencies, are only imported in the server,
+so that clients stay quick to start.  Generators may be named as scripts
+or as subcommands of the meshscripts command.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+import errno
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import traceback
+
+import click
+
+from meshscripts.cache import changed_outputs, output_states
+from meshscripts.cli import GENERATORS, load
+from meshscripts.lazy import import_all
+
+
+def socket_path():
+    """Return the socket path given by the MESHSCRIPTS_SOCKET environment
+    variable, by default in the runtime directory of the user.
+    """
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    default = os.path.join(directory, 'meshscripts-{}.sock'.format(os.getuid()))
+    return os.environ.get('MESHSCRIPTS_SOCKET', default)
+
+
+def _owned(path):
+    # Whether path is a socket of this user, and not one that another user
+    # created in a shared directory
+    st = os.lstat(path)
+    return st.st_uid == os.getuid() and stat.S_ISSOCK(st.st_mode)
+
+
+def request(data, path=None):
+    """Send a request to the server at `path` (default: socket_path()) and
+    return the response.  Raises OSError if the server can not be reached,
+    or its socket is not owned by this user.
+    """
+    path = path or socket_path()
+    if not _owned(path):
+        raise PermissionError(errno.EACCES, 'The socket is not owned by this user', path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(data).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('The server closed the connection')
+    return json.loads(line.decode('utf-8'))
+
+
+def _apply_options(ctx, options):
+    # As in the cylinder sweep, option names may be given as on the command
+    # line or as Python identifiers
+    params = {}
+    for param in ctx.command.params:
+        for name in [param.name] + param.opts + param.secondary_opts:
+            params[name.lstrip('-').replace('-', '_').lower()] = param
+    for key, value in options.items():
+        param = params.get(key.lstrip('-').replace('-', '_').lower())
+        if param is None:
+            raise click.UsageError('No such option: {}'.format(key), ctx)
+        ctx.params[param.name] = None if value is None else param.type_cast_value(ctx, value)
+
+
+def run(data):
+    """Run a request, in the current process, and return the response."""
+    stdout, stderr = io.StringIO(), io.StringIO()
+    outputs = []
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            os.chdir(data.get('cwd', '.'))
+            name = data['generator']
+            command = load(name)
+            with command.make_context(name, list(data.get('args', []))) as ctx:
+                _apply_options(ctx, data.get('options', {}))
+                out, levels = ctx.params['out'], ctx.params.get('levels', 1)
+                before = output_states(out, levels)
+                try:
+                    command.invoke(ctx)
+                finally:
+                    outputs = [os.path.abspath(out + suffix)
+                               for suffix in changed_outputs(out, before, levels)]
+            status = 0
+        except click.exceptions.Exit as e:
+            status = e.exit_code
+        except click.ClickException as e:
+            e.show(file=sys.stderr)
+            status = e.exit_code
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+            status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+
+    return {
+        'status': status,
+        'stdout': stdout.getvalue(),
+        'stderr': stderr.getvalue(),
+        'outputs': outputs,
+    }
+
+
+def _preload():
+    # Including the modules the generators import lazily
+    for name in GENERATORS:
+        load(name)
+    import_all()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Only connected, as by _claim()
+            return
+        try:
+            data = json.loads(line.decode('utf-8'))
+            if str(data.get('generator')).replace('-', '_') not in GENERATORS:
+                raise ValueError('unknown generator {!r}'.format(data.get('generator')))
+        except (ValueError, AttributeError) as e:
+            response = {'status': 2, 'stdout': '', 'stderr': 'Invalid request: {}\n'.format(e), 'outputs': []}
+        else:
+            response = self.server.submit(data)
+        try:
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client is gone, but the outputs are written all the same
+            pass
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A server running requests in a pool of `jobs` worker processes."""
+
+    daemon_threads = True
+
+    def __init__(self, path, jobs=None):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.pool = ProcessPoolExecutor(max_workers=jobs, initializer=_preload)
+        super(Server, self).__init__(path, _Handler)
+
+    def server_bind(self):
+        # Created without access for other users, who could otherwise
+        # connect before the permissions are changed
+        umask = os.umask(0o077)
+        try:
+            super(Server, self).server_bind()
+        finally:
+            os.umask(umask)
+
+    def submit(self, data):
+        pool = self.pool
+        try:
+            return pool.submit(run, data).result()
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for running out of memory, which
+            # breaks the whole pool
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = ProcessPoolExecutor(max_workers=self.jobs, initializer=_preload)
+            return {'status': 1, 'stdout': '', 'stderr': 'The worker process died\n', 'outputs': []}
+
+    def server_close(self):
+        super(Server, self).server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+
+def _claim(path):
+    # Remove a stale socket, left by a server that did not shut down cleanly
+    if not os.path.lexists(path):
+        return
+    if not _owned(path):
+        raise ValueError('{} exists, and is not a socket owned by this user'.format(path))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise ValueError('A server is already running at {}'.format(path))
+
+
+def serve(path=None, jobs=None):
+    """Serve requests at `path` (default: socket_path()) until interrupted
+    or terminated.
+    """
+    path = path or socket_path()
+    # Imported before the workers are forked, which then start ready
+    _preload()
+    _claim(path)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    with Server(path, jobs) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
@@ -0,0 +1,40 @@
+"""Writing of output files.
+
+A mesh is only usable as a whole, so the files of a mesh are written to a
+temporary directory next to them, and moved into place, replacing those
+of an earlier run, only once all are written.  A run that fails leaves the
+outputs of the earlier run as they were.
+
+Output files may be hard links to files in the cache (see
+meshscripts.cache), so they are never written in place: open_output()
+creates a new file instead of truncating the old one.
+"""
+
+from contextlib import contextmanager
+import os
+import shutil
+import tempfile
+
+
+def open_output(fn, mode='w'):
+    """Open an output file for writing, as a new file."""
+    try:
+        os.unlink(fn)
+    except FileNotFoundError:
+        pass
+    return open(fn, mode)
+
+
+@contextmanager
+def staged(directory):
+    """Yield a temporary directory in `directory`.  On success, the files
+    written to it are moved to `directory`, and otherwise they are removed.
+    """
+    directory = directory or '.'
+    tmp = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+    try:
+        yield tmp
+        for fn in os.listdir(tmp):
+            os.replace(os.path.join(tmp, fn), os.path.join(directory, fn))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
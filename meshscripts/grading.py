@@ -0,0 +1,169 @@
+"""Geometric grading of element sizes.
+
+All functions accept scalars or NumPy arrays, which are broadcast against
+each other, so that many combinations of parameters can be solved at once.
+Scalar inputs give scalar outputs.
+
+The grading is described by the first element size, the growth factor
+between consecutive elements, the number of elements and the total length,
+related by
+
+    total = first * (1 + factor + factor^2 + ... + factor^(N-1)).
+"""
+
+from collections import namedtuple
+
+from meshscripts.lazy import lazy_import
+
+
+np = lazy_import('numpy')
+
+
+FactorInfo = namedtuple('FactorInfo', ['residual', 'iterations', 'converged'])
+
+
+def _scalar(*args):
+    return all(np.ndim(arg) == 0 for arg in args)
+
+
+def _unwrap(value, scalar):
+    return value[()] if scalar else value
+
+
+def _check(condition, message):
+    if not np.all(condition):
+        raise ValueError(message)
+
+
+def _series(factor, N):
+    """Return the sum of factor^k for k < N and its derivative with respect
+    to factor, with care taken near factor = 1.
+    """
+    near = np.abs(factor - 1) < 1e-8
+    safe = np.where(near, 2.0, factor)
+    power = safe ** N
+    total = (power - 1) / (safe - 1)
+    deriv = (N * power / safe * (safe - 1) - (power - 1)) / (safe - 1) ** 2
+
+    delta = factor - 1
+    total = np.where(near, N + N * (N - 1) / 2 * delta, total)
+    deriv = np.where(near, N * (N - 1) / 2 + N * (N - 1) * (N - 2) / 3 * delta, deriv)
+    return total, deriv
+
+
+def graded_space(start, step, factor, N):
+    """Return N points, starting at `start`, where the distance between
+    consecutive points starts at `step` and grows by `factor`.
+
+    With array arguments, the points run along a new last axis.
+    """
+    scalar = _scalar(start, step, factor)
+    start, step, factor = np.broadcast_arrays(
+        *(np.asarray(arg, dtype=float) for arg in (start, step, factor))
+    )
+
+    # Accumulate the steps the same way a running sum would, so that the
+    # result is identical to adding one step at a time
+    terms = np.empty(start.shape + (N,))
+    if N > 0:
+        terms[..., 0] = start
+    if N > 1:
+        terms[..., 1] = step
+        terms[..., 2:] = factor[..., np.newaxis]
+        terms[..., 1:] = np.multiply.accumulate(terms[..., 1:], axis=-1)
+    points = np.add.accumulate(terms, axis=-1)
+    return list(points) if scalar else points
+
+
+def find_factor(initial, total, N, tol=1e-7, maxiter=100, full_output=False):
+    """Find the grading factor such that N elements starting with size
+    `initial` have a combined length of `total`.
+
+    Newton's method is started from an upper bound of the solution.  Since
+    the length is an increasing, convex function of the factor, the
+    iterates then decrease monotonically towards the solution, so
+    convergence is guaranteed.  Iteration stops when the length is within
+    `tol` of `total` for all inputs.
+
+    If `full_output` is true, also returns a FactorInfo with the residual,
+    the number of iterations and which inputs converged.
+    """
+    scalar = _scalar(initial, total, N)
+    initial, total = np.asarray(initial, dtype=float), np.asarray(total, dtype=float)
+    N = np.asarray(N)
+
+    _check(initial > 0, 'Initial element size must be positive')
+    _check(N >= 2, 'At least two elements are needed to find a grading factor')
+    _check(total > initial, 'Total length must exceed the initial element size')
+
+    # The last element alone has length initial * factor^(N-1), so this
+    # factor always gives a total that is too long
+    factor = (total / initial) ** (1 / (N - 1))
+    factor = np.broadcast_to(factor, np.broadcast(initial, total, N).shape).copy()
+
+    iterations = 0
+    while True:
+        series, deriv = _series(factor, N)
+        residual = initial * series - total
+        converged = np.abs(residual) < tol
+        if np.all(converged) or iterations == maxiter:
+            break
+        update = np.where(converged, factor, factor - residual / (initial * deriv))
+        if np.array_equal(update, factor):
+            # No further progress is possible in floating point
+            break
+        factor = update
+        iterations += 1
+
+    factor = _unwrap(factor, scalar)
+    if full_output:
+        info = FactorInfo(_unwrap(residual, scalar), iterations, _unwrap(converged, scalar))
+        return factor, info
+    return factor
+
+
+def first_size(total, factor, N):
+    """Return the size of the first of N elements graded by `factor` that
+    together have length `total`.
+    """
+    scalar = _scalar(total, factor, N)
+    total, factor = np.asarray(total, dtype=float), np.asarray(factor, dtype=float)
+    _check(factor > 0, 'Grading factor must be positive')
+    _check(np.asarray(N) >= 1, 'Number of elements must be positive')
+
+    near = np.abs(factor - 1) < 1e-8
+    safe = np.where(near, 2.0, factor)
+    size = np.where(near, total / N, (1 - safe) / (1 - safe ** N) * total)
+    return _unwrap(size, scalar)
+
+
+def num_elements(first, total, factor):
+    """Return the number of elements, starting with size `first` and graded
+    by `factor`, needed to cover at least the length `total`, up to a
+    relative tolerance of 1e-8.
+    """
+    scalar = _scalar(first, total, factor)
+    first, total, factor = (np.asarray(arg, dtype=float) for arg in (first, total, factor))
+    _check(first > 0, 'Initial element size must be positive')
+    _check(total > 0, 'Total length must be positive')
+    _check(factor > 0, 'Grading factor must be positive')
+
+    # With factor < 1 the elements shrink, and their combined length is
+    # bounded by first / (1 - factor)
+    arg = 1 - 1/first * (1 - factor) * total
+    _check(arg > 0, 'Elements graded by factor < 1 can not cover the total length')
+
+    # Near factor = 1, the logarithms lose their precision, so use the
+    # expansion of the count in factor - 1 instead
+    near = np.abs(factor - 1) < 1e-8
+    ratio = total / first
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nel = np.where(
+            near, ratio - (factor - 1) * ratio * (ratio - 1) / 2,
+            np.log(arg) / np.log(np.where(near, 2.0, factor)),
+        )
+
+    # Lengths within a relative 1e-8 of the total count as covering it, so
+    # that the count does not jump as the factor passes 1
+    nel = np.ceil(nel * (1 - 1e-8)).astype(int)
+    return int(nel) if scalar else nel
@@ -0,0 +1,132 @@
+"""Hierarchies of nested meshes.
+
+Level 0 is the mesh as built, lowered to the output order.  Each further
+level splits every element of the previous one in two in each direction,
+by knot insertion.  Knot insertion does not change the geometry, and
+connected patches have matching knot vectors, so all levels are nested and
+conforming, with the same topology and partitioning.  Note that the finer
+levels are not the meshes an independent run with more elements would
+give: the geometry and grading are those of level 0.
+
+The prolongation from one level to the next is, for each patch, the
+tensor product of one matrix per parametric direction, mapping the
+coefficients of the coarse basis to those of the fine basis (for rational
+patches, the homogeneous coefficients).  The matrices are written to
+'<out>-<level>.npz' as CSR arrays named 'p<patch>d<direction>_data',
+'..._indices', '..._indptr' and '..._shape', with patches numbered from 1
+as in the .xinp file and directions from 0.  With the control points of a
+patch flattened in splipy's array order, its prolongation is the Kronecker
+product of the matrices in order of direction.
+"""
+
+from meshscripts.files import open_output
+from meshscripts.lazy import lazy_import
+from meshscripts.profile import stage
+
+
+np = lazy_import('numpy')
+sparse = lazy_import('scipy.sparse')
+splipy = lazy_import('splipy')
+
+
+def level_name(out, level):
+    """Return the output name of a level."""
+    return '{}-{}'.format(out, level)
+
+
+def prolongation(basis, factor=2):
+    """Return the basis with every knot span split into `factor`, and the
+    matrix, as a CSR matrix, mapping coefficients in the basis to
+    coefficients in the refined basis.
+    """
+    if basis.periodic > -1:
+        # Knot insertion is linear in the control points, so inserting into
+        # the identity gives the matrix
+        curve = splipy.Curve(basis, np.eye(basis.num_functions()), raw=True)
+        curve.refine(factor - 1)
+        return curve.bases[0], sparse.csr_matrix(curve.controlpoints)
+
+    spans = basis.knot_spans()
+    knots = np.sort(np.concatenate([basis.knots] + [
+        np.linspace(a, b, factor + 1)[1:-1] for a, b in zip(spans[:-1], spans[1:])
+    ]))
+    fine = splipy.BSplineBasis(basis.order, knots)
+
+    # The Oslo algorithm: row j holds the discrete B-splines at j, which
+    # are the coarse B-splines blossomed at the fine knots j+1, ..., j+p,
+    # computed for all rows at once by the usual recursion
+    tau, p, n = basis.knots, basis.order - 1, basis.num_functions()
+    m = fine.num_functions()
+    rows = np.arange(m)
+    mu = np.minimum(np.searchsorted(tau, knots[:m], side='right') - 1, n - 1)
+    values = np.ones((m, 1))
+    for r in range(1, p + 1):
+        x = knots[rows + r, np.newaxis]
+        i = mu[:, np.newaxis] + np.arange(1 - r, 1)
+        lower, upper = tau[i], tau[i + r]
+        support = upper > lower
+        w = np.divide(x - lower, upper - lower, out=np.zeros(i.shape), where=support)
+        result = np.zeros((m, r + 1))
+        result[:, 1:] += values * w
+        result[:, :-1] += values * (1 - w) * support
+        values = result
+    columns = mu[:, np.newaxis] + np.arange(-p, 1)
+    matrix = sparse.csr_matrix(
+        (values.ravel(), columns.ravel(), np.arange(0, m * (p + 1) + 1, p + 1)), shape=(m, n)
+    )
+    matrix.eliminate_zeros()
+    return fine, matrix
+
+
+def refine(patch, factor=2):
+    """Return a copy of a patch with every knot span split into `factor`,
+    like SplineObject.refine(factor - 1), by applying the prolongations.
+    """
+    bases, cps = [], patch.controlpoints
+    for d, basis in enumerate(patch.bases):
+        fine, matrix = prolongation(basis, factor)
+        bases.append(fine)
+        rhs = np.moveaxis(cps, d, 0)
+        shape = rhs.shape
+        cps = matrix @ rhs.reshape(shape[0], -1)
+        cps = np.moveaxis(cps.reshape((-1,) + shape[1:]), 0, d)
+    return type(patch)(*bases, controlpoints=cps, rational=patch.rational, raw=True)
+
+
+def write_prolongation(fn, patches, factor=2):
+    """Write the prolongation from the patches to the patches refined by
+    `factor` to fn.npz.
+    """
+    arrays = {}
+    for i, patch in enumerate(patches.values(), 1):
+        for d, basis in enumerate(patch.bases):
+            _, matrix = prolongation(basis, factor)
+            key = 'p{}d{}_'.format(i, d)
+            arrays[key + 'data'] = matrix.data
+            arrays[key + 'indices'] = matrix.indices
+            arrays[key + 'indptr'] = matrix.indptr
+            arrays[key + 'shape'] = np.array(matrix.shape)
+    with open_output(fn + '.npz', 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def write_hierarchy(patches, out, levels=1, prolongations=False, order=4, **kwargs):
+    """Write `levels` nested levels of the patches as <out>-0, <out>-1 and
+    so on, coarsest first, and the prolongations between them if asked to.
+    A single level is written as <out>, like PatchDict.write.  The other
+    keyword arguments are passed on to PatchDict.write.
+    """
+    if levels == 1:
+        patches.write(out, order=order, **kwargs)
+        return
+
+    # Lower first, since lowering and refinement do not commute
+    level = patches.lowered(order)
+    level.write(level_name(out, 0), order=order, **kwargs)
+    for k in range(1, levels):
+        coarse, level = level, level.refined()
+        if prolongations:
+            with stage('prolongation'):
+                write_prolongation(level_name(out, k), coarse)
+        del coarse
+        level.write(level_name(out, k), order=order, **kwargs)
@@ -0,0 +1,289 @@
+"""Automatic detection of patch interfaces.
+
+Boundaries are numbered as in the .xinp files: boundary 2*d + 1 of a patch
+is where parametric direction d is minimal, and 2*d + 2 where it is
+maximal.  Two boundaries are connected if their control points and
+(normalized) knot vectors coincide, possibly after reversing or swapping
+their directions.
+
+Each boundary is hashed on the quantized centroid of its control points,
+which does not depend on orientation, so candidate partners are found by a
+dictionary lookup instead of by comparing all pairs of boundaries.
+Periodic pairs are found in the same way, by looking up the centroid of a
+boundary translated by one of the given periods.
+
+The orientation of an interface is a number whose bit 0 is set if the
+first direction of the slave boundary runs opposite to that of the master,
+bit 1 likewise for the second direction (faces only), and bit 2 if the two
+directions are swapped.  For edges, this is 1 exactly for the connections
+flagged as reversed in .xinp files.
+
+Run this module as a script to check the connections of a .xinp file
+against those detected from its patches.
+"""
+
+from collections import namedtuple
+import itertools
+import os
+import sys
+
+import click
+
+from meshscripts.compression import open_input
+from meshscripts.io import patch_reader
+from meshscripts.lazy import lazy_import
+
+
+etree = lazy_import('lxml.etree')
+np = lazy_import('numpy')
+
+
+Interface = namedtuple('Interface', ['master', 'midx', 'slave', 'sidx', 'orient', 'periodic'])
+
+# Default tolerance, relative to the largest coordinate
+RTOL = 1e-8
+
+_Boundary = namedtuple('_Boundary', ['name', 'index', 'points', 'knots', 'centroid'])
+
+
+def _points(patch):
+    # Euclidean control points, followed by the weights for rational patches
+    cps = patch.controlpoints
+    if patch.rational:
+        return np.concatenate([cps[..., :-1] / cps[..., -1:], cps[..., -1:]], axis=-1)
+    return cps
+
+
+def _normalize(knots):
+    knots = np.asarray(knots, dtype=float)
+    return (knots - knots[0]) / (knots[-1] - knots[0])
+
+
+def _boundaries(name, patch):
+    points = _points(patch)
+    knots = [_normalize(b.knots) for b in patch.bases]
+    for axis in range(patch.pardim):
+        for end in (0, 1):
+            pts = np.take(points, -end, axis=axis)
+            geometry = pts[..., :patch.dimension].reshape(-1, patch.dimension)
+            yield _Boundary(
+                name, 2*axis + end + 1, pts,
+                [k for d, k in enumerate(knots) if d != axis],
+                geometry.mean(axis=0),
+            )
+
+
+def _orientations(boundary):
+    return [[0], [0, 1], range(8)][len(boundary.knots)]
+
+
+def _transform(boundary, orient):
+    pts, knots = boundary.points, list(boundary.knots)
+    if orient & 4:
+        pts, knots = pts.swapaxes(0, 1), knots[::-1]
+    for axis in range(len(knots)):
+        if orient & (1 << axis):
+            pts = np.flip(pts, axis)
+            knots[axis] = 1 - knots[axis][::-1]
+    return pts, knots
+
+
+def _orientation(master, slave, tol, shift=None):
+    """Return the orientation in which the slave boundary coincides with the
+    master, translated by shift, or None if it does not.
+    """
+    target = master.points
+    if shift is not None:
+        target = target.copy()
+        target[..., :len(shift)] += shift
+    for orient in _orientations(master):
+        pts, knots = _transform(slave, orient)
+        if pts.shape != target.shape:
+            continue
+        if any(len(a) != len(b) or not np.allclose(a, b, rtol=0, atol=1e-10)
+               for a, b in zip(knots, master.knots)):
+            continue
+        if np.allclose(pts, target, rtol=0, atol=tol):
+            return orient
+    return None
+
+
+def inverse(orient):
+    """Return the orientation of an interface with master and slave swapped."""
+    if orient & 4:
+        return 4 | (orient & 1) << 1 | (orient & 2) >> 1
+    return orient
+
+
+class _Index(object):
+    """Boundaries hashed on their centroid, quantized to the tolerance."""
+
+    def __init__(self, tol):
+        self.tol = tol
+        self.cells = {}
+
+    def _cell(self, x):
+        return tuple(np.floor(np.asarray(x) / self.tol).astype(int).tolist())
+
+    def add(self, i, x):
+        self.cells.setdefault(self._cell(x), []).append(i)
+
+    def remove(self, i, x):
+        self.cells[self._cell(x)].remove(i)
+
+    def candidates(self, x):
+        """Return the boundaries with centroid within the tolerance of x
+        (and possibly some further away).
+        """
+        cell = self._cell(x)
+        for offset in itertools.product((-1, 0, 1), repeat=len(cell)):
+            yield from self.cells.get(tuple(c + o for c, o in zip(cell, offset)), ())
+
+
+def find_interfaces(patches, tol=None, periods=()):
+    """Return the interfaces between the given patches, as a list of
+    Interface tuples.
+
+    The patches are given as a mapping from names to patches, or as a
+    list, in which case they are named by their 1-based position.  The
+    tolerance defaults to RTOL times the largest coordinate.  Boundaries
+    coinciding after translation by one of the periods are returned as
+    periodic interfaces, as are boundaries of a patch that coincide with
+    another boundary of the same patch.
+    """
+    items = list(patches.items()) if hasattr(patches, 'items') else list(enumerate(patches, 1))
+    if tol is None:
+        scale = max((np.abs(_points(p)[..., :p.dimension]).max() for _, p in items), default=0.0)
+        tol = RTOL * (scale or 1.0)
+
+    # Collapsed boundaries (points of degenerate patches) are never connected
+    bounds = [
+        b for name, patch in items for b in _boundaries(name, patch)
+        if np.ptp(b.points[..., :len(b.centroid)].reshape(-1, len(b.centroid)), axis=0).max() > tol
+    ]
+
+    interfaces = []
+    index = _Index(tol)
+    unmatched = {}
+    for i, b in enumerate(bounds):
+        for j in index.candidates(b.centroid):
+            orient = _orientation(bounds[j], b, tol)
+            if orient is not None:
+                master = bounds[j]
+                interfaces.append(Interface(master.name, master.index, b.name, b.index,
+                                            orient, master.name == b.name))
+                index.remove(j, master.centroid)
+                del unmatched[j]
+                break
+        else:
+            index.add(i, b.centroid)
+            unmatched[i] = None
+
+    for period in periods:
+        period = np.asarray(period, dtype=float)
+        for i in list(unmatched):
+            if i not in unmatched:
+                continue
+            b = bounds[i]
+            shift = period[:len(b.centroid)]
+            for j in index.candidates(b.centroid + shift):
+                if j == i:
+                    continue
+                orient = _orientation(b, bounds[j], tol, shift)
+                if orient is not None:
+                    slave = bounds[j]
+                    interfaces.append(Interface(b.name, b.index, slave.name, slave.index,
+                                                orient, True))
+                    for k in (i, j):
+                        index.remove(k, bounds[k].centroid)
+                        del unmatched[k]
+                    break
+
+    return interfaces
+
+
+def _key(iface):
+    a, b = (iface.master, iface.midx), (iface.slave, iface.sidx)
+    orient = iface.orient
+    if b < a:
+        a, b, orient = b, a, inverse(orient)
+    return (a, b), (orient, bool(iface.periodic))
+
+
+def compare(table, detected):
+    """Compare a table of interfaces against detected ones.  Returns the
+    lists of detected interfaces missing from the table, of interfaces in
+    the table that were not detected, and of pairs (table, detected) of
+    interfaces between the same boundaries with different orientation or
+    periodicity.
+    """
+    table = {_key(iface)[0]: iface for iface in table}
+    detected = {_key(iface)[0]: iface for iface in detected}
+    missing = [iface for key, iface in detected.items() if key not in table]
+    extra = [iface for key, iface in table.items() if key not in detected]
+    wrong = [
+        (iface, detected[key]) for key, iface in table.items()
+        if key in detected and _key(iface)[1] != _key(detected[key])[1]
+    ]
+    return missing, extra, wrong
+
+
+def read_xinp(fn):
+    """Return the patch file name and the interfaces of a .xinp file, which
+    may be compressed.  The patch file name is relative to the directory of
+    the .xinp file.
+    """
+    with open_input(fn) as f:
+        root = etree.parse(f).getroot()
+    patchfile = os.path.join(os.path.dirname(fn), root.findtext('patchfile').strip())
+    interfaces = []
+    for conn in root.iterfind('topology/connection'):
+        orient = int(conn.get('orient', 1 if conn.get('reverse') == 'true' else 0))
+        interfaces.append(Interface(
+            int(conn.get('master')), int(conn.get('midx')),
+            int(conn.get('slave')), int(conn.get('sidx')),
+            orient, conn.get('periodic') == 'true',
+        ))
+    for per in root.iterfind('topology/periodic'):
+        patch, direction = int(per.get('patch')), int(per.get('dir'))
+        interfaces.append(Interface(patch, 2*direction - 1, patch, 2*direction, 0, True))
+    return patchfile, interfaces
+
+
+def _format(iface):
+    return '{}:{} - {}:{} orient {}{}'.format(
+        iface.master, iface.midx, iface.slave, iface.sidx, iface.orient,
+        ' periodic' if iface.periodic else '',
+    )
+
+
+@click.command()
+@click.argument('xinp', type=click.Path(exists=True, dir_okay=False))
+@click.option('--period', 'periods', type=(float, float, float), multiple=True,
+              help='Translation between periodic boundaries')
+@click.option('--tol', type=float, default=None, help='Absolute tolerance')
+def check(xinp, periods, tol):
+    """Check the connections of a .xinp file against those detected from its
+    patches.
+
+    Exits with status 1 if they differ.
+    """
+    patchfile, table = read_xinp(xinp)
+    with patch_reader(patchfile) as f:
+        patches = f.read()
+
+    missing, extra, wrong = compare(table, find_interfaces(patches, tol, periods))
+    for iface in missing:
+        print('missing: ' + _format(iface))
+    for iface in extra:
+        print('not detected: ' + _format(iface))
+    for iface, found in wrong:
+        print('mismatch: {} (detected {})'.format(_format(iface), _format(found)))
+
+    if missing or extra or wrong:
+        sys.exit(1)
+    print('{} connections agree'.format(len(table)))
+
+
+if __name__ == '__main__':
+    check()
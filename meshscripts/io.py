@@ -0,0 +1,232 @@
+"""Readers and writers for the patch files referenced from .xinp files.
+
+G2 files are written with an index next to them, '<patchfile>.index.json',
+so that single patches can be read without parsing the whole file.  The
+index holds, for each patch in the order of the file, its 'names' (or
+null), the byte 'offsets' and 'lengths' of its text, its 'orders' and its
+number of 'controlpoints', as one list per field.  In compressed G2 files
+(see meshscripts.compression), each patch is a member of its own, and the
+offsets and lengths are those of the members, in the file as written.  The
+index names the 'compression' of the file, or null.  Binary patch files
+have an index of their own (see meshscripts.binary).
+
+read_patches() reads patches from either kind of file, given by their
+numbers, from 1 as in the .xinp file, or by their names.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import os
+
+from meshscripts.binary import BinaryReader, BinaryWriter, EXTENSION as BINARY_EXTENSION
+from meshscripts.compression import (
+    COMPRESSIONS, CompressedWriter, compression_of, decompress, open_input,
+)
+from meshscripts.files import open_output
+from meshscripts.lazy import lazy_import
+
+
+np = lazy_import('numpy')
+splipy = lazy_import('splipy')
+g2 = lazy_import('splipy.io.g2')
+
+
+# Patch file formats, with their file extensions
+FORMATS = {
+    'g2': '.g2',
+    'binary': BINARY_EXTENSION,
+}
+
+INDEX_EXTENSION = '.index.json'
+
+# The parametric dimensions of the G2 object types
+PARDIMS = {100: 1, 200: 2, 700: 3}
+
+
+def patch_filename(fn, fmt='g2', compression=None):
+    """Return the name of the patch file with base name `fn` in the given
+    format and compression.
+    """
+    return fn + FORMATS[fmt] + (COMPRESSIONS[compression] if compression else '')
+
+
+def patch_writer(fn, fmt='g2', compression=None, level=None):
+    """Return a writer for the patch file with base name `fn` in the given
+    format, compressed at the given level if asked to.  The writer is a
+    context manager with a write method that accepts a patch or a list of
+    patches, and optionally the name of the patch.
+    """
+    if fmt == 'g2':
+        return G2Writer(patch_filename(fn, fmt, compression), compression, level)
+    if fmt == 'binary':
+        if compression:
+            raise ValueError('Binary patch files can not be compressed')
+        return BinaryWriter(fn + FORMATS['binary'])
+    raise ValueError('Unknown patch file format: {}'.format(fmt))
+
+
+def patch_reader(fn):
+    """Return a reader for the patch file `fn`, in the format and
+    compression given by its extension.  The reader is a context manager
+    with a read method that returns a list of patches.
+    """
+    if fn.endswith(FORMATS['binary']):
+        return BinaryReader(fn)
+    reader = g2.G2(fn)
+    if compression_of(fn):
+        reader.fstream = io.TextIOWrapper(open_input(fn), encoding='ascii')
+        reader.onlywrite = False
+    return reader
+
+
+def read_patches(fn, ids, jobs=None):
+    """Return the patches of the patch file `fn` with the given numbers,
+    from 1, or names, in that order.  G2 files are read through their
+    index, with up to `jobs` reads at a time.
+    """
+    if fn.endswith(FORMATS['binary']):
+        with BinaryReader(fn) as f:
+            names = _positions(entry.get('name') for entry in f.index)
+            return [f.patch(find_patch(names, len(f), id)) for id in ids]
+    with IndexedG2Reader(fn) as f:
+        return f.patches(ids, jobs=jobs)
+
+
+def _positions(names):
+    # The positions of the named patches in a patch file
+    return {name: i for i, name in enumerate(names) if name is not None}
+
+
+def find_patch(positions, count, id):
+    """Return the position of a patch in a patch file of `count` patches,
+    given its number, from 1, or its name, and the positions of the named
+    patches.
+    """
+    if isinstance(id, str):
+        try:
+            return positions[id]
+        except KeyError:
+            raise KeyError('No patch named {}'.format(id)) from None
+    if not 1 <= id <= count:
+        raise KeyError('No patch number {}'.format(id))
+    return id - 1
+
+
+class G2Writer(object):
+    """Write patches to a G2 file with splipy, compressed at the given level
+    if asked to, and their index when the file is closed.
+    """
+
+    def __init__(self, filename, compression=None, level=None):
+        self.filename = filename
+        self.compression = compression
+        self.level = level
+        self.index = {
+            'names': [], 'offsets': [], 'lengths': [], 'orders': [], 'controlpoints': [],
+            'compression': compression,
+        }
+        # Futures of the offsets and lengths of compressed patches
+        self.members = []
+
+    def __enter__(self):
+        if self.compression:
+            self.fstream = CompressedWriter(self.filename, self.compression, self.level,
+                                            chunk=None).__enter__()
+        else:
+            self.fstream = open_output(self.filename)
+        self.writer = g2.G2(self.filename)
+        self.writer.fstream, self.writer.onlywrite = self.fstream, True
+        return self
+
+    def write(self, obj, name=None):
+        if isinstance(obj, (list, tuple)):
+            for o in obj:
+                self.write(o)
+            return
+
+        if self.compression:
+            self.writer.write(obj)
+            self.members.append(self.fstream.end_member())
+        else:
+            # Only ASCII is written, so positions are byte offsets
+            offset = self.fstream.tell()
+            self.writer.write(obj)
+            self.index['offsets'].append(offset)
+            self.index['lengths'].append(self.fstream.tell() - offset)
+        self.index['names'].append(name)
+        self.index['orders'].append(list(obj.order()))
+        self.index['controlpoints'].append(int(np.prod(obj.shape)))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.compression:
+            self.fstream.__exit__(exc_type, exc_value, traceback)
+        else:
+            self.fstream.close()
+        if exc_type is not None:
+            return
+        for member in self.members:
+            offset, length = member.result()
+            self.index['offsets'].append(offset)
+            self.index['lengths'].append(length)
+        with open_output(self.filename + INDEX_EXTENSION) as f:
+            json.dump(self.index, f)
+
+
+def parse_patch(text):
+    """Return the spline object written as `text` in a G2 file."""
+    values = np.fromstring(text, sep=' ')
+    pardim, dimension, rational = PARDIMS[int(values[0])], int(values[4]), bool(values[5])
+    pos, bases = 6, []
+    for _ in range(pardim):
+        n, order = int(values[pos]), int(values[pos + 1])
+        bases.append(splipy.BSplineBasis(order, values[pos + 2:pos + 2 + n + order], -1))
+        pos += 2 + n + order
+    cps = values[pos:].reshape(-1, dimension + rational)
+    return g2.G2.classes[pardim - 1](*bases, controlpoints=cps, rational=rational)
+
+
+class IndexedG2Reader(object):
+    """Read single patches from a G2 file, through its index."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename + INDEX_EXTENSION) as f:
+            self.index = json.load(f)
+        self.positions = _positions(self.index['names'])
+
+    def __enter__(self):
+        self.fd = os.open(self.filename, os.O_RDONLY)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.close(self.fd)
+
+    def __len__(self):
+        return len(self.index['offsets'])
+
+    def find(self, id):
+        """Return the position of the patch with the given number, from 1,
+        or name.
+        """
+        return find_patch(self.positions, len(self), id)
+
+    def patch(self, i):
+        """Return the patch at position i."""
+        data = os.pread(self.fd, self.index['lengths'][i], self.index['offsets'][i])
+        if self.index.get('compression'):
+            data = decompress(data, self.index['compression'])
+        return parse_patch(data.decode('ascii'))
+
+    def patches(self, ids, jobs=None):
+        """Return the patches with the given numbers, from 1, or names, with
+        up to `jobs` reads at a time.
+        """
+        positions = [self.find(id) for id in ids]
+        if len(positions) < 2:
+            return [self.patch(i) for i in positions]
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(self.patch, positions))
+
+    def read(self):
+        return [self.patch(i) for i in range(len(self))]
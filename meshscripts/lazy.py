@@ -0,0 +1,57 @@
+"""Lazy imports of heavy dependencies.
+
+Importing numpy, scipy and splipy takes far longer than parsing options,
+so modules import them with lazy_import(), and the import only happens
+when a module attribute is first used.  Printing help or rejecting bad
+options then stays quick, and the generators can be imported as a library
+without paying for their dependencies up front.
+"""
+
+import importlib
+
+
+# The modules returned by lazy_import() so far
+_modules = []
+
+
+class _LazyModule(object):
+
+    def __init__(self, name, optional=False):
+        self.__name = name
+        self.__optional = optional
+
+    def __getattr__(self, attr):
+        # Only called for attributes not copied here yet
+        module = importlib.import_module(self.__name)
+        value = getattr(module, attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self.__name)
+
+    def _load(self):
+        try:
+            importlib.import_module(self.__name)
+        except ImportError:
+            if not self.__optional:
+                raise
+
+
+def lazy_import(name, optional=False):
+    """Return a stand-in for the module `name`, which imports it when one
+    of its attributes is first used.  Submodules are imported with the
+    usual machinery, so their parent packages are imported then as well.
+    Optional modules may be missing, which import_all() then ignores.
+    """
+    module = _LazyModule(name, optional)
+    _modules.append(module)
+    return module
+
+
+def import_all():
+    """Import the modules returned by lazy_import() so far, except
+    optional ones that are not installed.
+    """
+    for module in _modules:
+        module._load()
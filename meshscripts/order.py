@@ -0,0 +1,43 @@
+"""Change of polynomial order of spline objects.
+
+Generators that build their patches at the target order, instead of
+lowering finished cubic patches, convert their input curves with
+to_order().  Since ruled and Coons patches blend their edge curves
+linearly, patches built from lowered curves equal the lowered patches, up
+to rounding.
+"""
+
+from meshscripts.lazy import lazy_import
+
+
+np = lazy_import('numpy')
+spla = lazy_import('scipy.sparse.linalg')
+
+
+def to_order(obj, *orders):
+    """Return a copy of a spline object with the given orders, one for all
+    directions or one for each.  Raising is exact.  Lowering interpolates
+    at the Greville points of the lowered basis, like
+    SplineObject.lower_order, but with sparse matrices instead of dense
+    inverses.
+    """
+    if len(orders) == 1:
+        orders = orders * obj.pardim
+    obj = obj.clone()
+    raises = [max(p - q, 0) for p, q in zip(orders, obj.order())]
+    if any(raises):
+        obj.raise_order(*raises)
+
+    bases, cps = list(obj.bases), obj.controlpoints
+    for d, (basis, p) in enumerate(zip(obj.bases, orders)):
+        if basis.order <= p:
+            continue
+        bases[d] = basis.lower_order(basis.order - p)
+        pts = bases[d].greville()
+        rhs = np.moveaxis(cps, d, 0)
+        shape = rhs.shape
+        rhs = basis.evaluate(pts, sparse=True) @ rhs.reshape(shape[0], -1)
+        cps = spla.spsolve(bases[d].evaluate(pts, sparse=True).tocsc(), rhs)
+        cps = np.moveaxis(cps.reshape((-1,) + shape[1:]), 0, d)
+
+    return type(obj)(*bases, controlpoints=cps, rational=obj.rational, raw=True)
@@ -0,0 +1,139 @@
+"""Load balancing of patches over parallel processes.
+
+IFEM assigns each MPI rank a contiguous range of patches.  Patches are
+therefore ordered so that neighbours are close in the order, and the order
+is cut into ranges of balanced work, where the work of a patch is its
+number of elements.  PatchDict.partition splits large patches until the
+ranges are balanced.
+"""
+
+from collections import deque, namedtuple
+import heapq
+import itertools
+
+from meshscripts.lazy import lazy_import
+
+
+np = lazy_import('numpy')
+
+
+Statistics = namedtuple('Statistics', ['elements', 'dofs', 'interfaces', 'cut'])
+
+
+def elements(patch):
+    """Return the number of elements of a patch."""
+    return int(np.prod([len(patch.knots(d)) - 1 for d in range(patch.pardim)]))
+
+
+def dofs(patch, order=None):
+    """Return the number of degrees of freedom of a patch, or of the patch
+    lowered to the given order.
+    """
+    bases = patch.bases
+    if order is not None:
+        bases = [b.lower_order(b.order - order) if b.order > order else b for b in bases]
+    return int(np.prod([b.num_functions() for b in bases]))
+
+
+def _bfs(adjacency, start):
+    distance = {start: 0}
+    order = [start]
+    queue = deque([start])
+    while queue:
+        node = queue.popleft()
+        for neighbour in adjacency[node]:
+            if neighbour not in distance:
+                distance[neighbour] = distance[node] + 1
+                order.append(neighbour)
+                queue.append(neighbour)
+    return order, distance
+
+
+def ordering(adjacency):
+    """Return the nodes of a graph, given as a mapping from nodes to lists of
+    neighbours, in an order where neighbours are close.
+
+    Each connected component is traversed from a peripheral node, always
+    continuing with the node with the most neighbours already visited.
+    Unlike a breadth-first order, which runs in thin layers, this grows
+    compact regions, so that ranges of the order share few interfaces.
+    """
+    result, seen = [], set()
+    tick = itertools.count()
+    for node in adjacency:
+        if node in seen:
+            continue
+        # The node furthest away from any node is peripheral
+        order, distance = _bfs(adjacency, node)
+        start = max(order, key=lambda n: distance[n])
+
+        links = {}
+        heap = [(0, next(tick), start)]
+        while heap:
+            _, _, node = heapq.heappop(heap)
+            if node in seen:
+                continue
+            seen.add(node)
+            result.append(node)
+            for neighbour in adjacency[node]:
+                if neighbour not in seen:
+                    links[neighbour] = links.get(neighbour, 0) + 1
+                    heapq.heappush(heap, (-links[neighbour], next(tick), neighbour))
+    return result
+
+
+def linear_partition(weights, nparts):
+    """Cut a sequence of weights into nparts non-empty contiguous ranges,
+    minimizing the largest sum.  Returns the ranges as (start, stop) pairs.
+    """
+    if len(weights) < nparts:
+        raise ValueError('Can not divide {} patches over {} processes'.format(len(weights), nparts))
+
+    def cut(limit):
+        ranges, start, total = [], 0, 0
+        for i, w in enumerate(weights):
+            if i > start and total + w > limit:
+                ranges.append((start, i))
+                start, total = i, 0
+            total += w
+        ranges.append((start, len(weights)))
+        return ranges
+
+    # Binary search for the smallest feasible limit
+    lo, hi = max(weights), sum(weights)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if len(cut(mid)) <= nparts:
+            hi = mid
+        else:
+            lo = mid + 1
+    ranges = cut(lo)
+
+    # Fewer ranges may suffice, but every process needs a patch
+    while len(ranges) < nparts:
+        k = max(
+            (k for k, (start, stop) in enumerate(ranges) if stop - start > 1),
+            key=lambda k: sum(weights[ranges[k][0]:ranges[k][1]]),
+        )
+        start, stop = ranges[k]
+        cumsum = np.cumsum(weights[start:stop])
+        mid = start + 1 + int(np.argmin(np.abs(cumsum[:-1] - cumsum[-1] / 2)))
+        ranges[k:k+1] = [(start, mid), (mid, stop)]
+    return ranges
+
+
+def imbalance(loads):
+    """Return the largest load relative to the mean, minus one."""
+    return max(loads) / (sum(loads) / len(loads)) - 1
+
+
+def format_statistics(stats):
+    """Return a table of the work per process."""
+    lines = ['{:>8} {:>12} {:>12}'.format('process', 'elements', 'dofs')]
+    for rank, (nel, ndof) in enumerate(zip(stats.elements, stats.dofs)):
+        lines.append('{:>8} {:12d} {:12d}'.format(rank, nel, ndof))
+    lines.append('imbalance: {:.1%} elements, {:.1%} dofs'.format(
+        imbalance(stats.elements), imbalance(stats.dofs)
+    ))
+    lines.append('interfaces between processes: {} of {}'.format(stats.cut, stats.interfaces))
+    return '\n'.join(lines)
@@ -0,0 +1,138 @@
+"""Lightweight instrumentation of named stages.
+
+Generators mark their stages with the stage() context manager.  Unless
+profiling is enabled, stage() returns a shared no-op context manager, so
+the instrumentation costs next to nothing.
+
+For each stage, the profiler records the wall time, the CPU time of the
+process (all threads, excluding child processes), the change in resident
+memory and the peak resident memory at the end of the stage.  Results are
+written as JSON, with totals per stage name and all individual events, or
+in Chrome trace format, for viewing in chrome://tracing or Perfetto.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import click
+
+
+_NULL = nullcontext()
+_profiler = None
+
+FORMATS = ['json', 'chrome']
+
+
+def _rss():
+    """Return the current resident memory in bytes, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+
+    @contextmanager
+    def stage(self, name):
+        start, cpu, rss = time.perf_counter(), time.process_time(), _rss()
+        try:
+            yield
+        finally:
+            end_rss = _rss()
+            self.events.append({
+                'name': name,
+                'thread': threading.get_ident(),
+                'start': start - self.origin,
+                'wall': time.perf_counter() - start,
+                'cpu': time.process_time() - cpu,
+                'rss_delta': None if rss is None or end_rss is None else end_rss - rss,
+                'peak_rss': _peak_rss(),
+            })
+
+    def summary(self):
+        """Return the totals for each stage name, in order of first use."""
+        stages = OrderedDict()
+        for event in sorted(self.events, key=lambda e: e['start']):
+            total = stages.setdefault(event['name'], {
+                'count': 0, 'wall': 0.0, 'cpu': 0.0, 'rss_delta': 0, 'peak_rss': 0,
+            })
+            total['count'] += 1
+            total['wall'] += event['wall']
+            total['cpu'] += event['cpu']
+            total['rss_delta'] += event['rss_delta'] or 0
+            total['peak_rss'] = max(total['peak_rss'], event['peak_rss'])
+        return stages
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        return {
+            'traceEvents': [{
+                'name': event['name'],
+                'ph': 'X',
+                'ts': event['start'] * 1e6,
+                'dur': event['wall'] * 1e6,
+                'pid': pid,
+                'tid': event['thread'],
+                'args': {k: event[k] for k in ('cpu', 'rss_delta', 'peak_rss')},
+            } for event in self.events],
+            'displayTimeUnit': 'ms',
+        }
+
+    def dump(self, fn, fmt='json'):
+        if fmt == 'chrome':
+            data = self.chrome_trace()
+        else:
+            data = {'stages': self.summary(), 'events': self.events}
+        with open(fn, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+def stage(name):
+    """Context manager marking a named stage, if profiling is enabled."""
+    if _profiler is None:
+        return _NULL
+    return _profiler.stage(name)
+
+
+def profiled(func):
+    """Decorator for generator commands.  Adds --profile and
+    --profile-format options, and records the whole command as the stage
+    'total'.
+    """
+    @functools.wraps(func)
+    def wrapper(profile, profile_format, **kwargs):
+        global _profiler
+        if profile is None:
+            return func(**kwargs)
+
+        _profiler = profiler = Profiler()
+        try:
+            with profiler.stage('total'):
+                return func(**kwargs)
+        finally:
+            _profiler = None
+            profiler.dump(profile, profile_format)
+
+    wrapper = click.option('--profile-format', type=click.Choice(FORMATS), default='json')(wrapper)
+    wrapper = click.option('--profile', type=click.Path(dir_okay=False), default=None,
+                           help='Write per-stage timings to this file')(wrapper)
+    return wrapper
@@ -0,0 +1,115 @@
+"""Prediction of mesh sizes without building the mesh.
+
+Each generator has a sizing function, which takes the same parameters as
+the generator and returns Sizes: the number of elements in each
+parametric direction of each patch, and the order of the patches.  The
+element counts follow the same formulas as the generator, but no splines
+are built.  All parameters may be NumPy arrays, which are broadcast
+against each other, to size many meshes at once.
+
+DOFs are counted per patch, assuming single interior knots, so DOFs on
+interfaces between patches are counted once for each patch.
+"""
+
+from collections import OrderedDict, namedtuple
+import functools
+import inspect
+import sys
+
+import click
+
+from meshscripts.lazy import lazy_import
+
+
+np = lazy_import('numpy')
+
+
+Sizes = namedtuple('Sizes', ['patches', 'order', 'c0', 'info'])
+
+
+def patch_sizes(patches, order, c0=(), **info):
+    """Return Sizes with the element counts broadcast to a common shape.
+    Directions listed in c0, as (patch name, direction) pairs, have knots
+    of multiplicity order - 1 instead of single knots.
+    """
+    shape = np.broadcast_shapes(*(np.shape(n) for nels in patches.values() for n in nels))
+    patches = OrderedDict(
+        (name, tuple(np.broadcast_to(n, shape) for n in nels)) for name, nels in patches.items()
+    )
+    return Sizes(patches, order, set(c0), OrderedDict(info))
+
+
+def patch_dofs(nels, order, c0=()):
+    """Return the number of DOFs of a patch with the given numbers of
+    elements in each direction, of the given order (one for all
+    directions, or one for each).  Knots are single, except in the
+    directions listed in c0.  Empty patches have no DOFs.
+    """
+    orders = order if np.ndim(order) > 0 else [order] * len(nels)
+    dofs = np.prod([
+        (p - 1) * np.asarray(n) + 1 if d in c0 else np.asarray(n) + p - 1
+        for d, (n, p) in enumerate(zip(nels, orders))
+    ], axis=0)
+    return np.where(np.all([np.asarray(n) > 0 for n in nels], axis=0), dofs, 0)
+
+
+def patch_elements(nels):
+    """Return the number of elements of a patch."""
+    return np.prod(nels, axis=0)
+
+
+def _c0(sizes, name):
+    return [d for patch, d in sizes.c0 if patch == name]
+
+
+def total_elements(sizes):
+    return sum(patch_elements(nels) for nels in sizes.patches.values())
+
+
+def total_dofs(sizes):
+    return sum(
+        patch_dofs(nels, sizes.order, _c0(sizes, name)) for name, nels in sizes.patches.items()
+    )
+
+
+def format_sizes(sizes):
+    """Return a table of the sizes of a single mesh."""
+    lines = ['{:>8} {:>20} {:>12} {:>12}'.format('patch', 'per direction', 'elements', 'dofs')]
+    for name, nels in sizes.patches.items():
+        nels = [int(n) for n in nels]
+        if not all(nels):
+            continue
+        lines.append('{:>8} {:>20} {:12d} {:12d}'.format(
+            name, ' x '.join(str(n) for n in nels),
+            int(patch_elements(nels)), int(patch_dofs(nels, sizes.order, _c0(sizes, name))),
+        ))
+    lines.append('{:>8} {:>20} {:12d} {:12d}'.format(
+        'total', '', int(total_elements(sizes)), int(total_dofs(sizes))
+    ))
+    for name, value in sizes.info.items():
+        lines.append('{}: {:.6g}'.format(name, float(value)))
+    return '\n'.join(lines)
+
+
+def sized(size):
+    """Decorator for generator commands.  Adds a --dry-run option, which
+    prints the sizes given by the sizing function `size`, called with the
+    options it takes, instead of generating the mesh.
+    """
+    params = inspect.signature(size).parameters
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(dry_run, **kwargs):
+            if not dry_run:
+                return func(**kwargs)
+            try:
+                result = size(**{k: v for k, v in kwargs.items() if k in params})
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+            print(format_sizes(result))
+
+        return click.option('--dry-run', is_flag=True,
+                            help='Print the mesh size without generating the mesh')(wrapper)
+    return decorator
@@ -0,0 +1,166 @@
+"""Incremental regeneration of meshes.
+
+A generator is written as a graph of stages.  A stage is a function of
+explicit inputs: parameters, which must be JSON serializable, and the
+results of other stages.  Its result, typically splipy objects, i.e. their
+knots and control points, is memoized in the cache of meshscripts.cache.
+
+The key of a result is a hash of the stage name, the source of the
+generator and of this package, the versions of the libraries the results
+are pickled with, the parameters and the keys of the input results, so
+all keys are known before anything runs.  Results are computed, or loaded
+from the cache, only when their values are needed.  After a change of
+parameters, only the stages depending on them run again, and stages whose
+downstream results are all cached are not even loaded.
+
+Stage functions must not modify their inputs, since results are shared
+between stages.  Spline objects are passed to and from the worker
+processes of Stages.map() as their bases and control points, not pickled
+as objects.
+"""
+
+from collections import namedtuple
+from concurrent import futures
+import functools
+import hashlib
+import json
+
+from meshscripts.cache import _source_hash, library_versions
+from meshscripts.lazy import lazy_import
+from meshscripts.profile import stage
+
+
+np = lazy_import('numpy')
+splipy = lazy_import('splipy')
+
+
+_MISSING = object()
+
+_source = functools.lru_cache(maxsize=None)(_source_hash)
+
+
+_Spline = namedtuple('_Spline', ['cls', 'bases', 'controlpoints', 'rational'])
+
+
+def _pack(value):
+    if isinstance(value, splipy.SplineObject):
+        return _Spline(type(value), value.bases, value.controlpoints, value.rational)
+    return value
+
+
+def _unpack(value):
+    if isinstance(value, _Spline):
+        return value.cls(*value.bases, controlpoints=value.controlpoints,
+                         rational=value.rational, raw=True)
+    return value
+
+
+def _call_packed(func, *args):
+    # Runs in a worker process
+    return _pack(func(*map(_unpack, args)))
+
+
+def _default(obj):
+    # NumPy scalars and arrays
+    return np.asarray(obj).tolist()
+
+
+def _hash(*data):
+    data = json.dumps(data, sort_keys=True, default=_default)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class Result(object):
+    """The lazily evaluated result of a stage."""
+
+    def __init__(self, stages, name, func, args, key):
+        self.stages = stages
+        self.name = name
+        self.func = func
+        self.args = args
+        self.key = key
+        self._value = _MISSING
+
+    def __getitem__(self, index):
+        return _Item(self, index)
+
+    def inputs(self):
+        """Return the values of the arguments of the stage function."""
+        return [a.value if isinstance(a, (Result, _Item)) else a for a in self.args]
+
+    def ready(self):
+        """Return true if the value is known without running the stage."""
+        return self._value is not _MISSING or (
+            self.stages.cache is not None and self.key in self.stages.cache
+        )
+
+    @property
+    def value(self):
+        if self._value is _MISSING:
+            cache = self.stages.cache
+            if cache is not None:
+                try:
+                    self._value = cache.get(self.key)
+                except KeyError:
+                    pass
+            if self._value is _MISSING:
+                inputs = self.inputs()
+                with stage(self.name):
+                    self.set(self.func(*inputs))
+        return self._value
+
+    def set(self, value):
+        self._value = value
+        if self.stages.cache is not None:
+            self.stages.cache.put(self.key, value)
+
+
+class _Item(object):
+    """An item of the result of a stage, usable as the input of another
+    stage.
+    """
+
+    def __init__(self, result, index):
+        self.result = result
+        self.index = index
+        self.key = _hash(result.key, index)
+
+    def __getitem__(self, index):
+        return _Item(self, index)
+
+    @property
+    def value(self):
+        return self.result.value[self.index]
+
+
+class Stages(object):
+    """Graph of stages, with results memoized in a meshscripts.cache.Cache.
+    Without a cache, results are computed when needed and kept in memory
+    only.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def run(self, name, func, *args):
+        """Return the Result of func(*args) as the stage `name`.  Arguments
+        that are Results, or items of Results, are passed as their values.
+        """
+        inputs = [a.key if isinstance(a, (Result, _Item)) else a for a in args]
+        key = _hash('stage', name, _source(func), library_versions(), inputs)
+        return Result(self, name, func, args, key)
+
+    def map(self, name, func, items, *args, jobs=1):
+        """Return the Results of func(item, *args) for each item, as stages
+        called `name`.  If jobs > 1, those that are not cached are computed
+        in that many processes.
+        """
+        results = [self.run(name, func, item, *args) for item in items]
+        todo = [r for r in results if not r.ready()]
+        if jobs > 1 and len(todo) > 1:
+            inputs = [[_pack(value) for value in r.inputs()] for r in todo]
+            with stage(name), futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                values = list(pool.map(_call_packed, [func] * len(todo), *zip(*inputs)))
+            for result, value in zip(todo, values):
+                result.set(_unpack(value))
+        return results
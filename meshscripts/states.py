@@ -0,0 +1,63 @@
+"""Deformation states of a mesh.
+
+When a mesh moves, as around the flag in a fluid-structure run, its
+topology and knot vectors stay the same and only control points change.
+Instead of a full patch file per state, the states are written to
+'<out>.states.npz' as changes to the control points of the reference patch
+file.
+
+The file holds 'patches', the numbers of the patches that change (from 1,
+as in the .xinp file), and 'components', the coordinates that change.  For
+each such patch, 'p<patch>' holds the changes in every state, with shape
+(states, control points, components), with the control points in the
+order of the patch file, the first parametric direction running fastest.
+For rational patches, the changes are to the weighted coordinates, as
+stored.
+"""
+
+from meshscripts.files import open_output
+from meshscripts.lazy import lazy_import
+
+
+np = lazy_import('numpy')
+
+EXTENSION = '.states.npz'
+
+
+def _file_axes(pardim):
+    # The control point axes in file order, the first direction fastest
+    return tuple(range(pardim))[::-1] + (pardim,)
+
+
+def write_states(fn, patches, deltas, components):
+    """Write the states to fn.states.npz.  `deltas` maps the names of the
+    patches that change to the changes to their control points, with shape
+    (states,) + the control point grid + (len(components),).
+    """
+    numbers = {name: i for i, name in enumerate(patches, 1)}
+    arrays = {
+        'patches': np.array([numbers[name] for name in deltas], dtype=int),
+        'components': np.array(components, dtype=int),
+    }
+    for name, delta in deltas.items():
+        axes = (0,) + tuple(d + 1 for d in _file_axes(patches[name].pardim))
+        delta = np.transpose(delta, axes).reshape(len(delta), -1, len(components))
+        arrays['p{}'.format(numbers[name])] = delta
+    with open_output(fn + EXTENSION, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def apply_state(fn, patches, state):
+    """Return copies of the patches, in the order of the patch file, with
+    the changes of a state in fn.states.npz applied.
+    """
+    patches = [patch.clone() for patch in patches]
+    with np.load(fn + EXTENSION) as f:
+        components = f['components']
+        for number in f['patches']:
+            patch = patches[number - 1]
+            delta = f['p{}'.format(number)][state]
+            delta = delta.reshape(patch.shape[::-1] + (len(components),))
+            delta = np.transpose(delta, _file_axes(patch.pardim))
+            patch.controlpoints[..., components] += delta
+    return patches
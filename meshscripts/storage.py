@@ -0,0 +1,48 @@
+"""Out-of-core storage of patches.
+
+A PatchDict given a Spill moves the control points of each patch to a .npy
+file as soon as the patch is added, and replaces them with a memory map of
+that file.  The patches remain ordinary splipy objects, but their control
+points are paged in from disk when used, and can be paged out again by the
+operating system, so meshes larger than memory can be generated and
+written one patch at a time.
+"""
+
+import itertools
+import os
+import shutil
+import tempfile
+import weakref
+
+from meshscripts.lazy import lazy_import
+
+
+np = lazy_import('numpy')
+
+
+class Spill(object):
+    """Storage for control points in a temporary directory, created in the
+    given directory (default: the system temporary directory) and removed
+    with the Spill.
+    """
+
+    def __init__(self, path=None):
+        self.path = tempfile.mkdtemp(prefix='meshscripts-spill-', dir=path)
+        self._count = itertools.count()
+        weakref.finalize(self, shutil.rmtree, self.path, ignore_errors=True)
+
+    def store(self, patch):
+        """Move the control points of a patch to disk, in place, and return
+        the patch.
+        """
+        if isinstance(patch.controlpoints, np.memmap):
+            return patch
+        fn = os.path.join(self.path, '{}.npy'.format(next(self._count)))
+        np.save(fn, patch.controlpoints)
+        patch.controlpoints = np.load(fn, mmap_mode='r+')
+        try:
+            # The mapping keeps the data, and the space is freed with it
+            os.unlink(fn)
+        except OSError:
+            pass
+        return patch
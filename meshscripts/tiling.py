@@ -0,0 +1,224 @@
+"""Tiling of a cell into a grid of translated copies.
+
+Meshes of periodic structures, like perforated plates and tube banks,
+repeat a cell many times.  Instead of building every copy, the cell is
+built once and the control points of each of its patches are translated
+to all positions of the grid at once.  The connections within a copy and
+between neighbouring copies are detected once, on a block of two by two
+copies, and repeated over the grid, so the time taken is linear in the
+number of copies.
+
+Where the copies are not all needed at once, translated() instead returns
+a patch that only holds its template and an offset, and computes its
+control points whenever they are used.  A mesh of such instances takes
+the memory of its templates, until the patches are written.  With
+write_instances(), the solver side can avoid the duplication too: the
+distinct templates are written to '<out>.templates<ext>', in the format of
+the patch file, and '<out>.instances.json' lists, for each patch of the
+mesh in the order of the patch file, its template (numbered from 1) and
+its offset, as 'instances': [[template, dx, dy, ...], ...].  The JSON file
+also names the 'format' and 'compression' of the templates.
+"""
+
+import copy
+from itertools import product
+import json
+
+from meshscripts.files import open_output
+from meshscripts.interfaces import find_interfaces, inverse
+from meshscripts.io import FORMATS, patch_writer
+from meshscripts.lazy import lazy_import
+from meshscripts.order import to_order
+from meshscripts.topology import PatchDict
+
+
+np = lazy_import('numpy')
+
+INSTANCES_EXTENSION = '.instances.json'
+TEMPLATES_EXTENSIONS = ['.templates' + ext for ext in sorted(set(FORMATS.values()))]
+
+
+def instance_name(name, i, j):
+    """Return the name of the copy in column i and row j, from 1, of a
+    patch or boundary set of the cell.
+    """
+    return '{}-{}-{}'.format(name, i, j)
+
+
+def _instance(patch, cps):
+    # A copy of the patch with other control points.  Unlike the spline
+    # constructors, this shares the bases instead of copying them.
+    result = copy.copy(patch)
+    result.bases = list(patch.bases)
+    result.controlpoints = cps
+    return result
+
+
+class _Translated(object):
+    # Mixed into a spline class by translated(): the control points are
+    # those of the template, translated, until some are assigned
+
+    @property
+    def controlpoints(self):
+        cps = self.__dict__.get('_controlpoints')
+        if cps is not None:
+            return cps
+        cps = self.template.controlpoints.copy()
+        if self.rational:
+            cps[..., :-1] += self.offset * cps[..., -1:]
+        else:
+            cps += self.offset
+        # Changes in place would be lost
+        cps.flags.writeable = False
+        return cps
+
+    @controlpoints.setter
+    def controlpoints(self, cps):
+        self.__dict__['_controlpoints'] = cps
+
+    def __reduce_ex__(self, protocol):
+        # Copies and pickles are plain patches
+        result = copy.copy(self.template)
+        result.bases = list(self.bases)
+        result.controlpoints = np.array(self.controlpoints)
+        return result.__reduce_ex__(protocol)
+
+
+_classes = {}
+
+
+def translated(patch, offset):
+    """Return an instance of a patch translated by `offset`, which computes
+    its control points from those of the patch whenever they are used.
+    The instance shares the bases of the patch, and its control points are
+    read-only, so it must be cloned before changing it in place.  Copies
+    are plain patches.
+    """
+    cls = type(patch)
+    if cls not in _classes:
+        _classes[cls] = type(cls.__name__, (_Translated, cls), {})
+    result = _classes[cls].__new__(_classes[cls])
+    result.__dict__.update((k, v) for k, v in patch.__dict__.items() if k != 'controlpoints')
+    result.bases = list(patch.bases)
+    result.template = patch
+    result.offset = np.zeros(patch.dimension)
+    result.offset[:len(offset)] = offset
+    return result
+
+
+def _template(patch):
+    # The template of a patch and its offset, or the patch itself
+    if isinstance(patch, _Translated) and '_controlpoints' not in patch.__dict__:
+        return patch.template, patch.offset
+    return patch, np.zeros(patch.dimension)
+
+
+def write_instances(fn, patches, order=4, fmt='g2', compression=None, compression_level=None):
+    """Write the templates of the patches, lowered to the given order, to
+    fn.templates<ext>, compressed if asked to, and the instances to
+    fn.instances.json (see above).  Patches that are not instances of
+    translated() are templates of their own.
+    """
+    numbers, instances = {}, []
+    with patch_writer(fn + '.templates', fmt, compression, compression_level) as f:
+        for patch in patches.values():
+            template, offset = _template(patch)
+            if id(template) not in numbers:
+                numbers[id(template)] = len(numbers) + 1
+                f.write(to_order(template, *(min(p, order) for p in template.order())))
+            instances.append([numbers[id(template)]] + offset.tolist())
+    with open_output(fn + INSTANCES_EXTENSION) as f:
+        json.dump({'format': fmt, 'compression': compression, 'instances': instances}, f)
+
+
+def _translated(cell, positions, pitch):
+    # For each patch of the cell, its copies at the given grid positions
+    offsets = np.asarray(positions, dtype=float) * pitch
+    copies = {}
+    for name, patch in cell.items():
+        shift = np.zeros((len(positions),) + (1,) * patch.pardim + (patch.dimension,))
+        shift[..., :offsets.shape[1]] = offsets.reshape(shift.shape[:-1] + (-1,))
+        cps = np.repeat(patch.controlpoints[np.newaxis], len(positions), axis=0)
+        if patch.rational:
+            cps[..., :-1] += shift * cps[..., -1:]
+        else:
+            cps += shift
+        copies[name] = [_instance(patch, c) for c in cps]
+    return copies
+
+
+def _templates(cell, pitch):
+    # The connections of a block of two by two copies, as connections of
+    # the copy at the origin, with the offset of the copy of the slave.
+    # Each connection is kept once, with a non-negative offset.
+    positions = list(product(range(2), repeat=2))
+    copies = _translated(cell, positions, pitch)
+    owner = {
+        (name, k): (name, position)
+        for name in cell for k, position in enumerate(positions)
+    }
+    block = {(name, k): copies[name][k] for name in cell for k in range(len(positions))}
+
+    templates = set()
+    for iface in find_interfaces(block):
+        (master, mpos), (slave, spos) = owner[iface.master], owner[iface.slave]
+        medge, sedge, orient = iface.midx, iface.sidx, iface.orient
+        offset = (spos[0] - mpos[0], spos[1] - mpos[1])
+        if offset[::-1] < (0, 0):
+            master, medge, slave, sedge = slave, sedge, master, medge
+            orient = inverse(orient)
+            offset = (-offset[0], -offset[1])
+        templates.add((master, medge, slave, sedge, orient, offset))
+    return sorted(templates, key=lambda t: (t[5][::-1], list(cell).index(t[0]), t[1]))
+
+
+def tile(cell, shape, pitch, sides=None, instanced=()):
+    """Return a PatchDict with copies of the patches of `cell` on a grid
+    of shape[0] columns by shape[1] rows, the copy in column i and row j
+    translated by (i * pitch[0], j * pitch[1]).  The copies are named with
+    instance_name(), and numbered row by row.  The copies share the
+    basis objects of the cell, so they must be cloned before inserting
+    knots in place.
+
+    Connections are detected between the copies (see above), not taken
+    from the cell.  Boundary sets listed in `sides`, mapping set names to
+    (direction, end), are kept on the copies at that end of the grid in
+    that direction (end 0 or 1), and dropped elsewhere, as they are
+    interior.  Boundary sets listed in `instanced` get a set of their own
+    for each copy, named with instance_name().  Other sets gather all
+    copies.
+    """
+    sides = sides or {}
+    nx, ny = shape
+    positions = [(i, j) for j in range(ny) for i in range(nx)]
+    copies = _translated(cell, positions, pitch)
+
+    result = PatchDict(cell.dim, spill=cell.spill)
+    for k, (i, j) in enumerate(positions):
+        for name in cell:
+            result[instance_name(name, i + 1, j + 1)] = copies[name][k]
+    del copies
+
+    for master, medge, slave, sedge, orient, (di, dj) in _templates(cell, pitch):
+        for i, j in positions:
+            if 0 <= i + di < nx and 0 <= j + dj < ny:
+                result.connect((instance_name(master, i + 1, j + 1), medge,
+                                instance_name(slave, i + di + 1, j + dj + 1), sedge, orient))
+
+    for set_name, kinds in cell.boundaries.items():
+        for i, j in positions:
+            if set_name in sides:
+                direction, end = sides[set_name]
+                if (i, j)[direction] != end * (shape[direction] - 1):
+                    continue
+                name = set_name
+            elif set_name in instanced:
+                name = instance_name(set_name, i + 1, j + 1)
+            else:
+                name = set_name
+            for kind, items in kinds.items():
+                for patch, number in items:
+                    result.boundaries.setdefault(name, {}).setdefault(kind, []).append(
+                        (instance_name(patch, i + 1, j + 1), number)
+                    )
+    return result
@@ -0,0 +1,449 @@
+"""Patches with topology information.
+
+A PatchDict holds named patches, the connections between them and named
+boundary sets.  It writes the patches to a patch file, lowering their order
+and validating them on the way, and the topology to an IFEM .xinp file.
+The .xinp file is streamed, without building a document tree, so that
+writing it stays cheap for large numbers of patches.
+"""
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from meshscripts.compression import COMPRESSIONS, CompressedWriter
+from meshscripts.files import staged
+from meshscripts.hierarchy import refine
+from meshscripts.interfaces import Interface, find_interfaces, inverse
+from meshscripts.io import patch_filename, patch_writer
+from meshscripts.lazy import lazy_import
+from meshscripts.partition import Statistics, dofs, elements, imbalance, linear_partition, ordering
+from meshscripts.profile import stage
+from meshscripts.validate import InvalidMeshError, jacobian_report, format_reports
+
+
+xml = lazy_import('lxml.etree')
+np = lazy_import('numpy')
+
+
+class PatchDict(OrderedDict):
+
+    def __init__(self, dim, *args, spill=None, **kwargs):
+        # Patches are moved to the spill, a meshscripts.storage.Spill, as
+        # they are added
+        self.spill = spill
+        super(PatchDict, self).__init__(*args, **kwargs)
+        self.dim = dim
+        self.masters = {}
+        self.boundaries = {}
+        self.periodics = []
+        self.ranks = None
+
+    def __setitem__(self, name, patch):
+        if self.spill is not None:
+            patch = self.spill.store(patch)
+        super(PatchDict, self).__setitem__(name, patch)
+
+    def add(self, *args):
+        names, patches = args[:-1], args[-1]
+        for name, patch in zip(names, patches):
+            self[name] = patch
+
+    def connect(self, *args):
+        # Each connection may be flagged 'rev' and 'per', or given an
+        # orientation number as in meshscripts.interfaces
+        for master, medge, slave, sedge, *rest in args:
+            orient = next((r for r in rest if isinstance(r, int)), int('rev' in rest))
+            per = 'per' in rest
+
+            if master == slave and per:
+                self.periodics.append((master, max(medge, sedge) // 2))
+            elif master != slave:
+                self.masters[(master, medge)] = (slave, sedge, orient, per)
+            else:
+                raise Exception('What?')
+
+    def detect(self, tol=None, periods=()):
+        """Add the connections found by meshscripts.interfaces."""
+        for iface in find_interfaces(self, tol, periods):
+            flags = ['per'] if iface.periodic else []
+            self.connect((iface.master, iface.midx, iface.slave, iface.sidx, iface.orient, *flags))
+
+    def interfaces(self):
+        """Return the connections as a list of Interface tuples."""
+        result = [
+            Interface(master, medge, slave, sedge, orient, per)
+            for (master, medge), (slave, sedge, orient, per) in self.masters.items()
+        ]
+        result.extend(Interface(patch, 2*d - 1, patch, 2*d, 0, True) for patch, d in self.periodics)
+        return result
+
+    def boundary(self, name, patch, number, dim=-1, add=0):
+        kind = {
+            2: ['vertex', 'edge'],
+            3: ['vertex', 'edge', 'face'],
+        }[self.dim][dim]
+        number += add
+        self.boundaries.setdefault(name, {}).setdefault(kind, []).append((patch, number))
+
+    def _adjacency(self):
+        # For each patch, its connections as (boundary, neighbour, neighbour
+        # boundary, orientation seen from the patch)
+        adjacency = {name: [] for name in self}
+        for (master, medge), (slave, sedge, orient, _) in self.masters.items():
+            adjacency[master].append((medge, slave, sedge, orient))
+            adjacency[slave].append((sedge, master, medge, inverse(orient)))
+        return adjacency
+
+    def _split_plan(self, name, direction, knot):
+        # Splitting a patch cuts the boundaries along the split direction,
+        # so the neighbours across them must be split too.  Returns, for
+        # each patch to split, the direction and the knot.
+        adjacency = self._adjacency()
+        pardim = self[name].pardim
+        plan = {name: (direction, _relative(self[name], direction, knot))}
+        queue = deque([name])
+        while queue:
+            patch = queue.popleft()
+            d, s = plan[patch]
+            for number, neighbour, nnumber, orient in adjacency[patch]:
+                if (number - 1) // 2 == d:
+                    continue
+                nd, rev = _tangent(pardim, number, nnumber, orient, d)
+                ns = 1 - s if rev else s
+                if neighbour in plan:
+                    if plan[neighbour][0] != nd or abs(plan[neighbour][1] - ns) > 1e-10:
+                        raise ValueError('Patch {} can not be split conformingly'.format(name))
+                    continue
+                plan[neighbour] = (nd, ns)
+                queue.append(neighbour)
+        return {
+            patch: (d, _absolute(self[patch], d, s)) for patch, (d, s) in plan.items()
+        }
+
+    def split(self, name, direction, knot=None):
+        """Split a patch in two along a parametric direction, at the given
+        knot (by default, the middle one).  Neighbouring patches are split as
+        needed to keep all connections conforming.  Split patches are
+        replaced by two patches named '<name>.0' and '<name>.1', and the
+        connections and boundary sets are updated.  Raises ValueError if
+        the split can not be done conformingly.
+        """
+        if knot is None:
+            kts = self[name].knots(direction)
+            if len(kts) < 3:
+                raise ValueError('Patch {} has a single element in direction {}'.format(name, direction))
+            knot = kts[len(kts) // 2]
+        plan = self._split_plan(name, direction, knot)
+        pardim = self[name].pardim
+
+        halves = {}
+        items = []
+        for patch, obj in self.items():
+            if patch not in plan:
+                items.append((patch, obj))
+                continue
+            d, t = plan[patch]
+            names = ['{}.{}'.format(patch, i) for i in range(2)]
+            halves[patch] = names
+            items.extend(zip(names, obj.split(t, d)))
+        self.clear()
+        self.update(items)
+
+        def parts(patch, entity):
+            # The halves of a patch containing a boundary entity
+            if patch not in plan:
+                return [patch]
+            fixed = entity if isinstance(entity, dict) else _fixed(pardim, entity[0], entity[1])
+            d = plan[patch][0]
+            return [halves[patch][fixed[d]]] if d in fixed else halves[patch]
+
+        codim = 'edge' if pardim == 2 else 'face'
+        masters = {}
+        for (master, medge), (slave, sedge, orient, per) in self.masters.items():
+            mparts, sparts = parts(master, (codim, medge)), parts(slave, (codim, sedge))
+            if len(mparts) == 2 and _tangent(pardim, medge, sedge, orient, plan[master][0])[1]:
+                sparts = sparts[::-1]
+            for m, s in zip(mparts, sparts):
+                masters[(m, medge)] = (s, sedge, orient, per)
+
+        periodics = []
+        for patch, d in self.periodics:
+            if patch in plan and plan[patch][0] == d - 1:
+                lower, upper = halves[patch]
+                masters[(lower, 2*d - 1)] = (upper, 2*d, 0, True)
+            else:
+                periodics.extend((p, d) for p in parts(patch, {}))
+
+        for patch, (d, _) in plan.items():
+            lower, upper = halves[patch]
+            masters[(lower, 2*d + 2)] = (upper, 2*d + 1, 0, False)
+
+        for kinds in self.boundaries.values():
+            for kind, entries in kinds.items():
+                kinds[kind] = [
+                    (p, number) for patch, number in entries for p in parts(patch, (kind, number))
+                ]
+
+        self.masters, self.periodics = masters, periodics
+        return halves
+
+    def partition(self, nprocs, order=None, tol=0.05):
+        """Distribute the patches over nprocs processes with balanced numbers
+        of elements.  The patches are reordered so that each process gets a
+        contiguous range, and the largest patches are split (along with
+        their neighbours) until the imbalance is at most tol, if possible.
+        DOFs are counted for the patches lowered to the given order.
+        Returns the Statistics of the partition.
+        """
+        while True:
+            adjacency = {
+                patch: [neighbour for _, neighbour, _, _ in conns]
+                for patch, conns in self._adjacency().items()
+            }
+            names = ordering(adjacency)
+            weights = [elements(self[patch]) for patch in names]
+            if len(names) >= nprocs:
+                ranges = linear_partition(weights, nprocs)
+                loads = [sum(weights[start:stop]) for start, stop in ranges]
+                if imbalance(loads) <= tol:
+                    break
+            # With no patch larger than tol times the mean load, the best
+            # ranges are balanced to within tol, so splitting further is moot
+            if not self._split_largest(weights, names, tol * sum(weights) / nprocs):
+                if len(names) < nprocs:
+                    raise ValueError('Can not divide the patches over {} processes'.format(nprocs))
+                break
+
+        items = [(patch, self[patch]) for patch in names]
+        self.clear()
+        self.update(items)
+        self.ranks = [(start + 1, stop) for start, stop in ranges]
+
+        rank = {patch: k for k, (start, stop) in enumerate(ranges) for patch in names[start:stop]}
+        return Statistics(
+            elements=[sum(weights[start:stop]) for start, stop in ranges],
+            dofs=[sum(dofs(self[patch], order) for patch in names[start:stop]) for start, stop in ranges],
+            interfaces=len(self.masters),
+            cut=sum(rank[master] != rank[slave] for (master, _), (slave, *_) in self.masters.items()),
+        )
+
+    def _split_largest(self, weights, names, limit):
+        # Split the largest patch possible, if larger than the limit, in the
+        # direction that splits the fewest other patches
+        for weight, patch in sorted(zip(weights, names), key=lambda x: -x[0]):
+            if weight <= limit:
+                break
+            obj = self[patch]
+            candidates = []
+            for d in range(obj.pardim):
+                kts = obj.knots(d)
+                if len(kts) < 3:
+                    continue
+                try:
+                    plan = self._split_plan(patch, d, kts[len(kts) // 2])
+                except ValueError:
+                    continue
+                candidates.append((len(plan), -len(kts), d))
+            if candidates:
+                _, _, d = min(candidates)
+                self.split(patch, d)
+                return True
+        return False
+
+    def _derived(self, items):
+        # A PatchDict of the given patches, with the topology of this one
+        result = PatchDict(self.dim, items, spill=self.spill)
+        result.masters = dict(self.masters)
+        result.boundaries = {
+            name: {kind: list(entries) for kind, entries in kinds.items()}
+            for name, kinds in self.boundaries.items()
+        }
+        result.periodics = list(self.periodics)
+        result.ranks = self.ranks
+        return result
+
+    def lowered(self, order):
+        """Return a copy with the patches lowered to the given order."""
+        return self._derived((name, _lowered(patch, order)) for name, patch in self.items())
+
+    def refined(self, factor=2):
+        """Return a copy with every element split uniformly into `factor`
+        elements in each direction, by knot insertion.  The geometry is
+        unchanged, and conforming connections stay conforming.
+        """
+        with stage('refine'):
+            return self._derived((name, refine(patch, factor)) for name, patch in self.items())
+
+    def write(self, fn, order=4, fmt='g2', validate=True, jobs=None, pretty=True, compression=None,
+              compression_level=None):
+        """Write the patches, lowered to the given order, and the topology,
+        compressed if asked to (see meshscripts.compression).  If validate
+        is true, raise an InvalidMeshError if any patch has inverted
+        elements.  The files replace those of an earlier run only once all
+        are written (see meshscripts.files).  Returns the Jacobian reports,
+        if any.
+        """
+        # Lower and write one patch at a time, so that only the lowered
+        # copies still being validated are kept in memory
+        jobs = jobs or os.cpu_count()
+        reports = []
+        patchfile = patch_filename(fn, fmt, compression)
+        directory, base = os.path.split(fn)
+        with staged(directory) as tmp:
+            writer = patch_writer(os.path.join(tmp, base), fmt, compression, compression_level)
+            with writer as f, ThreadPoolExecutor(max_workers=jobs) as pool:
+                pending = deque()
+                for name, patch in self.items():
+                    patch = _lowered(patch, order)
+
+                    if validate:
+                        if len(pending) > jobs:
+                            pending.popleft().result()
+                        future = pool.submit(jacobian_report, patch)
+                        pending.append(future)
+                        reports.append(future)
+
+                    with stage('serialize'):
+                        f.write(patch, name=name)
+
+            if validate:
+                reports = [future.result() for future in reports]
+                if any(r.inverted for r in reports):
+                    raise InvalidMeshError(
+                        'Inverted elements found in {}\n'.format(patchfile)
+                        + format_reports(self.keys(), reports)
+                    )
+
+            with stage('topology'):
+                self.write_topology(os.path.join(tmp, base), patchfile, pretty=pretty,
+                                    compression=compression, compression_level=compression_level)
+        return reports
+
+    def write_topology(self, fn, patchfile, pretty=True, compression=None, compression_level=None):
+        """Write the topology to fn.xinp, indented unless pretty is false,
+        and compressed if asked to.
+        """
+        pids = {name: i + 1 for i, name in enumerate(self)}
+        pardim = next(iter(self.values())).pardim
+
+        if compression:
+            f = CompressedWriter(fn + '.xinp' + COMPRESSIONS[compression], compression,
+                                 compression_level)
+        else:
+            f = open(fn + '.xinp', 'wb')
+        with f:
+            with xml.xmlfile(f, encoding='UTF-8') as xf:
+                def indent(depth):
+                    if pretty:
+                        xf.write('\n' + '  ' * depth)
+
+                xf.write_declaration(standalone=False)
+                with xf.element('geometry', dim=str(pardim)):
+                    indent(1)
+                    xf.write(_element('patchfile', text=patchfile))
+
+                    indent(1)
+                    with xf.element('topology'):
+                        for (master, medge), (slave, sedge, orient, periodic) in self.masters.items():
+                            mid, sid = pids[master], pids[slave]
+                            if mid > sid:
+                                mid, sid = sid, mid
+                                medge, sedge = sedge, medge
+                                orient = inverse(orient)
+                            attrib = {
+                                'master': str(mid),
+                                'midx': str(medge),
+                                'slave': str(sid),
+                                'sidx': str(sedge),
+                                'reverse': 'true' if orient & 1 else 'false',
+                                'periodic': 'true' if periodic else 'false',
+                            }
+                            if orient > 1:
+                                attrib['orient'] = str(orient)
+                            indent(2)
+                            xf.write(_element('connection', attrib))
+                        for patch, direction in self.periodics:
+                            indent(2)
+                            xf.write(_element('periodic', {
+                                'patch': str(pids[patch]),
+                                'dir': str(direction),
+                            }))
+                        indent(1)
+
+                    indent(1)
+                    with xf.element('topologysets'):
+                        for name, kinds in self.boundaries.items():
+                            for kind, items in kinds.items():
+                                indent(2)
+                                with xf.element('set', name=name, type=kind):
+                                    for patch, number in items:
+                                        indent(3)
+                                        xf.write(_element('item', {'patch': str(pids[patch])}, str(number)))
+                                    indent(2)
+                        indent(1)
+
+                    if self.ranks:
+                        indent(1)
+                        with xf.element('partitioning', procs=str(len(self.ranks))):
+                            for rank, (lower, upper) in enumerate(self.ranks):
+                                indent(2)
+                                xf.write(_element('part', {
+                                    'proc': str(rank),
+                                    'lower': str(lower),
+                                    'upper': str(upper),
+                                }))
+                            indent(1)
+                    indent(0)
+            f.write(b'\n')
+
+
+def _lowered(patch, order):
+    diff = [o - order for o in patch.order()]
+    if any(diff):
+        with stage('lower_order'):
+            patch = patch.lower_order(*diff)
+    return patch
+
+
+def _element(tag, attrib=None, text=None):
+    element = xml.Element(tag, attrib or {})
+    element.text = text
+    return element
+
+
+def _fixed(pardim, kind, number):
+    # The parametric directions fixed on a vertex, edge or face, mapped to
+    # the end (0 or 1) they are fixed at
+    k = number - 1
+    if kind == 'vertex':
+        return {d: k >> d & 1 for d in range(pardim)}
+    if kind == 'edge' and pardim == 3:
+        direction, k = divmod(k, 4)
+        others = [d for d in range(3) if d != direction]
+        return {others[0]: k & 1, others[1]: k >> 1 & 1}
+    return {k // 2: k % 2}
+
+
+def _tangent(pardim, number, nnumber, orient, direction):
+    # Map a direction along a boundary to the corresponding direction of the
+    # neighbour across it, and whether the two run opposite
+    tangents = [d for d in range(pardim) if d != (number - 1) // 2]
+    ntangents = [d for d in range(pardim) if d != (nnumber - 1) // 2]
+    i = tangents.index(direction)
+    j = 1 - i if orient & 4 else i
+    return ntangents[j], bool(orient >> i & 1)
+
+
+def _relative(patch, direction, knot):
+    kts = patch.knots(direction)
+    return (knot - kts[0]) / (kts[-1] - kts[0])
+
+
+def _absolute(patch, direction, s):
+    # Snap to the nearest knot, since conforming neighbours have the same
+    # relative knots
+    kts = patch.knots(direction)
+    knot = kts[0] + s * (kts[-1] - kts[0])
+    nearest = kts[np.argmin(np.abs(kts - knot))]
+    return nearest if abs(nearest - knot) <= 1e-8 * (kts[-1] - kts[0]) else knot
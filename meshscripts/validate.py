@@ -0,0 +1,137 @@
+"""Validation of patch parametrizations.
+
+The Jacobian determinant of each patch is evaluated on a tensor grid of
+Gauss points in every element.  For surfaces, the determinant of the
+in-plane (x, y) part is used, which is the z-component of the normal.
+Elements with a non-positive determinant at any point are reported as
+inverted, and writing a mesh with inverted elements raises an
+InvalidMeshError.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from meshscripts.lazy import lazy_import
+from meshscripts.profile import stage
+
+
+np = lazy_import('numpy')
+
+
+JacobianReport = namedtuple('JacobianReport', ['min', 'max', 'elements', 'inverted'])
+
+# Maximal number of evaluation points per batch, to bound memory use
+BATCH_SIZE = 2**20
+
+
+class InvalidMeshError(click.ClickException):
+    """Raised when writing a mesh with inverted elements.  Generator
+    commands report it as an error, without a traceback.
+    """
+
+
+def gauss_points(knots, npts):
+    """Return npts Gauss points in each knot span, as one array."""
+    knots = np.asarray(knots, dtype=float)
+    pts, _ = np.polynomial.legendre.leggauss(npts)
+    lower, upper = knots[:-1, np.newaxis], knots[1:, np.newaxis]
+    return ((upper - lower) / 2 * pts + (upper + lower) / 2).ravel()
+
+
+def _contract(cps, matrix, axis):
+    # Apply a (sparse) basis matrix along one axis of a control point array
+    cps = np.moveaxis(cps, axis, 0)
+    result = matrix @ cps.reshape(cps.shape[0], -1)
+    return np.moveaxis(result.reshape((matrix.shape[0],) + cps.shape[1:]), 0, axis)
+
+
+def derivatives(patch, *params):
+    """Return the first derivatives of a patch in each parametric direction,
+    on the tensor grid given by the parameter arrays.
+    """
+    if patch.rational:
+        return [patch.derivative(*params, d=tuple(int(i == j) for j in range(patch.pardim)))
+                for i in range(patch.pardim)]
+
+    values = [b.evaluate(p, sparse=True) for b, p in zip(patch.bases, params)]
+    firsts = [b.evaluate(p, d=1, sparse=True) for b, p in zip(patch.bases, params)]
+    derivs = []
+    for i in range(patch.pardim):
+        result = patch.controlpoints
+        for j in reversed(range(patch.pardim)):
+            result = _contract(result, firsts[j] if i == j else values[j], j)
+        derivs.append(result)
+    return derivs
+
+
+def determinant(patch, *params):
+    """Return the Jacobian determinant of a surface or volume patch on the
+    tensor grid given by the parameter arrays.
+    """
+    derivs = derivatives(patch, *params)
+    if patch.pardim == 2:
+        du, dv = derivs
+        return du[..., 0] * dv[..., 1] - du[..., 1] * dv[..., 0]
+    if patch.pardim == 3:
+        (ux, uy, uz), (vx, vy, vz), (wx, wy, wz) = (np.moveaxis(d, -1, 0) for d in derivs)
+        return ux * (vy * wz - vz * wy) - uy * (vx * wz - vz * wx) + uz * (vx * wy - vy * wx)
+    raise ValueError('Jacobian determinant undefined for {}D patches'.format(patch.pardim))
+
+
+def jacobian_report(patch, npts=None):
+    """Evaluate the Jacobian determinant of a patch in npts Gauss points per
+    element and direction (by default, the order in each direction), and
+    return a JacobianReport with its extremal values, the number of
+    elements and the number of inverted elements.
+    """
+    if npts is None:
+        npts = patch.order()
+    elif np.ndim(npts) == 0:
+        npts = [npts] * patch.pardim
+
+    with stage('validate'):
+        knots = [patch.knots(d) for d in range(patch.pardim)]
+        params = [gauss_points(kts, n) for kts, n in zip(knots, npts)]
+        nels = [len(kts) - 1 for kts in knots]
+
+        # Process whole elements in the last direction in batches
+        per_element = int(np.prod([len(p) for p in params[:-1]])) * npts[-1]
+        batch = max(1, BATCH_SIZE // per_element)
+
+        jmin, jmax, inverted = np.inf, -np.inf, 0
+        for start in range(0, nels[-1], batch):
+            stop = min(start + batch, nels[-1])
+            last = params[-1][start * npts[-1] : stop * npts[-1]]
+            det = determinant(patch, *params[:-1], last)
+
+            # Minimum in each element
+            shape = []
+            for nel, n in zip(nels[:-1] + [stop - start], npts):
+                shape.extend([nel, n])
+            elmin = det.reshape(shape).min(axis=tuple(range(1, len(shape), 2)))
+
+            jmin = min(jmin, det.min())
+            jmax = max(jmax, det.max())
+            inverted += int(np.count_nonzero(elmin <= 0.0))
+
+        return JacobianReport(float(jmin), float(jmax), int(np.prod(nels)), inverted)
+
+
+def validate(patches, npts=None, jobs=None):
+    """Return a JacobianReport for each patch, computed in parallel."""
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(lambda patch: jacobian_report(patch, npts), patches))
+
+
+def format_reports(names, reports):
+    """Return a table of Jacobian reports for the named patches."""
+    lines = ['{:>10} {:>12} {:>12} {:>10} {:>10}'.format(
+        'patch', 'min J', 'max J', 'elements', 'inverted'
+    )]
+    for name, r in zip(names, reports):
+        lines.append('{:>10} {:12.4e} {:12.4e} {:10d} {:10d}'.format(
+            str(name), r.min, r.max, r.elements, r.inverted
+        ))
+    return '\n'.join(lines)
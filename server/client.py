@@ -0,0 +1,33 @@
+import click
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from meshscripts.daemon import GENERATORS, request, socket_path
+
+
+@click.command(context_settings={'ignore_unknown_options': True, 'allow_interspersed_args': False})
+@click.option('--socket', 'path', type=click.Path(dir_okay=False), default=None,
+              help='Socket of the server (default: $MESHSCRIPTS_SOCKET or {})'.format(socket_path()))
+@click.option('--print-outputs', is_flag=True, help='Print the paths of the output files')
+@click.argument('generator', type=click.Choice(list(GENERATORS)))
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+def client(path, print_outputs, generator, args):
+    """Run GENERATOR with the options ARGS in the server."""
+    path = path or socket_path()
+    try:
+        response = request({'generator': generator, 'args': list(args), 'cwd': os.getcwd()}, path)
+    except OSError as e:
+        print('Can not reach the server at {}: {}'.format(path, e.strerror or e), file=sys.stderr)
+        sys.exit(1)
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    if print_outputs:
+        for fn in response['outputs']:
+            print(fn)
+    sys.exit(response['status'])
+
+
+if __name__ == '__main__':
+    client()
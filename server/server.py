@@ -0,0 +1,22 @@
+import click
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from meshscripts.daemon import serve, socket_path
+
+
+@click.command()
+@click.option('--socket', 'path', type=click.Path(dir_okay=False), default=None,
+              help='Socket to listen on (default: $MESHSCRIPTS_SOCKET or {})'.format(socket_path()))
+@click.option('--jobs', type=int, default=os.cpu_count(), help='Number of requests to run at a time')
+def server(path, jobs):
+    try:
+        serve(path, jobs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    server()
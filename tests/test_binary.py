@@ -0,0 +1,22 @@
+import pytest
+from splipy import surface_factory as sf
+
+from meshscripts.binary import BinaryReader, BinaryWriter
+
+
+def test_roundtrip(tmp_path):
+    fn = str(tmp_path / 'out')
+    with BinaryWriter(fn) as f:
+        f.write(sf.square(), name='a')
+    with BinaryReader(fn) as f:
+        patches = f.read()
+    assert len(patches) == 1
+
+
+def test_exception_removes_file(tmp_path):
+    fn = str(tmp_path / 'out')
+    with pytest.raises(RuntimeError):
+        with BinaryWriter(fn) as f:
+            f.write(sf.square())
+            raise RuntimeError
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,92 @@
+import importlib
+import inspect
+import sys
+
+from meshscripts import cli, stages
+from meshscripts.cache import Cache, _script_sources, output_states
+from meshscripts.grading import num_elements
+
+
+HELPER = '''
+def build(n):
+    return n
+'''
+
+GENERATOR = '''
+import click
+
+from meshscripts.cache import cached
+from meshscripts.files import open_output
+from gen_helper import build
+
+
+@click.command()
+@click.option('--n', default=1)
+@click.option('--out', default='out')
+@cached('gen')
+def gen(n, out):
+    with open_output(out + '.xinp') as f:
+        f.write(str(build(n)))
+'''
+
+
+def _run(gen, out):
+    gen.callback(cache=True, out=str(out), n=1)
+
+
+def test_helper_change_misses(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv('MESHSCRIPTS_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'gen_helper.py').write_text(HELPER)
+    (tmp_path / 'gen_script.py').write_text(GENERATOR)
+    for name in ('gen_helper', 'gen_script'):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    gen = importlib.import_module('gen_script').gen
+    out = tmp_path / 'out'
+
+    _run(gen, out)
+    _run(gen, out)
+    assert capsys.readouterr().err.splitlines()[1].startswith('Cache hit')
+
+    (tmp_path / 'gen_helper.py').write_text(HELPER.replace('return n', 'return 2 * n'))
+    _run(gen, out)
+    assert capsys.readouterr().err.startswith('Cache miss')
+
+
+def _sources(name):
+    return [f.replace('\\', '/').rsplit('/', 2)[-2:] for f in
+            _script_sources(inspect.unwrap(cli.load(name).callback))]
+
+
+def test_tube_bank_sources():
+    assert ['cylinder', 'cylinder.py'] in _sources('tube_bank')
+
+
+def test_plate_sources():
+    assert ['cut_square', 'cut_square.py'] in _sources('plate')
+
+
+def test_stage_key_has_versions(monkeypatch):
+    key = stages.Stages().run('s', num_elements, 1).key
+    monkeypatch.setattr(stages, 'library_versions', lambda: {'splipy': '0'})
+    assert stages.Stages().run('s', num_elements, 1).key != key
+
+
+def test_outputs_of_other_runs_ignored(tmp_path):
+    for fn in ['out.xinp', 'out-0.xinp', 'out-1.g2', 'out-3.g2', 'outer.xinp']:
+        (tmp_path / fn).write_text('')
+    out = str(tmp_path / 'out')
+    assert sorted(output_states(out)) == ['.xinp']
+    assert sorted(output_states(out, levels=2)) == ['-0.xinp', '-1.g2']
+
+
+def test_store_links_and_skips_large(tmp_path):
+    out = tmp_path / 'out'
+    (tmp_path / 'out.g2').write_bytes(b'x' * 100)
+    cache = Cache(str(tmp_path / 'cache'), max_size=1000)
+    cache.store('a', str(out), ['.g2'])
+    assert (tmp_path / 'cache' / 'a' / 'mesh.g2').stat().st_ino == (tmp_path / 'out.g2').stat().st_ino
+
+    cache.max_size = 50
+    cache.store('b', str(out), ['.g2'])
+    assert not (tmp_path / 'cache' / 'b').exists()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from meshscripts.grading import find_factor, first_size, graded_space, num_elements
+
+
+def test_graded_space():
+    points = graded_space(1.0, 0.5, 2.0, 4)
+    assert points == [1.0, 1.5, 2.5, 4.5]
+    assert graded_space(0.0, 1.0, 1.0, 3) == [0.0, 1.0, 2.0]
+
+
+def test_graded_space_arrays():
+    points = graded_space(0.0, np.array([1.0, 2.0]), 1.5, 5)
+    assert points.shape == (2, 5)
+    for row, step in zip(points, [1.0, 2.0]):
+        assert np.allclose(row, graded_space(0.0, step, 1.5, 5))
+
+
+def test_find_factor():
+    factor = find_factor(0.1, 2.0, 10)
+    assert np.isclose(graded_space(0.0, 0.1, factor, 11)[-1], 2.0)
+    factor, info = find_factor(np.array([0.1, 0.2]), 2.0, 10, full_output=True)
+    assert np.all(info.converged)
+    assert factor[0] > factor[1] > 1
+
+
+def test_find_factor_uniform():
+    assert np.isclose(find_factor(0.1, 1.0, 10), 1.0)
+
+
+def test_find_factor_invalid():
+    with pytest.raises(ValueError):
+        find_factor(0.0, 1.0, 10)
+    with pytest.raises(ValueError):
+        find_factor(0.1, 1.0, 1)
+    with pytest.raises(ValueError):
+        find_factor(2.0, 1.0, 10)
+
+
+@pytest.mark.parametrize('factor', [0.9, 1.0, 1 + 1e-10, 1.2])
+def test_first_size(factor):
+    first = first_size(3.0, factor, 7)
+    assert np.isclose(graded_space(0.0, first, factor, 8)[-1], 3.0)
+
+
+def test_first_size_inverts_find_factor():
+    factor = find_factor(0.05, 4.0, 20)
+    assert np.isclose(first_size(4.0, factor, 20), 0.05)
+
+
+@pytest.mark.parametrize('factor', [0.97, 1.0, 1.1])
+def test_num_elements_covers(factor):
+    nel = num_elements(0.1, 2.0, factor)
+    assert graded_space(0.0, 0.1, factor, nel + 1)[-1] >= 2.0 * (1 - 1e-8)
+    assert graded_space(0.0, 0.1, factor, nel)[-1] < 2.0
+
+
+@pytest.mark.parametrize('first, total', [(0.02, 1.0), (1.0, 50.0), (0.1, 5.0)])
+def test_num_elements_continuous_at_one(first, total):
+    counts = [num_elements(first, total, f) for f in (1 - 1e-10, 1.0, 1 + 1e-10)]
+    assert counts == [50, 50, 50]
+
+
+def test_num_elements_arrays():
+    nel = num_elements(0.1, np.array([1.0, 2.0]), 1.0)
+    assert nel.tolist() == [10, 20]
+
+
+def test_num_elements_invalid():
+    with pytest.raises(ValueError):
+        num_elements(0.1, 20.0, 0.9)
@@ -0,0 +1,18 @@
+import numpy as np
+from splipy import Surface, surface_factory as sf
+
+from meshscripts.stages import Stages
+
+
+def _scaled(patch, factor):
+    assert isinstance(patch, Surface)
+    return patch * factor
+
+
+def test_map_in_processes():
+    stages = Stages()
+    square = stages.run('square', sf.square)
+    results = stages.map('scale', _scaled, [square, square], 2.0, jobs=2)
+    for result in results:
+        assert isinstance(result.value, Surface)
+        assert np.allclose(result.value.controlpoints, 2 * square.value.controlpoints)
@@ -0,0 +1,37 @@
+import pytest
+from splipy import surface_factory as sf
+
+from meshscripts.topology import PatchDict
+from meshscripts.validate import InvalidMeshError
+
+
+def _patches(inverted):
+    patches = PatchDict(2)
+    patches['good'] = sf.square()
+    square = sf.square()
+    if inverted:
+        square.controlpoints[..., 0] *= -1
+    patches['bad'] = square
+    return patches
+
+
+@pytest.mark.parametrize('fmt', ['g2', 'binary'])
+def test_inverted_keeps_earlier_output(tmp_path, fmt):
+    out = str(tmp_path / 'out')
+    _patches(False).write(out, order=2, fmt=fmt)
+    before = {p.name: p.read_bytes() for p in tmp_path.iterdir()}
+    assert 'out.xinp' in before
+
+    with pytest.raises(InvalidMeshError, match='Inverted elements'):
+        _patches(True).write(out, order=2, fmt=fmt)
+    assert {p.name: p.read_bytes() for p in tmp_path.iterdir()} == before
+
+
+def test_replaces_earlier_output(tmp_path):
+    out = str(tmp_path / 'out')
+    _patches(False).write(out, order=2)
+    patches = _patches(False)
+    del patches['bad']
+    patches.write(out, order=2)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['out.g2', 'out.g2.index.json', 'out.xinp']
+    assert (tmp_path / 'out.g2').read_text().count('200 1 0 0') == 1
@@ -1,27 +1,53 @@
 import click
-import numpy as np
+from collections import OrderedDict
+import os
+import sys
 
-from splipy import curve_factory as cf, surface_factory as sf
-from splipy.IO import G2
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from meshscripts.cache import cached
+from meshscripts.lazy import lazy_import
+from meshscripts.profile import profiled, stage
+from meshscripts.sizing import patch_sizes, sized
+
+
+np = lazy_import('numpy')
+cf = lazy_import('splipy.curve_factory')
+sf = lazy_import('splipy.surface_factory')
+g2 = lazy_import('splipy.io.g2')
+
+
+def size_thingy(elements=(3, 20)):
+    """Return the Sizes of the mesh, without building it.  The numbers of
+    elements may be arrays.
+    """
+    # Quadratic circle segments, raised to quadratic across
+    return patch_sizes(OrderedDict([('thingy', tuple(elements))]), 3)
 
 
 @click.command()
 @click.option('--elements', nargs=2, default=(3, 20))
 @click.option('--radius', default=4.0)
 @click.option('--out', default='out')
+@profiled
+@sized(size_thingy)
+@cached('thingy')
 def thingy(radius, elements, out):
-    right = cf.circle_segment(np.pi/2)
-    right.rotate(-np.pi/4).translate((radius-1, 0, 0))
+    """Generate a single patch between two circle segments."""
+    with stage('build'):
+        right = cf.circle_segment(np.pi/2)
+        right.rotate(-np.pi/4).translate((radius-1, 0, 0))
 
-    left = right.clone().rotate(np.pi)
-    right.reverse()
+        left = right.clone().rotate(np.pi)
+        right.reverse()
 
-    thingy = sf.edge_curves(left, right)
-    thingy.raise_order(0, 1)
-    thingy.refine(*[e - 1 for e in elements])
+        thingy = sf.edge_curves(left, right)
+        thingy.raise_order(0, 1)
+        thingy.refine(*[e - 1 for e in elements])
 
-    with G2(out + '.g2') as f:
-        f.write([thingy])
+    with stage('serialize'):
+        with g2.G2(out + '.g2') as f:
+            f.write([thingy])
 
 
 if __name__ == '__main__':